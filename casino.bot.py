@@ -7,9 +7,1454 @@ import sqlite3
 import shutil
 import random
 import threading
+import queue
+import hashlib
+import json
+from fractions import Fraction
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait as futures_wait
 from dataclasses import dataclass
 from html import escape as html_escape
 from typing import Optional, List, Tuple, Dict
+import sys
+
+# SLOT MATH: символы, веса, правила выплат и таблицы. Ни бота, ни базы —
+# этот блок стоит до импорта telebot, чтобы симулятор (см. ниже) запускался отдельно.
+R_EMO = {
+    0: "💀",
+    1: "🍒",
+    2: "🍀",
+    3: "🍋",
+    4: "7⃣",
+    5: "👹",
+}
+# 1x3 шансы на 💀 👹 7⃣ , стандартные 🍒🍀🍋
+R_WEIGHTS_1x3 = [
+    (0, 2),   # 💀
+    (5, 1),   # 👹
+    (4, 4),   # 7⃣
+    (1, 6),   # 🍒
+    (2, 6),   # 🍀
+    (3, 6),   # 🍋
+]
+# 3x3 такие же шансы, как 1x3
+R_WEIGHTS_3x3 = R_WEIGHTS_1x3
+# 3x5 шансы
+R_WEIGHTS_3x5 = [
+    (5, 2),   # 👹
+    (4, 5),   # 7⃣
+    (1, 8),   # 🍒
+    (2, 8),   # 🍀
+    (3, 8),   # 🍋
+    (0, 4),   # 💀
+]
+
+def weighted_pick(pairs):
+    total = sum(w for _, w in pairs)
+    r = random.randint(1, total)
+    s = 0
+    for val, w in pairs:
+        s += w
+        if r <= s:
+            return val
+    return pairs[-1][0]
+
+def roulette_weights_apply(base, active) -> List[Tuple[int, int]]:
+    """Веса [(code, weight), ...] с учётом активных предметов (magnet, wine)."""
+    mul = {0: 1.0, 1: 1.0, 2: 1.0, 3: 1.0, 4: 1.0, 5: 1.0}
+
+    # Магнит: стандартные 🍒🍀🍋 (1,2,3) +10%
+    if active.get("magnet", 0) > 0:
+        for c in (1, 2, 3):
+            mul[c] *= 1.10
+
+    # Вино: 7⃣ (4) и 💀 (0) +20%
+    if active.get("wine", 0) > 0:
+        mul[4] *= 1.20
+        mul[0] *= 1.20
+
+    out = []
+    for code, w in base:
+        code = int(code)
+        w2 = int(round(float(w) * mul.get(code, 1.0)))
+        out.append((code, max(1, w2)))
+    return out
+
+def fake_clover_apply(rfmt: str, state, rnd=random):
+    # выбираем 1 клетку и форсим: 50% 7⃣(4) иначе 💀(0)
+    forced = 4 if rnd.random() < 0.5 else 0
+
+    if rfmt == "1x3":
+        idx = rnd.randrange(3)
+        st = list(state)
+        st[idx] = forced
+        return st
+
+    # 3x3 или 3x5
+    rows = len(state)
+    cols = len(state[0]) if rows else 0
+    r = rnd.randrange(rows)
+    c = rnd.randrange(cols)
+    st = [list(row) for row in state]
+    st[r][c] = forced
+    return st
+
+def _pepper_triggers_demon_ref(state, rfmt: str) -> bool:
+    """Триггер для 'Перца дьявола': 3💀 в 1×3/3×3 (по линии), 5💀 по строке в 3×5."""
+    try:
+        if rfmt == "1x3":
+            return (isinstance(state, list) and len(state) == 3 and all(int(x) == 0 for x in state))
+
+        if rfmt == "3x3":
+            g = state
+            if not g or len(g) != 3 or len(g[0]) != 3:
+                return False
+            # строки
+            for r in range(3):
+                if all(int(g[r][c]) == 0 for c in range(3)):
+                    return True
+            # столбцы
+            for c in range(3):
+                if all(int(g[r][c]) == 0 for r in range(3)):
+                    return True
+            # диагонали
+            if all(int(g[i][i]) == 0 for i in range(3)):
+                return True
+            if all(int(g[i][2 - i]) == 0 for i in range(3)):
+                return True
+            return False
+
+        if rfmt == "3x5":
+            g = state
+            if not g or len(g) != 3 or len(g[0]) != 5:
+                return False
+            # 5💀 подряд — трактуем как строка из пяти 💀
+            for r in range(3):
+                if all(int(g[r][c]) == 0 for c in range(5)):
+                    return True
+            return False
+    except Exception:
+        return False
+
+    return False
+
+def _line3_rule(codes: List[int], stake_cents: int) -> int:
+    """
+    Возвращает изменение баланса (в центах) за ход.
+    Правила - упрощённо/логично по твоему ТЗ:
+    - если есть 💀: штраф зависит от количества 💀 (1=-2x, 2=-3x, 3=-(всё) и долг -2x) -> долг реализуем позже; сейчас: -5x
+    - 7⃣: если 1 шт -> 1x, 2 -> +2x, 3 -> +3x
+    - 👹: 1 -> 1x, 2 -> +4x, 3 -> +5x
+    - 🍒🍀🍋:
+        3 одинаковых -> +0.1x
+        2 одинаковых рядом -> 0
+        иначе -> -1x
+    """
+    stake = int(stake_cents)
+
+    skulls = codes.count(0)
+    if skulls > 0:
+        if skulls == 1:
+            return -2 * stake
+        if skulls == 2:
+            return -3 * stake
+        return -5 * stake
+    
+    def is_std(x): return x in (1, 2, 3)
+    if is_std(codes[0]) and is_std(codes[1]) and codes[0] == codes[1]:
+        return 0
+    if is_std(codes[1]) and is_std(codes[2]) and codes[1] == codes[2]:
+        return 0
+    
+    std_adjacent = ((is_std(codes[0]) and is_std(codes[1])) or (is_std(codes[1]) and is_std(codes[2])))
+    sevens = codes.count(4)
+    demons = codes.count(5)
+    if std_adjacent:
+        if sevens == 1 and demons == 0:
+            return 0
+        if demons == 1 and sevens == 0:
+            return 0
+
+    if sevens > 0:
+        if sevens == 1:
+            return +1 * stake
+        if sevens == 2:
+            return +2 * stake
+        return +3 * stake
+
+    if demons > 0:
+        if demons == 1:
+            return +1 * stake
+        if demons == 2:
+            return +4 * stake
+        return +5 * stake
+
+    if codes[0] == codes[1] == codes[2]:
+        return int(round(1 * stake))
+    if codes[0] == codes[1] or codes[1] == codes[2]:
+        return 0
+    return -1 * stake
+
+def _calc_delta_3x3_ref(grid: List[List[int]], stake_cents: int) -> int:
+    stake = int(stake_cents)
+    total = 0
+
+    for r in range(3):
+        total += _line3_rule(grid[r], stake)
+
+    for c in range(3):
+        col = [grid[r][c] for r in range(3)]
+        total += _line3_rule(col, stake)
+
+    d1 = [grid[i][i] for i in range(3)]
+    if d1[0] == d1[1] == d1[2]:
+        total += _line3_rule(d1, stake)
+
+    d2 = [grid[i][2 - i] for i in range(3)]
+    if d2[0] == d2[1] == d2[2]:
+        total += _line3_rule(d2, stake)
+
+    return total
+
+def _max_run_len(row: List[int], sym: int) -> int:
+    best = 0
+    cur_run = 0
+    for x in row:
+        if x == sym:
+            cur_run += 1
+            best = max(best, cur_run)
+        else:
+            cur_run = 0
+    return best
+
+def _has_run_len(row: List[int], sym: int, n: int) -> bool:
+    return _max_run_len(row, sym) >= n
+
+def _skull_penalty_row5(row: List[int], stake: int) -> int:
+    skulls = row.count(0)
+    if skulls >= 3:
+        if skulls == 3:
+            return -1 * stake
+        if skulls == 4:
+            return -3 * stake
+        # 5 skulls: "минус все и долг"
+        return -5 * stake
+
+    # 2 подряд из пяти -> -0.2 ставки
+    if skulls == 2 and _has_run_len(row, 0, 2):
+        return int(round(-0.2 * stake))
+
+    # 1 skull "ничего"
+    return 0
+
+def _row5_rule(row: List[int], stake_cents: int) -> int:
+    stake = int(stake_cents)
+
+    # сначала 💀 (они могут полностью перебить)
+    skull_pen = _skull_penalty_row5(row, stake)
+    if skull_pen != 0:
+        return skull_pen
+
+    # 👹 джекпот/крупные серии
+    if _has_run_len(row, 5, 5):  # 👹👹👹👹👹
+        return 666 * stake
+    if _has_run_len(row, 5, 4):  # 👹 x4
+        return 6 * stake
+
+    # 7⃣ серии
+    if _has_run_len(row, 4, 5):
+        return 5 * stake
+    if _has_run_len(row, 4, 4):
+        return 4 * stake
+
+    # стандарт 🍒🍀🍋 серии (любой из этих)
+    for sym in (1, 2, 3):
+        if _has_run_len(row, sym, 5):
+            return 2 * stake
+        if _has_run_len(row, sym, 4):
+            return 1 * stake
+        if _has_run_len(row, sym, 3):
+            return int(round(0.5 * stake))
+
+    return 0
+
+def _calc_delta_3x5_ref(grid: List[List[int]], stake_cents: int) -> int:
+    stake = int(stake_cents)
+    total = 0
+
+    for r in range(3):
+        total += _row5_rule(grid[r], stake)
+
+    for c in range(5):
+        col = [grid[r][c] for r in range(3)]
+        total += _line3_rule(col, stake)
+
+    for c0 in range(0, 3):
+        d = [grid[0][c0], grid[1][c0+1], grid[2][c0+2]]
+        if d[0] == d[1] == d[2]:
+            total += _line3_rule(d, stake)
+
+    for c0 in range(2, 5):
+        d = [grid[0][c0], grid[1][c0-1], grid[2][c0-2]]
+        if d[0] == d[1] == d[2]:
+            total += _line3_rule(d, stake)
+
+    return total
+
+def _debt_mult_from_skulls_ref(state, rfmt: str) -> int:
+    """
+    Возвращает множитель долга, если выпал "долговой черепной исход".
+    0 = долга нет.
+
+    Условия по твоему ТЗ:
+    - 3×3: любая линия 💀💀💀 (гор/верт/диаг) => долг 2×ставка (вайп + долг)
+    - 3×5: строка 💀×5 => долг 5×ставка (вайп + долг)
+           любая линия 💀💀💀 (вертикаль или диагональ длины 3) => долг 2×ставка (вайп + долг)
+    - 1×3: 💀💀💀 => долг 2×ставка (вайп + долг)
+    """
+    # state может быть list[int] (1x3) или list[list[int]] (3x3/3x5)
+    try:
+        if rfmt == "1x3":
+            codes = list(state)
+            return 2 if len(codes) == 3 and codes.count(0) == 3 else 0
+
+        if rfmt == "3x3":
+            g = state  # 3x3 grid
+            # rows
+            for r in range(3):
+                if g[r][0] == g[r][1] == g[r][2] == 0:
+                    return 2
+            # cols
+            for c in range(3):
+                if g[0][c] == g[1][c] == g[2][c] == 0:
+                    return 2
+            # diags
+            if g[0][0] == g[1][1] == g[2][2] == 0:
+                return 2
+            if g[0][2] == g[1][1] == g[2][0] == 0:
+                return 2
+            return 0
+
+        # 3x5
+        g = state
+        best = 0
+
+        # строка из 5 черепов => долг 5x
+        for r in range(3):
+            if all(x == 0 for x in g[r]):
+                best = max(best, 5)
+
+        # вертикаль длины 3 => долг 2x
+        for c in range(5):
+            if g[0][c] == g[1][c] == g[2][c] == 0:
+                best = max(best, 2)
+
+        # диагонали длины 3 (лево->право)
+        for c0 in range(0, 3):
+            if g[0][c0] == g[1][c0+1] == g[2][c0+2] == 0:
+                best = max(best, 2)
+
+        # диагонали длины 3 (право->лево)
+        for c0 in range(2, 5):
+            if g[0][c0] == g[1][c0-1] == g[2][c0-2] == 0:
+                best = max(best, 2)
+
+        return best
+    except Exception:
+        return 0
+
+# Таблицы выплат. Правила выше (_line3_rule, _row5_rule) остаются эталоном:
+# из них при импорте строятся таблицы множителей ставки по индексу линии в base-6
+# (216 для линий длины 3, 7776 для строк 3×5). Дробные множители (0.5 и -0.2)
+# хранятся как float и округляются так же, как в правилах.
+def _slot_idx(codes) -> int:
+    i = 0
+    for x in codes:
+        i = i * 6 + int(x)
+    return i
+
+def _slot_mult_table(rule, n: int) -> list:
+    out = []
+    for idx in range(6 ** n):
+        codes = [(idx // 6 ** k) % 6 for k in range(n - 1, -1, -1)]
+        v = rule(codes, 10)  # ставка 10: 0.5 и -0.2 дают целые 5 и -2
+        out.append(v // 10 if v % 10 == 0 else v / 10)
+    return out
+
+LINE3_MULT = _slot_mult_table(_line3_rule, 3)
+ROW5_MULT = _slot_mult_table(_row5_rule, 5)
+assert all(type(m) is int for m in LINE3_MULT)  # на этом держится сумма линий одним умножением
+
+def _mult_cents(m, stake: int) -> int:
+    return m * stake if type(m) is int else int(round(m * stake))
+
+# линии длины 3 как тройки клеток (r, c)
+_LINES_3x3 = (
+    [((r, 0), (r, 1), (r, 2)) for r in range(3)]
+    + [((0, c), (1, c), (2, c)) for c in range(3)]
+)
+_DIAGS_3x3 = [((0, 0), (1, 1), (2, 2)), ((0, 2), (1, 1), (2, 0))]
+_COLS_3x5 = [((0, c), (1, c), (2, c)) for c in range(5)]
+_DIAGS_3x5 = (
+    [((0, c0), (1, c0 + 1), (2, c0 + 2)) for c0 in range(0, 3)]
+    + [((0, c0), (1, c0 - 1), (2, c0 - 2)) for c0 in range(2, 5)]
+)
+
+def _line_idx(g, cells) -> int:
+    (r0, c0), (r1, c1), (r2, c2) = cells
+    return int(g[r0][c0]) * 36 + int(g[r1][c1]) * 6 + int(g[r2][c2])
+
+def _diag_idxs(g, diags) -> List[int]:
+    # диагональ засчитывается только если все три символа одинаковые
+    out = []
+    for cells in diags:
+        (r0, c0), (r1, c1), (r2, c2) = cells
+        if g[r0][c0] == g[r1][c1] == g[r2][c2]:
+            out.append(_line_idx(g, cells))
+    return out
+
+def calc_delta_1x3(codes: List[int], stake_cents: int) -> int:
+    return LINE3_MULT[_slot_idx(codes)] * int(stake_cents)
+
+def calc_line_delta_len3(codes: List[int], stake_cents: int) -> int:
+    return calc_delta_1x3(codes, stake_cents)
+
+def calc_row_delta_3x5(row: List[int], stake_cents: int) -> int:
+    return _mult_cents(ROW5_MULT[_slot_idx(row)], int(stake_cents))
+
+def calc_delta_3x3(grid: List[List[int]], stake_cents: int) -> int:
+    m = 0
+    for cells in _LINES_3x3:
+        m += LINE3_MULT[_line_idx(grid, cells)]
+    for idx in _diag_idxs(grid, _DIAGS_3x3):
+        m += LINE3_MULT[idx]
+    return m * int(stake_cents)
+
+def calc_delta_3x5(grid: List[List[int]], stake_cents: int) -> int:
+    stake = int(stake_cents)
+    total = 0
+    for r in range(3):
+        total += _mult_cents(ROW5_MULT[_slot_idx(grid[r])], stake)
+    m = 0
+    for cells in _COLS_3x5:
+        m += LINE3_MULT[_line_idx(grid, cells)]
+    for idx in _diag_idxs(grid, _DIAGS_3x5):
+        m += LINE3_MULT[idx]
+    return total + m * stake
+
+# 💀💀💀 — это индекс линии 0, 💀×5 — индекс строки 0
+def debt_mult_from_skulls(state, rfmt: str) -> int:
+    """Множитель долга за черепа (0 = долга нет). Правила — в _debt_mult_from_skulls_ref."""
+    try:
+        if rfmt == "1x3":
+            return 2 if len(state) == 3 and _slot_idx(state) == 0 else 0
+        if rfmt == "3x3":
+            if any(_line_idx(state, cells) == 0 for cells in _LINES_3x3 + _DIAGS_3x3):
+                return 2
+            return 0
+        if any(_slot_idx(state[r]) == 0 for r in range(3)):
+            return 5
+        if any(_line_idx(state, cells) == 0 for cells in _COLS_3x5 + _DIAGS_3x5):
+            return 2
+        return 0
+    except Exception:
+        return 0
+
+def pepper_triggers_demon(state, rfmt: str) -> bool:
+    """Триггер для 'Перца дьявола': 3💀 в 1×3/3×3 (по линии), 5💀 по строке в 3×5."""
+    try:
+        if rfmt == "1x3":
+            return isinstance(state, list) and len(state) == 3 and _slot_idx(state) == 0
+        if rfmt == "3x3":
+            if not state or len(state) != 3 or len(state[0]) != 3:
+                return False
+            return any(_line_idx(state, cells) == 0 for cells in _LINES_3x3 + _DIAGS_3x3)
+        if rfmt == "3x5":
+            if not state or len(state) != 3 or len(state[0]) != 5:
+                return False
+            return any(_slot_idx(state[r]) == 0 for r in range(3))
+    except Exception:
+        return False
+    return False
+
+def check_slot_tables(samples: int = 2000) -> List[str]:
+    """Сверка табличных оценщиков с эталонными правилами. Пустой список — всё совпало."""
+    bad: List[str] = []
+    stakes = (1, 3, 7, 10, 25, 100, 12345)
+    for n, rule, fast in ((3, _line3_rule, calc_delta_1x3), (5, _row5_rule, calc_row_delta_3x5)):
+        for idx in range(6 ** n):
+            codes = [(idx // 6 ** k) % 6 for k in range(n - 1, -1, -1)]
+            for st in stakes:
+                if fast(codes, st) != rule(codes, st):
+                    bad.append(f"{n}: {codes} x{st}")
+                    break
+            if n == 3:
+                for fn, ref in ((debt_mult_from_skulls, _debt_mult_from_skulls_ref),
+                                (pepper_triggers_demon, _pepper_triggers_demon_ref)):
+                    if fn(codes, "1x3") != ref(codes, "1x3"):
+                        bad.append(f"1x3 {fn.__name__}: {codes}")
+
+    rnd = random.Random(777)
+    for _ in range(samples):
+        st = rnd.choice(stakes)
+        for rfmt, cols, fast, ref in (
+            ("3x3", 3, calc_delta_3x3, _calc_delta_3x3_ref),
+            ("3x5", 5, calc_delta_3x5, _calc_delta_3x5_ref),
+        ):
+            # перекос в черепа, чтобы чаще ловить долговые и перечные исходы
+            g = [[rnd.choice((0, 0, 0, 1, 2, 3, 4, 5)) for _ in range(cols)] for __ in range(3)]
+            if fast(g, st) != ref(g, st):
+                bad.append(f"{rfmt} delta: {g} x{st}")
+            if debt_mult_from_skulls(g, rfmt) != _debt_mult_from_skulls_ref(g, rfmt):
+                bad.append(f"{rfmt} debt: {g}")
+            if pepper_triggers_demon(g, rfmt) != _pepper_triggers_demon_ref(g, rfmt):
+                bad.append(f"{rfmt} pepper: {g}")
+    return bad
+
+# СИМУЛЯТОР RTP (офлайн). Запуск без бота и без базы:
+#   python casino.bot.py sim --fmt 3x5 --items magnet,wine,devil_pepper --spins 10000000
+#   python casino.bot.py sim --all-combos --spins 1000000
+# С NumPy сетки тянутся пачками массивов; без него — обычный цикл на тех же таблицах.
+try:
+    import numpy as np  # type: ignore
+except Exception:
+    np = None
+
+SIM_ITEMS = ("magnet", "wine", "fake_clover", "devil_pepper", "insurance", "paket")
+SIM_SHAPES = {"1x3": (1, 3), "3x3": (3, 3), "3x5": (3, 5)}
+SIM_BATCH = 500_000
+
+def sim_weights(rfmt: str, items) -> List[Tuple[int, int]]:
+    base = R_WEIGHTS_1x3 if rfmt == "1x3" else (R_WEIGHTS_3x3 if rfmt == "3x3" else R_WEIGHTS_3x5)
+    return roulette_weights_apply(base, {k: 1 for k in items})
+
+def _sim_settle(delta: int, debt_mult: int, items, stake: int, balance: int) -> int:
+    """Расчёт хода как в run_spin (для обычного игрока: не демон, не на жизнь)."""
+    if "devil_pepper" in items:
+        delta *= 2
+    insured = ("insurance" in items) or ("paket" in items)
+    if insured and delta < 0:
+        delta = -delta if "paket" in items else 0
+    if not insured and debt_mult > 0:
+        delta = min(delta, 0, -debt_mult * stake - balance)
+    return delta
+
+def _sim_eval_state(rfmt: str, st, stake: int) -> Tuple[int, int, bool]:
+    if rfmt == "1x3":
+        return calc_delta_1x3(st, stake), debt_mult_from_skulls(st, rfmt), pepper_triggers_demon(st, rfmt)
+    if rfmt == "3x3":
+        return calc_delta_3x3(st, stake), debt_mult_from_skulls(st, rfmt), pepper_triggers_demon(st, rfmt)
+    return calc_delta_3x5(st, stake), debt_mult_from_skulls(st, rfmt), pepper_triggers_demon(st, rfmt)
+
+def _sim_py(rfmt: str, items, n: int, stake: int, balance: int, rnd: random.Random) -> Tuple[Dict[int, int], int, int]:
+    ww = sim_weights(rfmt, items)
+    codes = [c for c, _ in ww]
+    weights = [w for _, w in ww]
+    rows, cols = SIM_SHAPES[rfmt]
+    clover = "fake_clover" in items
+    hist: Dict[int, int] = {}
+    debts = 0
+    peppers = 0
+    for _ in range(n):
+        if rfmt == "1x3":
+            st = rnd.choices(codes, weights, k=3)
+        else:
+            st = [rnd.choices(codes, weights, k=cols) for __ in range(rows)]
+        if clover:
+            st = fake_clover_apply(rfmt, st, rnd)
+        delta, debt_mult, pep = _sim_eval_state(rfmt, st, stake)
+        debts += int(debt_mult > 0)
+        peppers += int(pep and "devil_pepper" in items)
+        d = _sim_settle(delta, debt_mult, items, stake, balance)
+        hist[d] = hist.get(d, 0) + 1
+    return hist, debts, peppers
+
+def _sim_np_batch(rfmt: str, items, n: int, stake: int, balance: int, rng):
+    # веса целые: клетка = lut[случайное 0..sum-1], то же распределение, что у weighted_pick
+    ww = sim_weights(rfmt, items)
+    lut = np.repeat(np.array([c for c, _ in ww], dtype=np.int32), [w for _, w in ww])
+    rows, cols = SIM_SHAPES[rfmt]
+    # раскладка (строка, столбец, спин): каждая клетка — непрерывный вектор по спинам
+    g = lut[rng.integers(0, len(lut), size=(rows, cols, n))]
+
+    if "fake_clover" in items:
+        ar = np.arange(n)
+        rr = rng.integers(0, rows, n)
+        cc = rng.integers(0, cols, n)
+        g[rr, cc, ar] = np.where(rng.random(n) < 0.5, 4, 0)
+
+    line3 = np.array(LINE3_MULT, dtype=np.int64)
+
+    def line_idx(cells):
+        (r0, c0), (r1, c1), (r2, c2) = cells
+        return g[r0, c0] * 36 + g[r1, c1] * 6 + g[r2, c2]
+
+    def diag_mult(cells):
+        (r0, c0), (r1, c1), (r2, c2) = cells
+        same = (g[r0, c0] == g[r1, c1]) & (g[r1, c1] == g[r2, c2])
+        idx = line_idx(cells)
+        return np.where(same, line3[idx], 0), same & (idx == 0)
+
+    if rfmt == "1x3":
+        idx = g[0, 0] * 36 + g[0, 1] * 6 + g[0, 2]
+        delta = line3[idx] * stake
+        skull_line = idx == 0
+        debt = np.where(skull_line, 2, 0)
+        pepper = skull_line
+    elif rfmt == "3x3":
+        m = np.zeros(n, dtype=np.int64)
+        skull_line = np.zeros(n, dtype=bool)
+        for cells in _LINES_3x3:
+            idx = line_idx(cells)
+            m += line3[idx]
+            skull_line |= idx == 0
+        for cells in _DIAGS_3x3:
+            dm, dz = diag_mult(cells)
+            m += dm
+            skull_line |= dz
+        delta = m * stake
+        debt = np.where(skull_line, 2, 0)
+        pepper = skull_line
+    else:
+        row5 = np.array(ROW5_MULT, dtype=np.float64)
+        ridx = g[:, 0]
+        for c in range(1, 5):
+            ridx = ridx * 6 + g[:, c]  # (3, n)
+        # np.round, как и round(), округляет половины к чётному
+        delta = np.round(row5[ridx] * stake).astype(np.int64).sum(axis=0)
+        m = np.zeros(n, dtype=np.int64)
+        skull_line = np.zeros(n, dtype=bool)
+        for cells in _COLS_3x5:
+            idx = line_idx(cells)
+            m += line3[idx]
+            skull_line |= idx == 0
+        for cells in _DIAGS_3x5:
+            dm, dz = diag_mult(cells)
+            m += dm
+            skull_line |= dz
+        delta = delta + m * stake
+        skull_row = (ridx == 0).any(axis=0)
+        debt = np.where(skull_row, 5, np.where(skull_line, 2, 0))
+        pepper = skull_row
+
+    if "devil_pepper" in items:
+        delta = delta * 2
+    insured = ("insurance" in items) or ("paket" in items)
+    if insured:
+        delta = np.where(delta < 0, -delta if "paket" in items else 0, delta)
+    else:
+        capped = np.minimum(np.minimum(delta, 0), -debt * stake - balance)
+        delta = np.where(debt > 0, capped, delta)
+
+    vals, cnts = np.unique(delta, return_counts=True)
+    hist = {int(v): int(c) for v, c in zip(vals, cnts)}
+    peppers = int(pepper.sum()) if "devil_pepper" in items else 0
+    return hist, int((debt > 0).sum()), peppers
+
+def simulate_rtp(rfmt: str, items=(), spins: int = 1_000_000, stake: int = 100,
+                 balance_stakes: int = 10, seed: Optional[int] = None, use_numpy: bool = True) -> Dict[str, float]:
+    """
+    Монте-Карло одного формата с набором предметов.
+    stake — ставка в центах, balance_stakes — баланс игрока в ставках (влияет на черепной долг).
+    """
+    items = tuple(sorted(set(items)))
+    balance = int(balance_stakes) * int(stake)
+    hist: Dict[int, int] = {}
+    debts = peppers = 0
+    left = int(spins)
+    if use_numpy and np is not None:
+        rng = np.random.default_rng(seed)
+        while left > 0:
+            k = min(left, SIM_BATCH)
+            h, d, pp = _sim_np_batch(rfmt, items, k, stake, balance, rng)
+            for v, c in h.items():
+                hist[v] = hist.get(v, 0) + c
+            debts += d
+            peppers += pp
+            left -= k
+    else:
+        hist, debts, peppers = _sim_py(rfmt, items, left, stake, balance, random.Random(seed))
+    return sim_summary(hist, spins, stake, debts, peppers)
+
+def sim_summary(hist: Dict[int, int], n: int, stake: int, debts: int = 0, peppers: int = 0) -> Dict[str, float]:
+    n = max(1, int(n))
+    mean = sum(v * c for v, c in hist.items()) / n
+    var = sum(((v - mean) ** 2) * c for v, c in hist.items()) / n
+
+    def quantile(q: float) -> float:
+        acc = 0
+        for v in sorted(hist):
+            acc += hist[v]
+            if acc >= q * n:
+                return v / stake
+        return max(hist) / stake if hist else 0.0
+
+    return {
+        "spins": n,
+        "rtp": 1.0 + mean / stake,
+        "ev": mean / stake,
+        "var": var / (stake * stake),
+        "std": (var ** 0.5) / stake,
+        "hit": sum(c for v, c in hist.items() if v > 0) / n,
+        "loss": sum(c for v, c in hist.items() if v < 0) / n,
+        "p01": quantile(0.01),
+        "p001": quantile(0.001),
+        "min": (min(hist) / stake) if hist else 0.0,
+        "max": (max(hist) / stake) if hist else 0.0,
+        "debt": debts / n,
+        "pepper": peppers / n,
+    }
+
+def sim_item_combos() -> List[Tuple[str, ...]]:
+    """Все сочетания предметов; страховка и пакет не складываются (пакет приоритетнее)."""
+    base = ("magnet", "wine", "fake_clover", "devil_pepper")
+    out: List[Tuple[str, ...]] = []
+    for mask in range(1 << len(base)):
+        picked = tuple(b for i, b in enumerate(base) if mask & (1 << i))
+        for guard in ((), ("insurance",), ("paket",)):
+            out.append(picked + guard)
+    return out
+
+def _sim_parse_items(s: str) -> Tuple[str, ...]:
+    items = tuple(x.strip() for x in (s or "").split(",") if x.strip())
+    for x in items:
+        if x not in SIM_ITEMS:
+            raise SystemExit(f"unknown item: {x} (known: {', '.join(SIM_ITEMS)})")
+    return items
+
+def sim_main(argv: List[str]) -> int:
+    import argparse
+    ap = argparse.ArgumentParser(prog="casino.bot.py sim", description="Монте-Карло RTP рулетки")
+    ap.add_argument("--fmt", default="all", help="1x3|3x3|3x5|all")
+    ap.add_argument("--items", action="append", default=None,
+                    help="предметы через запятую; можно повторять (" + ",".join(SIM_ITEMS) + ")")
+    ap.add_argument("--all-combos", action="store_true", help="перебрать все сочетания предметов")
+    ap.add_argument("--spins", type=int, default=1_000_000)
+    ap.add_argument("--stake", type=int, default=100, help="ставка в центах")
+    ap.add_argument("--balance", type=int, default=10, help="баланс игрока в ставках (для долга)")
+    ap.add_argument("--seed", type=int, default=None)
+    ap.add_argument("--pure", action="store_true", help="без NumPy")
+    a = ap.parse_args(argv)
+
+    fmts = list(SIM_SHAPES) if a.fmt == "all" else [a.fmt]
+    for f in fmts:
+        if f not in SIM_SHAPES:
+            raise SystemExit(f"unknown format: {f}")
+    if a.all_combos:
+        combos = sim_item_combos()
+    else:
+        combos = [_sim_parse_items(x) for x in (a.items or [""])]
+
+    engine = "numpy" if (np is not None and not a.pure) else "python"
+    print(f"engine={engine} spins={a.spins} stake={a.stake} balance={a.balance}x")
+    print(f"{'fmt':4} {'items':44} {'RTP':>8} {'EV':>8} {'std':>7} {'hit':>6} {'loss':>6} "
+          f"{'p1%':>7} {'p0.1%':>7} {'debt':>6} {'pepper':>6} {'sec':>6}")
+    for f in fmts:
+        for items in combos:
+            t0 = time.time()
+            r = simulate_rtp(f, items, a.spins, a.stake, a.balance, a.seed, use_numpy=not a.pure)
+            print(
+                f"{f:4} {(','.join(items) or '-'):44} {r['rtp'] * 100:7.2f}% {r['ev']:+8.4f} {r['std']:7.3f} "
+                f"{r['hit'] * 100:5.1f}% {r['loss'] * 100:5.1f}% {r['p01']:+7.2f} {r['p001']:+7.2f} "
+                f"{r['debt'] * 100:5.2f}% {r['pepper'] * 100:5.2f}% {time.time() - t0:6.1f}"
+            )
+    return 0
+
+# ТОЧНЫЙ EV для 1×3 и 3×3: полный перебор исходов с целыми весами (без сэмплирования).
+#   python casino.bot.py ev [--fmt 1x3|3x3|all] [--items a,b ...] [--all-combos] [--balance K] [--dist]
+# Сетка 3×3 = три строки из 216 вариантов; вклад строк, столбцов и диагоналей берётся
+# из LINE3_MULT, перебор идёт по парам (верх, низ) с векторами по средней строке.
+# Фальшивый клевер (1 из 9 клеток -> 7⃣ или 💀 50/50) считается в том же проходе:
+# вес сетки под клевером = Σ_k [g_k ∈ {0,4}] * Π_{j≠k} w(g_j), знаменатель 2 * клеток * W^(клеток-1).
+# Результат (совместное распределение множителя и "черепной линии") кэшируется на диске
+# по хэшу весов и таблицы выплат.
+EV_CACHE_DIR = os.environ.get(
+    "EV_CACHE_DIR", os.path.join(os.path.abspath(os.path.dirname(__file__)), "data", "ev_cache")
+)
+EV_CACHE_VERSION = 1
+EV_FORMATS = ("1x3", "3x3")
+
+def _ev_cache_key(rfmt: str, weights) -> str:
+    payload = json.dumps(
+        {"v": EV_CACHE_VERSION, "fmt": rfmt, "w": [list(x) for x in weights], "line3": LINE3_MULT},
+        sort_keys=True, separators=(",", ":"),
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:24]
+
+def _ev_rows(weights) -> Tuple[list, list, list, list, list]:
+    """Для каждой из 216 строк: клетки, множитель, вес A = Πw, клеверный вес B, флаг 💀💀💀."""
+    w = {int(c): int(x) for c, x in weights}
+    cells, mult, wa, wb, skull = [], [], [], [], []
+    for idx in range(216):
+        t = (idx // 36, (idx // 6) % 6, idx % 6)
+        a = w[t[0]] * w[t[1]] * w[t[2]]
+        b = 0
+        for k in range(3):
+            if t[k] in (0, 4):
+                b += a // w[t[k]]
+        cells.append(t)
+        mult.append(LINE3_MULT[idx])
+        wa.append(a)
+        wb.append(b)
+        skull.append(idx == 0)
+    return cells, mult, wa, wb, skull
+
+def _ev_enum_1x3(weights) -> Dict[str, dict]:
+    cells, mult, wa, wb, skull = _ev_rows(weights)
+    plain: Dict[Tuple[int, int], int] = {}
+    clover: Dict[Tuple[int, int], int] = {}
+    for i in range(216):
+        key = (mult[i], int(skull[i]))
+        plain[key] = plain.get(key, 0) + wa[i]
+        if wb[i]:
+            clover[key] = clover.get(key, 0) + wb[i]
+    total = sum(int(x) for _, x in weights)
+    return {
+        "plain": {"den": total ** 3, "dist": plain},
+        "clover": {"den": 2 * 3 * total ** 2, "dist": clover},
+    }
+
+def _ev_enum_3x3(weights, use_numpy: bool = True) -> Dict[str, dict]:
+    cells, mult, wa, wb, skull = _ev_rows(weights)
+    total = sum(int(x) for _, x in weights)
+    plain: Dict[Tuple[int, int], int] = {}
+    clover: Dict[Tuple[int, int], int] = {}
+
+    if use_numpy and np is not None:
+        line3 = np.array(LINE3_MULT, dtype=np.int64)
+        C = np.array(cells, dtype=np.int64)       # (216, 3)
+        M = np.array(mult, dtype=np.int64)
+        A = np.array(wa, dtype=np.int64)
+        B = np.array(wb, dtype=np.int64)
+        Z = np.array(skull, dtype=bool)
+        off = 64  # множитель 3×3 лежит в [-40, 40]
+        acc_p = np.zeros(2 * 2 * off + 2, dtype=np.float64)
+        acc_c = np.zeros_like(acc_p)
+        r1 = C[:, None, :]   # средняя строка, ось 0
+        r2 = C[None, :, :]   # нижняя строка, ось 1
+        for i0 in range(216):
+            r0 = C[i0]
+            m = M[i0] + M[:, None] + M[None, :]
+            z = Z[i0] | Z[:, None] | Z[None, :]
+            for c in range(3):
+                ci = r0[c] * 36 + r1[..., c] * 6 + r2[..., c]
+                m = m + line3[ci]
+                z = z | (ci == 0)
+            for a0, b2 in ((0, 2), (2, 0)):
+                same = (r0[a0] == r1[..., 1]) & (r1[..., 1] == r2[..., b2])
+                di = r0[a0] * 36 + r1[..., 1] * 6 + r2[..., b2]
+                m = m + np.where(same, line3[di], 0)
+                z = z | (same & (di == 0))
+            key = ((m + off) * 2 + z).ravel()
+            wp = (A[i0] * A[:, None] * A[None, :]).ravel()
+            wc = (B[i0] * A[:, None] * A[None, :] + A[i0] * B[:, None] * A[None, :]
+                  + A[i0] * A[:, None] * B[None, :]).ravel()
+            # суммы целые и < 2^53, поэтому float64 здесь точен
+            acc_p += np.bincount(key, weights=wp, minlength=len(acc_p))
+            acc_c += np.bincount(key, weights=wc, minlength=len(acc_c))
+        for k in range(len(acc_p)):
+            key = (k // 2 - off, k % 2)
+            if acc_p[k]:
+                plain[key] = int(acc_p[k])
+            if acc_c[k]:
+                clover[key] = int(acc_c[k])
+    else:
+        for i0 in range(216):
+            r0 = cells[i0]
+            for i2 in range(216):
+                r2 = cells[i2]
+                base_m = mult[i0] + mult[i2]
+                base_z = skull[i0] or skull[i2]
+                # вклад столбца c при значении v в средней строке
+                col_m = [[LINE3_MULT[r0[c] * 36 + v * 6 + r2[c]] for v in range(6)] for c in range(3)]
+                col_z = [[(r0[c] * 36 + v * 6 + r2[c]) == 0 for v in range(6)] for c in range(3)]
+                dm = [0] * 6
+                dz = [False] * 6
+                for v in range(6):
+                    for a0, b2 in ((0, 2), (2, 0)):
+                        if r0[a0] == v == r2[b2]:
+                            di = r0[a0] * 36 + v * 6 + r2[b2]
+                            dm[v] += LINE3_MULT[di]
+                            dz[v] = dz[v] or di == 0
+                a02 = wa[i0] * wa[i2]
+                b02 = wb[i0] * wa[i2] + wa[i0] * wb[i2]
+                for i1 in range(216):
+                    v0, v1, v2 = cells[i1]
+                    m = base_m + mult[i1] + col_m[0][v0] + col_m[1][v1] + col_m[2][v2] + dm[v1]
+                    z = int(base_z or skull[i1] or col_z[0][v0] or col_z[1][v1] or col_z[2][v2] or dz[v1])
+                    key = (m, z)
+                    plain[key] = plain.get(key, 0) + a02 * wa[i1]
+                    wc = b02 * wa[i1] + a02 * wb[i1]
+                    if wc:
+                        clover[key] = clover.get(key, 0) + wc
+
+    return {
+        "plain": {"den": total ** 9, "dist": plain},
+        "clover": {"den": 2 * 9 * total ** 8, "dist": clover},
+    }
+
+def ev_distribution(rfmt: str, weights, use_cache: bool = True, use_numpy: bool = True) -> Dict[str, dict]:
+    """Совместное распределение (множитель ставки, 💀-линия) -> числитель; с дисковым кэшем."""
+    path = os.path.join(EV_CACHE_DIR, f"{rfmt}_{_ev_cache_key(rfmt, weights)}.json")
+    if use_cache and os.path.exists(path):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                raw = json.load(f)
+            return {
+                mode: {"den": int(d["den"]), "dist": {tuple(map(int, k.split(","))): int(v) for k, v in d["dist"].items()}}
+                for mode, d in raw.items()
+            }
+        except Exception:
+            pass
+
+    res = _ev_enum_1x3(weights) if rfmt == "1x3" else _ev_enum_3x3(weights, use_numpy=use_numpy)
+
+    if use_cache:
+        try:
+            os.makedirs(EV_CACHE_DIR, exist_ok=True)
+            tmp = path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({
+                    mode: {"den": d["den"], "dist": {f"{k[0]},{k[1]}": v for k, v in d["dist"].items()}}
+                    for mode, d in res.items()
+                }, f)
+            os.replace(tmp, path)
+        except Exception:
+            pass
+    return res
+
+def ev_exact(rfmt: str, items=(), balance_stakes: int = 10, use_cache: bool = True,
+             use_numpy: bool = True) -> Dict[str, object]:
+    """
+    Точный итог хода в ставках: распределение {дельта: Fraction}, EV, RTP, дисперсия и т.п.
+    Расчёт хода — как _sim_settle (перец, страховка/пакет, черепной долг).
+    """
+    items = tuple(sorted(set(items)))
+    d = ev_distribution(rfmt, sim_weights(rfmt, items), use_cache=use_cache, use_numpy=use_numpy)
+    part = d["clover" if "fake_clover" in items else "plain"]
+    den = part["den"]
+    out: Dict[Fraction, int] = {}
+    pepper_num = 0
+    debt_num = 0
+    for (m, z), num in part["dist"].items():
+        debt_mult = 2 if z else 0
+        debt_num += num if z else 0
+        pepper_num += num if (z and "devil_pepper" in items) else 0
+        delta = _sim_settle(int(m), debt_mult, items, 1, int(balance_stakes))
+        out[delta] = out.get(delta, 0) + num
+    dist = {Fraction(k): Fraction(v, den) for k, v in sorted(out.items())}
+    ev = sum(k * p for k, p in dist.items())
+    var = sum((k - ev) ** 2 * p for k, p in dist.items())
+    return {
+        "dist": dist,
+        "ev": ev,
+        "rtp": 1 + ev,
+        "var": var,
+        "hit": sum(p for k, p in dist.items() if k > 0),
+        "loss": sum(p for k, p in dist.items() if k < 0),
+        "debt": Fraction(debt_num, den),
+        "pepper": Fraction(pepper_num, den),
+    }
+
+def ev_main(argv: List[str]) -> int:
+    import argparse
+    ap = argparse.ArgumentParser(prog="casino.bot.py ev", description="Точный EV рулетки 1×3 / 3×3")
+    ap.add_argument("--fmt", default="all", help="1x3|3x3|all")
+    ap.add_argument("--items", action="append", default=None,
+                    help="предметы через запятую; можно повторять (" + ",".join(SIM_ITEMS) + ")")
+    ap.add_argument("--all-combos", action="store_true", help="перебрать все сочетания предметов")
+    ap.add_argument("--balance", type=int, default=10, help="баланс игрока в ставках (для долга)")
+    ap.add_argument("--dist", action="store_true", help="печатать распределение дельты")
+    ap.add_argument("--no-cache", action="store_true")
+    ap.add_argument("--pure", action="store_true", help="без NumPy")
+    a = ap.parse_args(argv)
+
+    fmts = list(EV_FORMATS) if a.fmt == "all" else [a.fmt]
+    for f in fmts:
+        if f not in EV_FORMATS:
+            raise SystemExit(f"exact EV is available for: {', '.join(EV_FORMATS)}")
+    combos = sim_item_combos() if a.all_combos else [_sim_parse_items(x) for x in (a.items or [""])]
+
+    print(f"cache={EV_CACHE_DIR if not a.no_cache else '-'} balance={a.balance}x")
+    print(f"{'fmt':4} {'items':44} {'RTP':>10} {'EV':>10} {'std':>8} {'hit':>7} {'loss':>7} {'debt':>7} {'pepper':>7} {'sec':>6}")
+    for f in fmts:
+        for items in combos:
+            t0 = time.time()
+            r = ev_exact(f, items, a.balance, use_cache=not a.no_cache, use_numpy=not a.pure)
+            print(
+                f"{f:4} {(','.join(items) or '-'):44} {float(r['rtp']) * 100:9.4f}% {float(r['ev']):+10.6f} "
+                f"{float(r['var']) ** 0.5:8.4f} {float(r['hit']) * 100:6.2f}% {float(r['loss']) * 100:6.2f}% "
+                f"{float(r['debt']) * 100:6.3f}% {float(r['pepper']) * 100:6.3f}% {time.time() - t0:6.1f}"
+            )
+            if a.dist:
+                for k, p in r["dist"].items():
+                    print(f"      {float(k):+8.2f}  {float(p) * 100:10.6f}%")
+    return 0
+
+# ZERO-ROULETTE: цвета, последовательности и подсчёт выигрыша. Чистые функции —
+# ими пользуются и бот, и симулятор zsim.
+ZERO_RED = { # Цвета чисел
+    1,3,5,7,9,12,14,16,18,19,21,23,25,27,30,32,34,36
+}
+
+def zero_color(num: int) -> str:
+    """R/B/W (W = зеро)."""
+    num = int(num)
+    if num == 0:
+        return "W"
+    return "R" if num in ZERO_RED else "B"
+
+def zero_code_is_num(code: str) -> bool:
+    return bool(code) and (code == "Z" or code.startswith("N"))
+
+def zero_code_to_num(code: str) -> int:
+    if code == "Z":
+        return 0
+    return int(code[1:])
+
+ZERO_SEQ_TIER = [33,16,24,5,10,23,8,30,11,36,13,27]
+ZERO_SEQ_ORPHELINS = [9,31,14,20,1,6,34,17]
+ZERO_SEQ_VOISINS = [22,18,29,7,28,19,4,21,2,25]
+ZERO_SEQ_ZERO_SPIEL = [12,35,3,26,0,32,15]
+
+def zero_seq_match(nums: list, seq: list) -> bool:
+    """nums == contiguous subseq of seq OR reverse(seq)."""
+    n = len(nums)
+    if n <= 0:
+        return False
+    for base in (seq, list(reversed(seq))):
+        for i in range(0, len(base) - n + 1):
+            if base[i:i+n] == nums:
+                return True
+    return False
+
+def zero_compute_combo(picks: list, gen_nums: list) -> Tuple[str, int]:
+    slots = []
+    for code in picks[:5]:
+        if zero_code_is_num(code):
+            n = zero_code_to_num(code)
+            slots.append(n if n in gen_nums else None)
+        else:
+            slots.append(None)
+
+    best = ("", 1)
+
+    def consider(name: str, mult: int):
+        nonlocal best
+        mult = int(mult)
+        if mult > best[1]:
+            best = (name, mult)
+
+    i = 0
+    while i < len(slots):
+        if slots[i] is None:
+            i += 1
+            continue
+        j = i
+        seg = []
+        while j < len(slots) and slots[j] is not None:
+            seg.append(int(slots[j]))
+            j += 1
+
+        L = len(seg)
+
+        if L >= 3:
+            ok = True
+            for k in range(1, L):
+                if abs(seg[k] - seg[k-1]) != 1:
+                    ok = False
+                    break
+            if ok:
+                consider("Strit", 2 if L == 3 else (3 if L == 4 else 5))
+
+            ok = True
+            if any(x == 0 for x in seg):
+                ok = False
+            else:
+                c0 = zero_color(seg[0])
+                for k in range(1, L):
+                    if abs(seg[k] - seg[k-1]) != 2 or zero_color(seg[k]) != c0:
+                        ok = False
+                        break
+            if ok:
+                consider("Flash", 2 if L == 3 else (3 if L == 4 else 5))
+
+        if L >= 4:
+            if zero_seq_match(seg, ZERO_SEQ_TIER):
+                consider("Tier", 2 if L == 4 else 3)
+            if zero_seq_match(seg, ZERO_SEQ_ORPHELINS):
+                consider("Orphelins", 2 if L == 4 else 3)
+            if zero_seq_match(seg, ZERO_SEQ_VOISINS):
+                consider("Voisins Du Zero", 2 if L == 4 else 3)
+            if zero_seq_match(seg, ZERO_SEQ_ZERO_SPIEL):
+                if seg and seg[0] == 0:
+                    consider("Zero Spiel", 3 if L == 4 else 5)
+                else:
+                    consider("Zero Spiel", 2 if L == 4 else 3)
+
+        i = j
+
+    return best[0], best[1]
+
+def zero_compute_delta(picks: list, gen_nums: list, stake_cents: int) -> Tuple[int, str, int]:
+    stake_cents = int(stake_cents or 0)
+
+    nums_only = [zero_code_to_num(c) for c in picks if zero_code_is_num(c)]
+    special_zero = (len(nums_only) > 0 and set(nums_only) == {0})
+
+    if special_zero:
+        if 0 in gen_nums:
+            return stake_cents * 10, "", 1
+        return -stake_cents * 5, "", 1
+
+    delta = 0
+    even_cnt = sum(1 for n in gen_nums if n != 0 and (n % 2 == 0))
+    odd_cnt = sum(1 for n in gen_nums if n != 0 and (n % 2 == 1))
+    red_cnt = sum(1 for n in gen_nums if zero_color(n) == "R")
+    black_cnt = sum(1 for n in gen_nums if zero_color(n) == "B")
+
+    for code in picks[:5]:
+        if zero_code_is_num(code):
+            n = zero_code_to_num(code)
+            delta += (stake_cents if n in gen_nums else -stake_cents)
+            continue
+
+        if code in ("E", "O") and even_cnt != odd_cnt:
+            if code == "E":
+                if even_cnt > odd_cnt:
+                    delta += (stake_cents * even_cnt + 1) // 2
+                else:
+                    delta -= (stake_cents * odd_cnt * 3 + 1) // 2
+            else:
+                if odd_cnt > even_cnt:
+                    delta += (stake_cents * odd_cnt + 1) // 2
+                else:
+                    delta -= (stake_cents * even_cnt * 3 + 1) // 2
+            continue
+
+        if code in ("R", "B") and red_cnt != black_cnt:
+            if code == "R":
+                if red_cnt > black_cnt:
+                    delta += (stake_cents * red_cnt + 1) // 2
+                else:
+                    delta -= (stake_cents * black_cnt * 3 + 1) // 2
+            else:
+                if black_cnt > red_cnt:
+                    delta += (stake_cents * black_cnt + 1) // 2
+                else:
+                    delta -= (stake_cents * red_cnt * 3 + 1) // 2
+            continue
+
+    combo_name, mult = zero_compute_combo(picks, gen_nums)
+    if mult > 1:
+        delta = int(delta) * int(mult)
+
+    return int(delta), combo_name, int(mult)
+
+ZERO_LUCKY_PROC_PCT = 25        # шанс срабатывания удачной фишки
+ZERO_COLOR_BONUS_PCT = 5        # +% к весам (за каждую активную фишку)
+
+def _weighted_sample_unique(pool: list, weight_fn, k: int, rnd=random) -> list:
+    pool = list(pool)
+    # веса считаются один раз и выбывают вместе с числом
+    weights = []
+    for x in pool:
+        try:
+            w = float(weight_fn(x))
+        except Exception:
+            w = 0.0
+        if w <= 0:
+            w = 0.0
+        weights.append(w)
+    out = []
+    for _ in range(int(k)):
+        if not pool:
+            break
+        total = sum(weights)
+        if total <= 0:
+            idx = rnd.randrange(len(pool))
+        else:
+            r = rnd.random() * total
+            s = 0.0
+            idx = 0
+            for i, w in enumerate(weights):
+                s += w
+                if r <= s:
+                    idx = i
+                    break
+        weights.pop(idx)
+        out.append(pool.pop(idx))
+    return out
+
+def _zero_picks_nums(picks: list) -> list:
+    nums = []
+    for code in (picks or []):
+        if zero_code_is_num(code):
+            try:
+                nums.append(int(zero_code_to_num(code)))
+            except Exception:
+                pass
+    return nums
+
+# Веса чисел 0..36 при red/black зеро-фишках. Таблица на каждую пару счётчиков
+# строится один раз: генерация и симулятор берут готовый список.
+_ZERO_WEIGHTS_CACHE: Dict[Tuple[int, int, int], List[float]] = {}
+
+def zero_weights(red_cnt: int, black_cnt: int, color_pct: Optional[int] = None) -> List[float]:
+    pct = ZERO_COLOR_BONUS_PCT if color_pct is None else int(color_pct)
+    key = (max(0, int(red_cnt)), max(0, int(black_cnt)), pct)
+    ww = _ZERO_WEIGHTS_CACHE.get(key)
+    if ww is None:
+        red_mul = 1.0 + (pct / 100.0) * key[0]
+        black_mul = 1.0 + (pct / 100.0) * key[1]
+        ww = [1.0] + [red_mul if zero_color(n) == "R" else black_mul for n in range(1, 37)]
+        _ZERO_WEIGHTS_CACHE[key] = ww
+    return ww
+
+def zero_lucky_apply(gen: list, nums: list, rnd=random) -> list:
+    """Удачная фишка: добиваем минимум 2 попадания по числам игрока (gen меняется на месте)."""
+    gen_set = set(gen)
+    hits = sum(1 for n in nums if n in gen_set)
+    if hits >= 2:
+        return gen
+    from collections import Counter
+    cnt = Counter(nums)
+
+    cand = [n for n in cnt.keys() if n not in gen_set]
+    cand.sort(key=lambda n: cnt[n], reverse=True)
+
+    to_put = []
+    for n in cand:
+        if hits >= 2:
+            break
+        to_put.append(int(n))
+        hits += int(cnt[n])
+
+    for n in to_put:
+        if n in gen_set:
+            continue
+        idx = rnd.randrange(len(gen))
+        for _ in range(10):
+            if gen[idx] != n and gen[idx] not in to_put:
+                break
+            idx = rnd.randrange(len(gen))
+        gen_set.discard(gen[idx])
+        gen[idx] = int(n)
+        gen_set.add(int(n))
+    return gen
+
+# СИМУЛЯТОР ZERO-РУЛЕТКИ (офлайн): один набор ставок против миллионов генераций.
+#   python casino.bot.py zsim --picks N1,N2,N3,R,E --red 2 --spins 5000000
+#   python casino.bot.py zsim --picks N7,N28,N12,N35,N3 --lucky --lucky-pct 15,25,35 --color-pct 0,5,10
+# Комбо зависит только от того, какие из 5 слотов сыграли, поэтому оно считается
+# эталонной zero_compute_combo один раз на каждую из 32 масок попаданий.
+ZSIM_BATCH = 200_000
+_ZERO_EVEN = [n for n in range(1, 37) if n % 2 == 0]
+_ZERO_ODD = [n for n in range(1, 37) if n % 2 == 1]
+_ZERO_BLACK = [n for n in range(1, 37) if n not in ZERO_RED]
+
+def _zsim_combo_table(picks: list) -> Tuple[List[int], List[int], List[str]]:
+    """По маске попаданий слотов: множитель комбо, сумма по числам (в ставках), имя комбо."""
+    picks = list(picks[:5])
+    mults, nums_delta, names = [], [], []
+    for mask in range(1 << len(picks)):
+        gen = []
+        nd = 0
+        for i, code in enumerate(picks):
+            if not zero_code_is_num(code):
+                continue
+            n = zero_code_to_num(code)
+            if mask & (1 << i):
+                gen.append(n)
+                nd += 1
+            else:
+                nd -= 1
+        name, mult = zero_compute_combo(picks, gen)
+        mults.append(int(mult))
+        nums_delta.append(nd)
+        names.append(name)
+    return mults, nums_delta, names
+
+def _zsim_py(picks: list, n: int, stake: int, ww: List[float], lucky_pct: int,
+             rnd: random.Random) -> Tuple[Dict[int, int], Dict[str, int]]:
+    nums = _zero_picks_nums(picks)
+    pool = list(range(0, 37))
+    hist: Dict[int, int] = {}
+    combos: Dict[str, int] = {}
+    for _ in range(n):
+        gen = _weighted_sample_unique(pool, ww.__getitem__, 5, rnd)
+        if nums and lucky_pct > 0 and rnd.randint(1, 100) <= lucky_pct:
+            zero_lucky_apply(gen, nums, rnd)
+        d, name, _mult = zero_compute_delta(picks, gen, stake)
+        hist[d] = hist.get(d, 0) + 1
+        if name:
+            combos[name] = combos.get(name, 0) + 1
+    return hist, combos
+
+def _zsim_side_delta(win_cnt, lose_cnt, stake: int):
+    # E/O/R/B: как в zero_compute_delta, округление (x + 1) // 2
+    win = (stake * win_cnt + 1) // 2
+    lose = -((stake * lose_cnt * 3 + 1) // 2)
+    return np.where(win_cnt > lose_cnt, win, np.where(win_cnt < lose_cnt, lose, 0))
+
+def _zsim_np_batch(picks: list, n: int, stake: int, ww: List[float], lucky_pct: int,
+                   rng, table) -> Tuple[Dict[int, int], Dict[str, int]]:
+    w = np.array(ww, dtype=np.float64)
+    # выборка без возвращения по весам = 5 наименьших ключей Exp(1)/w
+    # (то же распределение, что и последовательные извлечения в _weighted_sample_unique)
+    keys = rng.exponential(size=(n, 37)) / w
+    kth = np.partition(keys, 4, axis=1)[:, 4:5]
+    hit = keys <= kth
+
+    nums = _zero_picks_nums(picks)
+    if nums and lucky_pct > 0:
+        lucky = np.flatnonzero(rng.random(n) < lucky_pct / 100.0)
+        if lucky.size:
+            nums_arr = np.array(nums, dtype=np.int64)
+            need = lucky[hit[lucky][:, nums_arr].sum(axis=1) < 2]
+            rnd = random.Random(int(rng.integers(1 << 62)))
+            for r in need:
+                gen = np.flatnonzero(hit[r]).tolist()
+                zero_lucky_apply(gen, nums, rnd)
+                hit[r] = False
+                hit[r, gen] = True
+
+    picks = list(picks[:5])
+    if nums and set(nums) == {0}:
+        delta = np.where(hit[:, 0], stake * 10, -stake * 5).astype(np.int64)
+        vals, cnts = np.unique(delta, return_counts=True)
+        return {int(v): int(c) for v, c in zip(vals, cnts)}, {}
+
+    mults, nums_delta, names = table
+    mask = np.zeros(n, dtype=np.int64)
+    for i, code in enumerate(picks):
+        if zero_code_is_num(code):
+            mask |= hit[:, zero_code_to_num(code)].astype(np.int64) << i
+
+    delta = np.array(nums_delta, dtype=np.int64)[mask] * stake
+    even_cnt = hit[:, _ZERO_EVEN].sum(axis=1)
+    odd_cnt = hit[:, _ZERO_ODD].sum(axis=1)
+    red_cnt = hit[:, sorted(ZERO_RED)].sum(axis=1)
+    black_cnt = hit[:, _ZERO_BLACK].sum(axis=1)
+    for code in picks:
+        if code == "E":
+            delta += _zsim_side_delta(even_cnt, odd_cnt, stake)
+        elif code == "O":
+            delta += _zsim_side_delta(odd_cnt, even_cnt, stake)
+        elif code == "R":
+            delta += _zsim_side_delta(red_cnt, black_cnt, stake)
+        elif code == "B":
+            delta += _zsim_side_delta(black_cnt, red_cnt, stake)
+    delta *= np.array(mults, dtype=np.int64)[mask]
+
+    vals, cnts = np.unique(delta, return_counts=True)
+    hist = {int(v): int(c) for v, c in zip(vals, cnts)}
+    combos: Dict[str, int] = {}
+    for m, c in zip(*np.unique(mask, return_counts=True)):
+        name = names[int(m)]
+        if name:
+            combos[name] = combos.get(name, 0) + int(c)
+    return hist, combos
+
+def simulate_zero(picks, red_cnt: int = 0, black_cnt: int = 0, lucky: bool = False,
+                  spins: int = 1_000_000, stake: int = 100, color_pct: Optional[int] = None,
+                  lucky_pct: Optional[int] = None, seed: Optional[int] = None,
+                  use_numpy: bool = True) -> Dict[str, object]:
+    """
+    Монте-Карло zero-рулетки для одного набора ставок игрока.
+    red_cnt/black_cnt — сумма активных фишек всех игроков, lucky — у игрока удачная фишка.
+    """
+    picks = [str(c).strip().upper() for c in picks][:5]
+    ww = zero_weights(red_cnt, black_cnt, color_pct)
+    lp = (ZERO_LUCKY_PROC_PCT if lucky_pct is None else int(lucky_pct)) if lucky else 0
+    hist: Dict[int, int] = {}
+    combos: Dict[str, int] = {}
+    left = int(spins)
+    if use_numpy and np is not None:
+        rng = np.random.default_rng(seed)
+        table = _zsim_combo_table(picks)
+        while left > 0:
+            k = min(left, ZSIM_BATCH)
+            h, cc = _zsim_np_batch(picks, k, stake, ww, lp, rng, table)
+            for v, c in h.items():
+                hist[v] = hist.get(v, 0) + c
+            for name, c in cc.items():
+                combos[name] = combos.get(name, 0) + c
+            left -= k
+    else:
+        hist, combos = _zsim_py(picks, left, stake, ww, lp, random.Random(seed))
+    r: Dict[str, object] = dict(sim_summary(hist, spins, stake))
+    r["combos"] = {name: c / max(1, int(spins)) for name, c in sorted(combos.items(), key=lambda x: -x[1])}
+    return r
+
+def _zsim_parse_picks(s: str) -> List[str]:
+    picks = [x.strip().upper() for x in (s or "").split(",") if x.strip()]
+    if not picks or len(picks) > 5:
+        raise SystemExit(f"need 1..5 picks: {s}")
+    for c in picks:
+        ok = c in ("E", "O", "R", "B", "Z")
+        if not ok and c.startswith("N") and c[1:].isdigit():
+            ok = 1 <= int(c[1:]) <= 36
+        if not ok:
+            raise SystemExit(f"bad pick: {c} (N1..N36, Z, E, O, R, B)")
+    return picks
+
+def _zsim_parse_ints(s: Optional[str], default: int) -> List[int]:
+    if not s:
+        return [int(default)]
+    return [int(x) for x in s.split(",") if x.strip()]
+
+def zsim_main(argv: List[str]) -> int:
+    import argparse
+    ap = argparse.ArgumentParser(prog="casino.bot.py zsim", description="Монте-Карло zero-рулетки")
+    ap.add_argument("--picks", action="append", required=True,
+                    help="до 5 ставок через запятую (N1..N36, Z, E, O, R, B); можно повторять")
+    ap.add_argument("--red", default="0", help="red_chip на столе (через запятую — перебор)")
+    ap.add_argument("--black", default="0", help="black_chip на столе (через запятую — перебор)")
+    ap.add_argument("--lucky", action="store_true", help="у игрока удачная фишка")
+    ap.add_argument("--color-pct", default=None, help=f"ZERO_COLOR_BONUS_PCT (сейчас {ZERO_COLOR_BONUS_PCT}), через запятую")
+    ap.add_argument("--lucky-pct", default=None, help=f"ZERO_LUCKY_PROC_PCT (сейчас {ZERO_LUCKY_PROC_PCT}), через запятую")
+    ap.add_argument("--spins", type=int, default=1_000_000)
+    ap.add_argument("--stake", type=int, default=100, help="ставка в центах")
+    ap.add_argument("--seed", type=int, default=None)
+    ap.add_argument("--combos", action="store_true", help="печатать частоты комбо")
+    ap.add_argument("--pure", action="store_true", help="без NumPy")
+    a = ap.parse_args(argv)
+
+    pick_sets = [_zsim_parse_picks(x) for x in a.picks]
+    reds = _zsim_parse_ints(a.red, 0)
+    blacks = _zsim_parse_ints(a.black, 0)
+    color_pcts = _zsim_parse_ints(a.color_pct, ZERO_COLOR_BONUS_PCT)
+    lucky_pcts = _zsim_parse_ints(a.lucky_pct, ZERO_LUCKY_PROC_PCT) if a.lucky else [0]
+
+    engine = "numpy" if (np is not None and not a.pure) else "python"
+    print(f"engine={engine} spins={a.spins} stake={a.stake} lucky={'yes' if a.lucky else 'no'}")
+    print(f"{'picks':24} {'red':>3} {'blk':>3} {'col%':>4} {'lck%':>4} {'win':>7} {'loss':>7} "
+          f"{'EV':>8} {'std':>7} {'p1%':>7} {'max':>7} {'sec':>6}")
+    for picks in pick_sets:
+        for red in reds:
+            for black in blacks:
+                for cp in color_pcts:
+                    for lp in lucky_pcts:
+                        t0 = time.time()
+                        r = simulate_zero(picks, red, black, a.lucky, a.spins, a.stake, cp, lp,
+                                          a.seed, use_numpy=not a.pure)
+                        print(
+                            f"{','.join(picks):24} {red:3d} {black:3d} {cp:4d} {lp if a.lucky else '-':>4} "
+                            f"{r['hit'] * 100:6.2f}% {r['loss'] * 100:6.2f}% {r['ev']:+8.4f} {r['std']:7.3f} "
+                            f"{r['p01']:+7.2f} {r['max']:+7.2f} {time.time() - t0:6.1f}"
+                        )
+                        if a.combos:
+                            for name, p in r["combos"].items():
+                                print(f"      {name:16} {p * 100:8.4f}%")
+    return 0
+
+SIM_COMMANDS = {"sim": sim_main, "ev": ev_main, "zsim": zsim_main}
+
+if __name__ == "__main__" and len(sys.argv) > 1 and sys.argv[1] in SIM_COMMANDS:
+    sys.exit(SIM_COMMANDS[sys.argv[1]](sys.argv[2:]))
+
+
 from telebot import TeleBot
 from telebot.handler_backends import ContinueHandling
 from telebot.types import (
@@ -22,7 +1467,6 @@ from telebot.types import (
     InputMediaPhoto,
 )
 import io
-import sys
 import traceback
 
 # CONFIG
@@ -130,39 +1574,100 @@ sys.excepthook = _sys_excepthook
 import heapq
 import itertools as _itertools
 
+# Приоритеты правок: обычные (итог хода, лобби) идут раньше кадров анимации.
+# Кадр с истёкшим deadline или при перегрузке (очередь/429) выбрасывается.
+EDIT_PRIO_NORMAL = 0
+EDIT_PRIO_FRAME = 1
+EDIT_FRAME_TTL_SEC = 1.5          # кадр старше этого уже не показываем
+EDIT_ANIM_MAX_BACKLOG = 8         # правок в очереди, после которых анимация выключается
+EDIT_ANIM_429_WINDOW_SEC = 30.0
+EDIT_ANIM_429_MAX = 2             # 429 за окно, после которых анимация выключается
+
+# Квоты Telegram: ~30 сообщений/с на бота, ~20/мин на группу, ~1/с в личке.
+# (rate в токенах/с, ёмкость ведра)
+EDIT_GLOBAL_BUCKET = (28.0, 10)
+EDIT_GROUP_BUCKET = (20.0 / 60.0, 5)
+EDIT_PRIVATE_BUCKET = (1.0, 3)
+# Инлайн-сообщение не знает своего чата, а в одной группе их может быть несколько, так что
+# групповую квоту честно не посчитать. Ведро на сообщение с прежним шагом 1.05 с;
+# сверху — общее ведро бота и пауза по 429.
+EDIT_INLINE_BUCKET = (1.0 / 1.05, 3)
+EDIT_FRAME_RESERVE = 2            # кадры не тратят последние токены чата — они для итогов
+EDIT_LATENCY_SAMPLES = 2000
+
 class _EditJob:
-    __slots__ = ("due", "target", "req_id", "text", "reply_markup", "parse_mode", "inline_id", "chat_id", "msg_id")
-    def __init__(self, due, target, req_id, text, reply_markup, parse_mode, inline_id, chat_id, msg_id):
-        self.due = due
+    __slots__ = ("due", "target", "chat_key", "text", "reply_markup", "parse_mode", "inline_id", "chat_id", "msg_id",
+                 "priority", "deadline", "enq_ts")
+    def __init__(self, target, chat_key, text, reply_markup, parse_mode, inline_id, chat_id, msg_id,
+                 priority=EDIT_PRIO_NORMAL, deadline=None):
+        self.due = 0.0
         self.target = target
-        self.req_id = req_id
+        self.chat_key = chat_key
         self.text = text
         self.reply_markup = reply_markup
         self.parse_mode = parse_mode
         self.inline_id = inline_id
         self.chat_id = chat_id
         self.msg_id = msg_id
+        self.priority = priority
+        self.deadline = deadline
+        self.enq_ts = time.time()
+
+def percentile_ms(sorted_vals, q: float) -> float:
+    """Перцентиль по отсортированным секундам, в миллисекундах."""
+    if not sorted_vals:
+        return 0.0
+    return sorted_vals[min(len(sorted_vals) - 1, int(q * len(sorted_vals)))] * 1000.0
+
+class _TokenBucket:
+    __slots__ = ("rate", "cap", "tokens", "ts")
+    def __init__(self, rate: float, cap: int):
+        self.rate = float(rate)
+        self.cap = float(cap)
+        self.tokens = float(cap)
+        self.ts = time.time()
+
+    def refill(self, now: float) -> float:
+        if now > self.ts:
+            self.tokens = min(self.cap, self.tokens + (now - self.ts) * self.rate)
+            self.ts = now
+        return self.tokens
+
+    def wait_time(self, now: float) -> float:
+        t = self.refill(now)
+        return 0.0 if t >= 1.0 else (1.0 - t) / self.rate
+
+    def take(self, now: float):
+        self.refill(now)
+        self.tokens -= 1.0
 
 class EditLimiter:
-    """Serializes + rate-limits edit_message_text globally and per-message.
+    """Serializes + rate-limits edit_message_text with Telegram-shaped token buckets.
 
     Key features:
-    - Global gap between edits (avoids overall flood).
+    - One global bucket (~30/s) and one bucket per chat (~20/min in groups, ~1/s in private).
+    - Round-robin between chats: a busy group waits for its own tokens instead of starving others.
     - Per-target gap (avoids 'message is not modified' / 'too frequent' issues).
-    - Coalescing: if many edits queued for the same target (animation), only the latest is applied.
-    - Handles 429 retry_after by rescheduling the same edit.
+    - Coalescing: one pending edit per target, a newer edit replaces it (animation).
+    - 429 retry_after pauses only the offending chat and reschedules the edit.
+    - Animation frames (EDIT_PRIO_FRAME) go after any ready normal edit and are dropped
+      past their deadline, when the chat has no spare tokens or the limiter is under pressure.
     """
-    def __init__(self, bot_obj, global_gap_sec=0.12, per_target_gap_sec=1.05):
+    def __init__(self, bot_obj, global_bucket=EDIT_GLOBAL_BUCKET, per_target_gap_sec=1.05):
         self.bot = bot_obj
-        self.global_gap = float(global_gap_sec)
         self.per_target_gap = float(per_target_gap_sec)
         self._lock = threading.RLock()
         self._cv = threading.Condition(self._lock)
-        self._pq = []  
-        self._counter = _itertools.count()
-        self._latest_req = {} 
-        self._last_global = 0.0
+        self._jobs = {}              # target -> ожидающая правка
+        self._chat_targets = {}      # chat_key -> OrderedDict[target, None]
+        self._rr = deque()           # очередь чатов для round-robin
+        self._buckets = {}           # chat_key -> _TokenBucket
+        self._blocked_until = {}     # chat_key -> ts (retry_after)
+        self._global = _TokenBucket(*global_bucket)
         self._last_target = {}
+        self._recent_429 = deque()
+        self._latency = deque(maxlen=EDIT_LATENCY_SAMPLES)
+        self.stats = {"applied": 0, "coalesced": 0, "frames_dropped": 0, "429": 0}
         self._running = True
         self._thr = threading.Thread(target=self._run, daemon=True)
         self._thr.start()
@@ -182,45 +1687,149 @@ class EditLimiter:
                 return 0.0
         return 0.0
 
-    def _compute_due(self, target: tuple) -> float:
-        now = time.time()
-        due = now
-        due = max(due, self._last_global + self.global_gap)
-        due = max(due, self._last_target.get(target, 0.0) + self.per_target_gap)
-        return due
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._jobs)
+
+    def _pressured(self, now: float) -> bool:
+        while self._recent_429 and self._recent_429[0] < now - EDIT_ANIM_429_WINDOW_SEC:
+            self._recent_429.popleft()
+        if len(self._recent_429) >= EDIT_ANIM_429_MAX:
+            return True
+        return len(self._jobs) > EDIT_ANIM_MAX_BACKLOG
+
+    def animation_ok(self) -> bool:
+        """Есть ли смысл слать промежуточные кадры прямо сейчас."""
+        with self._lock:
+            return not self._pressured(time.time())
+
+    def _bucket(self, chat_key) -> _TokenBucket:
+        b = self._buckets.get(chat_key)
+        if b is None:
+            if chat_key[0] != "chat":
+                spec = EDIT_INLINE_BUCKET
+            else:
+                spec = EDIT_PRIVATE_BUCKET if chat_key[1] > 0 else EDIT_GROUP_BUCKET
+            b = _TokenBucket(*spec)
+            self._buckets[chat_key] = b
+        return b
+
+    def _drop_job(self, job: _EditJob):
+        self._jobs.pop(job.target, None)
+        targets = self._chat_targets.get(job.chat_key)
+        if targets is not None:
+            targets.pop(job.target, None)
+            if not targets:
+                self._chat_targets.pop(job.chat_key, None)
+                try:
+                    self._rr.remove(job.chat_key)
+                except ValueError:
+                    pass
+
+    def _push_job(self, job: _EditJob):
+        self._jobs[job.target] = job
+        targets = self._chat_targets.get(job.chat_key)
+        if targets is None:
+            targets = OrderedDict()
+            self._chat_targets[job.chat_key] = targets
+            self._rr.append(job.chat_key)
+        targets[job.target] = None
 
     def edit_text(self, *, text: str, reply_markup=None, parse_mode: str = None,
-                  inline_id: str = None, chat_id: int = None, msg_id: int = None):
+                  inline_id: str = None, chat_id: int = None, msg_id: int = None,
+                  priority: int = EDIT_PRIO_NORMAL, deadline: float = None):
         if inline_id:
             target = ("inline", inline_id)
+            chat_key = target
         else:
             target = ("chat", int(chat_id), int(msg_id))
+            chat_key = ("chat", int(chat_id))
 
         with self._lock:
-            due = self._compute_due(target)
-            req_id = next(self._counter)
-            self._latest_req[target] = req_id
-            job = _EditJob(due, target, req_id, text, reply_markup, parse_mode, inline_id, chat_id, msg_id)
-            heapq.heappush(self._pq, (job.due, next(self._counter), job))
+            if priority == EDIT_PRIO_FRAME:
+                now = time.time()
+                if self._pressured(now) or self._bucket(chat_key).refill(now) < EDIT_FRAME_RESERVE:
+                    self.stats["frames_dropped"] += 1
+                    return False
+            job = _EditJob(target, chat_key, text, reply_markup, parse_mode, inline_id, chat_id, msg_id,
+                           priority, deadline)
+            job.due = self._last_target.get(target, 0.0) + self.per_target_gap
+            old = self._jobs.get(target)
+            if old is not None:
+                self.stats["coalesced"] += 1
+                # итог не должен стать «кадром» из-за того, что его догнал новый кадр
+                if old.priority == EDIT_PRIO_NORMAL and priority == EDIT_PRIO_FRAME:
+                    job.priority = EDIT_PRIO_NORMAL
+                    job.deadline = None
+                job.enq_ts = old.enq_ts
+                self._jobs[target] = job
+            else:
+                self._push_job(job)
             self._cv.notify()
         return True
 
+    def _next_job(self, now: float):
+        """Следующая правка по кругу чатов; (None, сколько ждать), если отправлять нечего."""
+        wait = 0.5
+        g_wait = self._global.wait_time(now)
+        if g_wait > 0:
+            return None, g_wait
+        for prio in (EDIT_PRIO_NORMAL, EDIT_PRIO_FRAME):
+            for chat_key in list(self._rr):
+                until = self._blocked_until.get(chat_key, 0.0)
+                if until > now:
+                    wait = min(wait, until - now)
+                    continue
+                b_wait = self._bucket(chat_key).wait_time(now)
+                if b_wait > 0:
+                    wait = min(wait, b_wait)
+                    continue
+                for target in list(self._chat_targets.get(chat_key, ())):
+                    job = self._jobs[target]
+                    if job.priority == EDIT_PRIO_FRAME and (
+                        (job.deadline is not None and now > job.deadline) or self._pressured(now)
+                    ):
+                        self.stats["frames_dropped"] += 1
+                        self._drop_job(job)
+                        continue
+                    if job.priority != prio:
+                        continue
+                    if job.due > now:
+                        wait = min(wait, job.due - now)
+                        continue
+                    self._drop_job(job)
+                    if chat_key in self._chat_targets:
+                        # обслуженный чат встаёт в конец круга
+                        self._rr.remove(chat_key)
+                        self._rr.append(chat_key)
+                    self._bucket(chat_key).take(now)
+                    self._global.take(now)
+                    return job, 0.0
+        return None, wait
+
+    def _purge_idle(self, now: float):
+        # полные вёдра без очереди ничего не помнят — их можно забыть
+        for chat_key in [k for k, b in self._buckets.items() if k not in self._chat_targets and b.refill(now) >= b.cap]:
+            self._buckets.pop(chat_key, None)
+            self._blocked_until.pop(chat_key, None)
+        cutoff = now - self.per_target_gap
+        for target in [t for t, ts in self._last_target.items() if ts < cutoff]:
+            self._last_target.pop(target, None)
+
     def _run(self):
         while True:
             with self._lock:
                 if not self._running:
                     return
-                if not self._pq:
-                    self._cv.wait(timeout=0.5)
-                    continue
-                due, _, job = self._pq[0]
                 now = time.time()
-                if due > now:
-                    self._cv.wait(timeout=min(0.5, due - now))
+                if not self._jobs:
+                    if len(self._buckets) > 1000:
+                        self._purge_idle(now)
+                    self._cv.wait(timeout=0.5)
                     continue
-                heapq.heappop(self._pq)
-
-                if self._latest_req.get(job.target) != job.req_id:
+                job, wait = self._next_job(now)
+                if job is None:
+                    self._cv.wait(timeout=max(0.01, min(0.5, wait)))
                     continue
 
             try:
@@ -242,29 +1851,58 @@ class EditLimiter:
 
                 with self._lock:
                     t = time.time()
-                    self._last_global = t
                     self._last_target[job.target] = t
+                    self._latency.append(t - job.enq_ts)
+                    self.stats["applied"] += 1
 
             except Exception as e:
                 ra = self._parse_retry_after(e)
                 if ra > 0:
                     with self._lock:
-                        self._latest_req[job.target] = job.req_id
-                        job.due = time.time() + ra + 0.15
-                        heapq.heappush(self._pq, (job.due, next(self._counter), job))
+                        t = time.time()
+                        self.stats["429"] += 1
+                        self._recent_429.append(t)
+                        # пауза только для этого чата
+                        self._blocked_until[job.chat_key] = max(self._blocked_until.get(job.chat_key, 0.0), t + ra + 0.15)
+                        if job.priority == EDIT_PRIO_FRAME:
+                            # кадр после паузы уже никому не нужен
+                            self.stats["frames_dropped"] += 1
+                            continue
+                        if job.target not in self._jobs:
+                            self._push_job(job)
                         self._cv.notify()
                 continue
 
+    def metrics(self) -> Dict[str, float]:
+        with self._lock:
+            lat = sorted(self._latency)
+            now = time.time()
+            blocked = sum(1 for ts in self._blocked_until.values() if ts > now)
+            out = dict(self.stats)
+            out.update({
+                "depth": len(self._jobs),
+                "chats": len(self._chat_targets),
+                "blocked": blocked,
+            })
+
+        out["p50_ms"] = percentile_ms(lat, 0.50)
+        out["p99_ms"] = percentile_ms(lat, 0.99)
+        return out
+
 # Global instance
-EDIT_LIMITER = EditLimiter(bot, global_gap_sec=0.12, per_target_gap_sec=1.05)
+EDIT_LIMITER = EditLimiter(bot, global_bucket=EDIT_GLOBAL_BUCKET, per_target_gap_sec=1.05)
 
 def limited_edit_message_text(*, text: str, reply_markup=None, parse_mode: str = None,
-                              inline_id: str = None, chat_id: int = None, msg_id: int = None):
+                              inline_id: str = None, chat_id: int = None, msg_id: int = None,
+                              priority: int = EDIT_PRIO_NORMAL, deadline: float = None):
     """Enqueue an edit_message_text through the global limiter."""
     try:
         EDIT_LIMITER.edit_text(text=text, reply_markup=reply_markup, parse_mode=parse_mode,
-                               inline_id=inline_id, chat_id=chat_id, msg_id=msg_id)
+                               inline_id=inline_id, chat_id=chat_id, msg_id=msg_id,
+                               priority=priority, deadline=deadline)
     except Exception:
+        if priority == EDIT_PRIO_FRAME:
+            return
         try:
             if inline_id:
                 bot.edit_message_text(text, inline_message_id=inline_id, reply_markup=reply_markup, parse_mode=parse_mode)
@@ -273,6 +1911,116 @@ def limited_edit_message_text(*, text: str, reply_markup=None, parse_mode: str =
         except Exception:
             pass
 
+# Global scheduler
+class _SchedJob:
+    __slots__ = ("due", "fn", "args", "kwargs", "key", "cancelled")
+    def __init__(self, due, fn, args, kwargs, key):
+        self.due = due
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.key = key
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class Scheduler:
+    """Один поток-планировщик (heap по времени) + небольшой пул исполнителей.
+
+    - call_later/call_at возвращают handle с cancel().
+    - key: повторное планирование с тем же ключом отменяет предыдущее (таймер лобби и т.п.).
+    - run_steps: пошаговая задача-генератор; `yield delay` вместо time.sleep, поток не занимается.
+    """
+    def __init__(self, workers=4):
+        self._lock = threading.RLock()
+        self._cv = threading.Condition(self._lock)
+        self._pq = []
+        self._counter = _itertools.count()
+        self._by_key = {}
+        self._work = queue.Queue()
+        self.stats = {"scheduled": 0, "fired": 0, "cancelled": 0, "errors": 0}
+        self._thr = threading.Thread(target=self._run, daemon=True)
+        self._thr.start()
+        self._workers = []
+        for _ in range(max(1, int(workers))):
+            w = threading.Thread(target=self._worker, daemon=True)
+            w.start()
+            self._workers.append(w)
+
+    def call_at(self, due_ts: float, fn, *args, key=None, **kwargs) -> _SchedJob:
+        job = _SchedJob(float(due_ts), fn, args, kwargs, key)
+        with self._lock:
+            if key is not None:
+                old = self._by_key.get(key)
+                if old is not None and not old.cancelled:
+                    old.cancelled = True
+                    self.stats["cancelled"] += 1
+                self._by_key[key] = job
+            heapq.heappush(self._pq, (job.due, next(self._counter), job))
+            self.stats["scheduled"] += 1
+            self._cv.notify()
+        return job
+
+    def call_later(self, delay: float, fn, *args, key=None, **kwargs) -> _SchedJob:
+        return self.call_at(time.time() + max(0.0, float(delay)), fn, *args, key=key, **kwargs)
+
+    def cancel(self, key) -> bool:
+        with self._lock:
+            job = self._by_key.pop(key, None)
+            if job is None or job.cancelled:
+                return False
+            job.cancelled = True
+            self.stats["cancelled"] += 1
+            return True
+
+    def run_steps(self, gen, key=None):
+        """Крутим генератор: каждый `yield delay` — пауза без занятого потока."""
+        def _step():
+            try:
+                delay = next(gen)
+            except StopIteration:
+                return
+            self.call_later(float(delay or 0.0), _step, key=key)
+        self.call_later(0.0, _step, key=key)
+
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._pq)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._pq:
+                    self._cv.wait(timeout=1.0)
+                    continue
+                due, _, job = self._pq[0]
+                now = time.time()
+                if due > now:
+                    self._cv.wait(timeout=min(1.0, due - now))
+                    continue
+                heapq.heappop(self._pq)
+                if job.cancelled:
+                    continue
+                if job.key is not None and self._by_key.get(job.key) is job:
+                    self._by_key.pop(job.key, None)
+            self._work.put(job)
+
+    def _worker(self):
+        while True:
+            job = self._work.get()
+            if job.cancelled:
+                continue
+            try:
+                job.fn(*job.args, **job.kwargs)
+                with self._lock:
+                    self.stats["fired"] += 1
+            except Exception:
+                with self._lock:
+                    self.stats["errors"] += 1
+
+SCHEDULER = Scheduler(workers=int(os.getenv("SCHED_WORKERS", "4")))
+
 # Защита бота от падения
 def init_bot_identity():
     try:
@@ -354,49 +2102,329 @@ print("DB absolute:", cur.execute("PRAGMA database_list;").fetchall())
 print("journal_mode:", cur.execute("PRAGMA journal_mode;").fetchone())
 print("wal_autocheckpoint:", cur.execute("PRAGMA wal_autocheckpoint;").fetchone())
 
-DB_LOCK = threading.RLock()
+# Пул соединений: conn — единственный писатель (под DB_LOCK), чтения идут через
+# DB_READERS соединений с query_only. В WAL читатели не ждут писателя.
+DB_READERS = max(1, int(os.getenv("DB_READERS", "4")))
+
+_DB_WAIT_STATS_LOCK = threading.Lock()
+_DB_WAIT_STATS = {
+    "writer": {"n": 0, "total": 0.0, "max": 0.0},
+    "reader": {"n": 0, "total": 0.0, "max": 0.0},
+}
+
+def _db_wait_note(kind: str, waited: float):
+    with _DB_WAIT_STATS_LOCK:
+        st = _DB_WAIT_STATS[kind]
+        st["n"] += 1
+        st["total"] += waited
+        if waited > st["max"]:
+            st["max"] = waited
+
+def db_wait_stats() -> Dict[str, Dict[str, float]]:
+    """Ожидание писателя/читателя: число захватов, среднее и максимум (мс)."""
+    with _DB_WAIT_STATS_LOCK:
+        out = {}
+        for kind, st in _DB_WAIT_STATS.items():
+            n = int(st["n"])
+            out[kind] = {
+                "n": n,
+                "avg_ms": (st["total"] / n * 1000.0) if n else 0.0,
+                "max_ms": st["max"] * 1000.0,
+            }
+        return out
+
+class _DbWriteLock:
+    """
+    RLock писателя. Дополнительно помнит, держит ли его текущий поток: тогда чтения
+    идут через conn, чтобы видеть свои же незакоммиченные записи.
+    """
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._local = threading.local()
+
+    def acquire(self, blocking: bool = True, timeout: float = -1) -> bool:
+        t0 = time.perf_counter()
+        ok = self._lock.acquire(blocking, timeout)
+        if ok:
+            depth = getattr(self._local, "depth", 0)
+            if depth == 0:
+                _db_wait_note("writer", time.perf_counter() - t0)
+            self._local.depth = depth + 1
+        return ok
+
+    def release(self):
+        self._local.depth = getattr(self._local, "depth", 1) - 1
+        self._lock.release()
+
+    def held(self) -> bool:
+        return getattr(self._local, "depth", 0) > 0
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+        return False
+
+DB_LOCK = _DbWriteLock()
 with DB_LOCK:
     try:
         conn.execute("PRAGMA wal_checkpoint(TRUNCATE);")
     except Exception:
         pass
 
-def db_one(sql: str, params=()):
-    with DB_LOCK:
-        c = conn.cursor()
+def _open_reader() -> sqlite3.Connection:
+    rc = sqlite3.connect(DB_PATH, check_same_thread=False)
+    rc.execute("PRAGMA busy_timeout=8000;")
+    rc.execute("PRAGMA query_only=ON;")
+    return rc
+
+_DB_READ_POOL: "queue.Queue[sqlite3.Connection]" = queue.Queue()
+for _ in range(DB_READERS):
+    _DB_READ_POOL.put(_open_reader())
+
+def _db_read(sql: str, params, one: bool):
+    # внутри записи (db_tx / with DB_LOCK) — читаем через писателя
+    if DB_LOCK.held():
+        with DB_LOCK:
+            c = conn.cursor()
+            try:
+                c.execute(sql, params)
+                return c.fetchone() if one else c.fetchall()
+            finally:
+                try: c.close()
+                except: pass
+
+    t0 = time.perf_counter()
+    rc = _DB_READ_POOL.get()
+    _db_wait_note("reader", time.perf_counter() - t0)
+    try:
+        c = rc.cursor()
         try:
             c.execute(sql, params)
-            return c.fetchone()
+            return c.fetchone() if one else c.fetchall()
         finally:
             try: c.close()
             except: pass
+    finally:
+        _DB_READ_POOL.put(rc)
+
+def db_one(sql: str, params=()):
+    return _db_read(sql, params, True)
 
 def db_all(sql: str, params=()):
+    return _db_read(sql, params, False)
+
+def db_exec(sql: str, params=(), commit: bool = False):
     with DB_LOCK:
         c = conn.cursor()
         try:
             c.execute(sql, params)
-            return c.fetchall()
+            rc = c.rowcount
+            lid = c.lastrowid
+            if commit and not db_in_tx():
+                conn.commit()
+            return rc, lid
         finally:
-            try: c.close()
-            except: pass
+            try:
+                c.close()
+            except:
+                pass
 
-def db_exec(sql: str, params=(), commit: bool = False):
+def db_exec_many(sql: str, seq_params, commit: bool = False) -> int:
+    seq_params = list(seq_params or [])
+    if not seq_params:
+        return 0
     with DB_LOCK:
         c = conn.cursor()
         try:
-            c.execute(sql, params)
+            c.executemany(sql, seq_params)
             rc = c.rowcount
-            lid = c.lastrowid
-            if commit:
+            if commit and not db_in_tx():
                 conn.commit()
-            return rc, lid
+            return rc
         finally:
             try:
                 c.close()
             except:
                 pass
 
+# Единица работы: внутри `with db_tx():` все db_exec(..., commit=True) копятся в одной
+# транзакции, коммит один раз на выходе, при исключении — rollback. DB_LOCK держим весь блок,
+# а все коммиты общего conn идут под тем же замком (db_exec, db_commit), так что чужой поток
+# не зафиксирует нашу половину. Вложенные блоки сливаются во внешний.
+_DB_TX = threading.local()
+
+def db_in_tx() -> bool:
+    return getattr(_DB_TX, "depth", 0) > 0
+
+def db_commit():
+    """Коммит общего conn для кода вида cur.execute(...) + commit: под DB_LOCK, внутри db_tx — ничего."""
+    with DB_LOCK:
+        if not db_in_tx():
+            conn.commit()
+
+def db_after_commit(fn, *args, **kwargs):
+    """Побочные эффекты (сообщения в TG) — после коммита, не под DB_LOCK. Вне транзакции — сразу."""
+    if db_in_tx():
+        _DB_TX.after.append((fn, args, kwargs))
+        return
+    fn(*args, **kwargs)
+
+class db_tx:
+    def __enter__(self):
+        DB_LOCK.acquire()
+        depth = getattr(_DB_TX, "depth", 0)
+        if depth == 0:
+            _DB_TX.after = []
+        _DB_TX.depth = depth + 1
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        after = []
+        try:
+            _DB_TX.depth -= 1
+            if _DB_TX.depth > 0:
+                return False
+            after, _DB_TX.after = _DB_TX.after, []
+            if exc_type is None:
+                try:
+                    conn.commit()
+                except Exception:
+                    try: conn.rollback()
+                    except Exception: pass
+                    after = []
+                    raise
+            else:
+                after = []
+                try: conn.rollback()
+                except Exception: pass
+        finally:
+            DB_LOCK.release()
+
+        for fn, args, kwargs in after:
+            try:
+                fn(*args, **kwargs)
+            except Exception:
+                pass
+        return False
+
+class DbWriteBehind:
+    """Фоновый писатель для записей "выстрелил и забыл" (учёт сообщений, чатов, логов).
+
+    - Хендлер только кладёт запись в очередь и сразу возвращается.
+    - Пачка пишется одной транзакцией раз в flush_sec.
+    - Записи с одинаковым key схлопываются: в базу уйдёт только последняя.
+    - Внутри db_tx запись выполняется сразу, как часть транзакции.
+    - on_commit вызывается после коммита записи (сброс кэшей), у схлопнутых — все по очереди.
+    """
+    def __init__(self, flush_sec=0.05, max_batch=500):
+        self.flush_sec = float(flush_sec)
+        self.max_batch = int(max_batch)
+        self._lock = threading.Lock()
+        self._cv = threading.Condition(self._lock)
+        self._pending = OrderedDict()
+        self._counter = _itertools.count()
+        self._busy = False
+        self._flush_now = False
+        self.stats = {"queued": 0, "coalesced": 0, "written": 0, "batches": 0, "errors": 0}
+        self._thr = threading.Thread(target=self._run, daemon=True)
+        self._thr.start()
+
+    def submit(self, sql: str, params=(), key=None, on_commit=None):
+        if db_in_tx():
+            db_exec(sql, params, commit=True)
+            if on_commit is not None:
+                db_after_commit(on_commit)
+            return
+        with self._lock:
+            callbacks = [on_commit] if on_commit is not None else []
+            if key is None:
+                key = ("_", next(self._counter))
+            elif key in self._pending:
+                self.stats["coalesced"] += 1
+                callbacks = self._pending.pop(key)[2] + callbacks
+            was_empty = not self._pending
+            self._pending[key] = (sql, params, callbacks)
+            self.stats["queued"] += 1
+            # будим писателя только на первой записи пачки: иначе каждое submit обрывало
+            # ожидание набора пачки, и коммит шёл почти на каждую запись
+            if was_empty:
+                self._cv.notify_all()
+
+    @staticmethod
+    def _fire(callbacks):
+        for fn in callbacks:
+            try:
+                fn()
+            except Exception:
+                pass
+
+    def flush(self, timeout: float = 5.0):
+        """Дождаться, пока всё, что уже в очереди, окажется в базе."""
+        if db_in_tx() or threading.current_thread() is self._thr:
+            return
+        deadline = time.time() + float(timeout)
+        with self._lock:
+            while self._pending or self._busy:
+                left = deadline - time.time()
+                if left <= 0:
+                    return
+                self._flush_now = True  # писатель не ждёт flush_sec
+                self._cv.notify_all()
+                self._cv.wait(timeout=min(0.05, left))
+
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._pending:
+                    self._cv.wait(timeout=1.0)
+                # даём набежать пачке до фиксированного срока; пробуждения от submit/flush срок не сдвигают
+                end = time.time() + self.flush_sec
+                while not self._flush_now and len(self._pending) < self.max_batch:
+                    left = end - time.time()
+                    if left <= 0:
+                        break
+                    self._cv.wait(timeout=left)
+                self._flush_now = False
+                batch = []
+                while self._pending and len(batch) < self.max_batch:
+                    batch.append(self._pending.popitem(last=False)[1])
+                self._busy = True
+
+            try:
+                with db_tx():
+                    for sql, params, _cbs in batch:
+                        db_exec(sql, params, commit=True)
+                with self._lock:
+                    self.stats["written"] += len(batch)
+                    self.stats["batches"] += 1
+                for _sql, _params, cbs in batch:
+                    self._fire(cbs)
+            except Exception:
+                # пачка откатилась целиком — пишем по одной, чтобы одна плохая запись не съела остальные
+                for sql, params, cbs in batch:
+                    try:
+                        db_exec(sql, params, commit=True)
+                        with self._lock:
+                            self.stats["written"] += 1
+                    except Exception:
+                        with self._lock:
+                            self.stats["errors"] += 1
+                        continue
+                    self._fire(cbs)
+            finally:
+                with self._lock:
+                    self._busy = False
+                    self._cv.notify_all()
+
+DB_WRITER = DbWriteBehind(flush_sec=0.05)
+
 cur.execute("""
 CREATE TABLE IF NOT EXISTS users (
   user_id INTEGER PRIMARY KEY,
@@ -410,6 +2438,13 @@ CREATE TABLE IF NOT EXISTS users (
 )
 """)
 
+# индекс топа: SQLite сам поддерживает порядок при каждом UPDATE баланса/подарка/демона
+cur.execute("""
+CREATE INDEX IF NOT EXISTS idx_users_top_value
+ON users((COALESCE(balance_cents,0) - COALESCE(demo_gift_cents,0)) DESC, user_id)
+WHERE demon=0
+""")
+
 cur.execute("""
 CREATE TABLE IF NOT EXISTS user_settings (
   user_id INTEGER PRIMARY KEY,
@@ -526,6 +2561,55 @@ CREATE TABLE IF NOT EXISTS slave_earn_log (
 )
 """)
 
+cur.execute("""
+CREATE INDEX IF NOT EXISTS idx_slave_earn_log_pair
+ON slave_earn_log(slave_id, owner_id, ts)
+""")
+
+# сводка выплат по паре (раб, владелец): последнее зачисление + скользящее окно
+# из двух корзин по SLAVE_EARN_WINDOW_SEC (текущая и предыдущая). Ведёт slave_cut_record.
+SLAVE_EARN_WINDOW_SEC = 4 * 3600
+
+cur.execute("""
+CREATE TABLE IF NOT EXISTS slave_earn_summary (
+  slave_id INTEGER NOT NULL,
+  owner_id INTEGER NOT NULL,
+  last_credit_cents INTEGER NOT NULL DEFAULT 0,
+  last_ts INTEGER NOT NULL DEFAULT 0,
+  bucket_ts INTEGER NOT NULL DEFAULT 0,          -- начало текущей корзины
+  bucket_cents INTEGER NOT NULL DEFAULT 0,
+  prev_bucket_cents INTEGER NOT NULL DEFAULT 0,  -- корзина перед bucket_ts
+  PRIMARY KEY (slave_id, owner_id)
+) WITHOUT ROWID
+""")
+
+try:
+    if not cur.execute("SELECT 1 FROM slave_earn_summary LIMIT 1").fetchone():
+        _b = SLAVE_EARN_WINDOW_SEC
+        _b0 = (int(time.time()) // _b) * _b
+        # bare-колонка amount_cents при MAX(ts) берётся из строки с максимальным ts
+        cur.execute("""
+            INSERT OR IGNORE INTO slave_earn_summary
+                (slave_id, owner_id, last_credit_cents, last_ts, bucket_ts, bucket_cents, prev_bucket_cents)
+            SELECT l.slave_id, l.owner_id, l.amount_cents, l.last_ts, ?, COALESCE(w.cur_c, 0), COALESCE(w.prev_c, 0)
+            FROM (
+                SELECT slave_id, owner_id, amount_cents, MAX(ts) AS last_ts
+                FROM slave_earn_log
+                GROUP BY slave_id, owner_id
+            ) l
+            LEFT JOIN (
+                SELECT slave_id, owner_id,
+                       SUM(CASE WHEN ts >= ? THEN amount_cents ELSE 0 END) AS cur_c,
+                       SUM(CASE WHEN ts < ? THEN amount_cents ELSE 0 END) AS prev_c
+                FROM slave_earn_log
+                WHERE ts >= ?
+                GROUP BY slave_id, owner_id
+            ) w ON w.slave_id = l.slave_id AND w.owner_id = l.owner_id
+        """, (_b0, _b0, _b0, _b0 - _b))
+        conn.commit()
+except Exception:
+    pass
+
 cur.execute("""
 CREATE TABLE IF NOT EXISTS slave_meta (
   slave_id INTEGER PRIMARY KEY,
@@ -932,6 +3016,46 @@ CREATE TABLE IF NOT EXISTS pm_trade_state (
 )
 """)
 
+# архив старых игр (см. gc_old_games): только то, что нужно статусам/рассылке
+cur.execute("""
+CREATE TABLE IF NOT EXISTS games_archive (
+  game_id TEXT PRIMARY KEY,
+  game_type TEXT,
+  state TEXT,
+  creator_id INTEGER,
+  stake_cents INTEGER,
+  created_ts INTEGER,
+  cross_round INTEGER,
+  origin_chat_id INTEGER,
+  archived_ts INTEGER
+)
+""")
+
+cur.execute("""
+CREATE TABLE IF NOT EXISTS game_results_archive (
+  game_id TEXT,
+  user_id INTEGER,
+  delta_cents INTEGER DEFAULT 0,
+  PRIMARY KEY (game_id, user_id)
+) WITHOUT ROWID
+""")
+
+# отложенные задачи планировщика (закрытие лобби, тики зеро) — переживают рестарт
+cur.execute("""
+CREATE TABLE IF NOT EXISTS scheduled_jobs (
+  kind TEXT NOT NULL,               -- lobby|zero_reveal
+  ref TEXT NOT NULL,                -- game_id
+  arg INTEGER NOT NULL DEFAULT 0,   -- для zero_reveal: какой шар открыть
+  due_ts REAL NOT NULL,
+  PRIMARY KEY (kind, ref)
+)
+""")
+
+cur.execute("""
+CREATE INDEX IF NOT EXISTS idx_scheduled_jobs_due
+ON scheduled_jobs(due_ts)
+""")
+
 conn.commit()
 
 def ensure_game_origin_columns():
@@ -949,7 +3073,7 @@ def ensure_game_origin_columns():
             conn.execute(sql)
         except sqlite3.OperationalError:
             pass  
-    conn.commit()
+    db_commit()
 
 ensure_game_origin_columns()
 
@@ -968,7 +3092,7 @@ def ensure_credit_columns():
             conn.execute(f"ALTER TABLE credit_loans ADD COLUMN {name} {typ}")
         except sqlite3.OperationalError:
             pass
-    conn.commit()
+    db_commit()
 
 def ensure_transfer_columns():
     for sql in [
@@ -1008,7 +3132,7 @@ def ensure_transfer_columns():
       msg_id INTEGER DEFAULT 0
     )
     """)
-    conn.commit()
+    db_commit()
 
 ensure_transfer_columns()
 
@@ -1019,10 +3143,73 @@ def ensure_shop_cooldowns():
       next_protect_ts INTEGER NOT NULL DEFAULT 0
     )
     """)
-    conn.commit()
+    db_commit()
 
 ensure_shop_cooldowns()
 
+# Журнал денег: ноги проводок (см. ledger_post). account — user_id, 0 — казино, -1 — эскроу.
+cur.execute("""
+CREATE TABLE IF NOT EXISTS ledger (
+  id INTEGER PRIMARY KEY,
+  posting_id TEXT NOT NULL,
+  ts INTEGER NOT NULL,
+  account INTEGER NOT NULL,
+  amount_cents INTEGER NOT NULL,
+  kind TEXT NOT NULL,
+  ref TEXT NOT NULL DEFAULT ''
+)
+""")
+
+# Пустой журнал при первом запуске: открывающая проводка из текущих снапшотов,
+# чтобы сверка сходилась с первого дня. Проверка и все три вставки — одна транзакция:
+# после сбоя журнал остаётся пустым, и следующий старт пробует снова.
+try:
+    with db_tx():
+        if not db_one("SELECT 1 FROM ledger LIMIT 1"):
+            _ts = int(time.time())
+            db_exec("""
+                INSERT INTO ledger (posting_id, ts, account, amount_cents, kind, ref)
+                SELECT 'opening', ?, user_id, balance_cents, 'opening', '' FROM users WHERE COALESCE(balance_cents,0) <> 0
+            """, (_ts,), commit=True)
+            db_exec("""
+                INSERT INTO ledger (posting_id, ts, account, amount_cents, kind, ref)
+                SELECT 'opening', ?, -1, SUM(hold_cents), 'opening', '' FROM buyrab_offers
+                WHERE state=1 HAVING COALESCE(SUM(hold_cents),0) <> 0
+            """, (_ts,), commit=True)
+            db_exec("""
+                INSERT INTO ledger (posting_id, ts, account, amount_cents, kind, ref)
+                SELECT 'opening', ?, 0, -SUM(amount_cents), 'opening', '' FROM ledger
+                HAVING COALESCE(SUM(amount_cents),0) <> 0
+            """, (_ts,), commit=True)
+            print("ledger opening posting created")
+except Exception as e:
+    print("ledger opening posting failed:", repr(e))
+    send_error_report("ledger_opening", e)
+
+# Индексы под горячие запросы. Новый индекс — строкой сюда; проверка планов: /qplan.
+MANAGED_INDEXES = [
+    ("idx_slavery_owner", "slavery(owner_id)"),
+    ("idx_game_players_user", "game_players(user_id)"),
+    ("idx_work_shift_ends", "work_shift(ends_ts)"),
+    ("idx_transfers_pair_ts", "transfers(from_id, to_id, ts)"),
+    ("idx_users_username_nocase", "users(username COLLATE NOCASE)"),
+    ("idx_games_state", "games(state, created_ts)"),
+    ("idx_ledger_account", "ledger(account, id)"),
+    ("idx_ledger_posting", "ledger(posting_id)"),
+    ("idx_game_results_archive_user", "game_results_archive(user_id)"),
+    ("idx_shop_bind_game", "shop_bind(game_id)"),
+]
+
+def ensure_managed_indexes():
+    for name, target in MANAGED_INDEXES:
+        try:
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {target}")
+        except sqlite3.OperationalError as e:
+            print("index failed:", name, repr(e))
+    db_commit()
+
+ensure_managed_indexes()
+
 # Runtime DB: безопасный "cur" 
 # До этого места "cur" был реальным sqlite3.Cursor и использовался для миграций/DDL.
 # Дальше в рантайме он НЕ должен быть реальным курсором, иначе при потоках ловим:
@@ -1224,10 +3411,10 @@ def _track_private_bot_message(sent_msg):
         if chat_id <= 0 or msg_id <= 0:
             return
 
-        db_exec(
+        DB_WRITER.submit(
             "INSERT OR REPLACE INTO pm_bot_messages (chat_id, message_id, created_ts, delete_after_ts, deleted) VALUES (?,?,?,?,0)",
             (chat_id, msg_id, now_ts(), now_ts() + PM_AUTO_DELETE_SEC),
-            commit=True
+            key=("pm_msg", chat_id, msg_id)
         )
     except Exception:
         pass
@@ -1319,21 +3506,64 @@ def safe_format(template: str, **kwargs) -> str:
             return "{" + key + "}"
     return template.format_map(DD(**kwargs))
 
+# Трекинг групп: last_seen держим в памяти и сбрасываем в базу не чаще раза в GROUP_SEEN_FLUSH_SEC.
+# Новый чат или смена названия пишутся сразу.
+GROUP_SEEN_FLUSH_SEC = max(5, int(os.getenv("GROUP_SEEN_FLUSH_SEC", "300")))
+
+_GROUP_SEEN_LOCK = threading.Lock()
+_GROUP_SEEN: Dict[int, list] = {}  # chat_id -> [title, last_seen_ts, flushed_ts]
+
 def remember_group_chat(chat_id: int, title: str = "") -> None:
     chat_id = int(chat_id or 0)
     if chat_id >= 0:
         return
 
-    db_exec(
+    title = str(title or "")[:200]
+    ts = now_ts()
+    with _GROUP_SEEN_LOCK:
+        ent = _GROUP_SEEN.get(chat_id)
+        if ent is not None and (not title or title == ent[0]) and (ts - ent[2]) < GROUP_SEEN_FLUSH_SEC:
+            ent[1] = ts
+            return
+        _GROUP_SEEN[chat_id] = [title or (ent[0] if ent else ""), ts, ts]
+
+    DB_WRITER.submit(
         "INSERT INTO known_group_chats (chat_id, title, added_ts, last_seen_ts) VALUES (?,?,?,?) "
         "ON CONFLICT(chat_id) DO UPDATE SET "
         "title=CASE WHEN excluded.title<>'' THEN excluded.title ELSE known_group_chats.title END, "
         "last_seen_ts=excluded.last_seen_ts",
-        (chat_id, str(title or "")[:200], now_ts(), now_ts()),
-        commit=True
+        (chat_id, title, ts, ts),
+        key=("group_chat", chat_id)
     )
 
+def flush_group_seen() -> int:
+    """Сбросить накопленные last_seen_ts одной пачкой. Возвращает число чатов."""
+    rows = []
+    with _GROUP_SEEN_LOCK:
+        for chat_id, ent in _GROUP_SEEN.items():
+            if ent[1] > ent[2]:
+                rows.append((int(ent[1]), int(chat_id)))
+                ent[2] = ent[1]
+    if rows:
+        db_exec_many(
+            "UPDATE known_group_chats SET last_seen_ts=MAX(COALESCE(last_seen_ts,0), ?) WHERE chat_id=?",
+            rows,
+            commit=True
+        )
+    return len(rows)
+
+def _group_seen_daemon():
+    while True:
+        time.sleep(GROUP_SEEN_FLUSH_SEC)
+        try:
+            flush_group_seen()
+        except Exception:
+            send_error_report("_group_seen_daemon")
+
 def forget_group_chat(chat_id: int) -> None:
+    with _GROUP_SEEN_LOCK:
+        _GROUP_SEEN.pop(int(chat_id), None)
+    DB_WRITER.flush()
     db_exec("DELETE FROM known_group_chats WHERE chat_id=?", (int(chat_id),), commit=True)
 
 def _touch_group_from_message(message) -> None:
@@ -1366,10 +3596,69 @@ def _track_any_group_message(message):
     _touch_group_from_message(message)
     return ContinueHandling()
 
+# CALLBACK ROUTER: один обработчик на все кнопки. Префикс callback_data (до двух
+# сегментов через ":") ищется в словаре маршрутов, вместо линейного перебора
+# лямбда-фильтров telebot. По каждому маршруту — число вызовов и задержки.
+CB_ROUTES: Dict[str, object] = {}
+CB_ROUTE_SAMPLES = 1000
+_CB_ROUTE_STATS: Dict[str, dict] = {}
+_CB_ROUTE_LOCK = threading.Lock()
+
+def cb_route(*prefixes: str):
+    """Регистрирует обработчик кнопок для префиксов вида "shop" или "spin:pull"."""
+    def deco(fn):
+        for p in prefixes:
+            CB_ROUTES[p] = fn
+        return fn
+    return deco
+
+def cb_route_lookup(data: str) -> Tuple[str, object]:
+    base = data.rsplit(CB_SEP, 1)[0] if CB_SEP in data else data
+    parts = base.split(":", 2)
+    for k in (2, 1):
+        if len(parts) >= k:
+            key = ":".join(parts[:k])
+            fn = CB_ROUTES.get(key)
+            if fn is not None:
+                return key, fn
+    return "", None
+
+def _cb_route_record(route: str, dt: float, ok: bool):
+    with _CB_ROUTE_LOCK:
+        st = _CB_ROUTE_STATS.get(route)
+        if st is None:
+            st = {"n": 0, "errors": 0, "lat": deque(maxlen=CB_ROUTE_SAMPLES)}
+            _CB_ROUTE_STATS[route] = st
+        st["n"] += 1
+        if not ok:
+            st["errors"] += 1
+        st["lat"].append(dt)
+
+def cb_route_stats() -> List[Tuple[str, int, int, float, float, float]]:
+    """[(маршрут, вызовов, ошибок, p50, p95, p99 в мс)], самые частые сверху."""
+    with _CB_ROUTE_LOCK:
+        snap = [(r, st["n"], st["errors"], sorted(st["lat"])) for r, st in _CB_ROUTE_STATS.items()]
+    out = []
+    for route, n, errors, lat in snap:
+        out.append((route, n, errors, percentile_ms(lat, 0.50), percentile_ms(lat, 0.95), percentile_ms(lat, 0.99)))
+    out.sort(key=lambda x: -x[1])
+    return out
+
 @bot.callback_query_handler(func=lambda c: True)
-def _track_any_group_callback(call: CallbackQuery):
+def _cb_dispatch(call: CallbackQuery):
     _touch_group_from_callback(call)
-    return ContinueHandling()
+    data = call.data or ""
+    route, fn = cb_route_lookup(data)
+    if fn is None:
+        _cb_route_record("-", 0.0, True)
+        return
+    t0 = time.perf_counter()
+    ok = False
+    try:
+        fn(call)
+        ok = True
+    finally:
+        _cb_route_record(route, time.perf_counter() - t0, ok)
 
 def get_known_broadcast_group_ids() -> List[int]:
     """
@@ -1384,6 +3673,7 @@ def get_known_broadcast_group_ids() -> List[int]:
     queries = [
         "SELECT chat_id FROM known_group_chats WHERE chat_id < 0 ORDER BY last_seen_ts DESC, added_ts DESC",
         "SELECT DISTINCT COALESCE(origin_chat_id,0) FROM games WHERE COALESCE(origin_chat_id,0) < 0",
+        "SELECT DISTINCT COALESCE(origin_chat_id,0) FROM games_archive WHERE COALESCE(origin_chat_id,0) < 0",
         "SELECT DISTINCT COALESCE(chat_id,0) FROM transfers WHERE COALESCE(chat_id,0) < 0",
     ]
 
@@ -1487,7 +3777,17 @@ def get_ban_info(uid: int) -> Tuple[bool, int, str]:
     return True, until_ts, reason
 
 def is_banned(uid: int) -> bool:
-    return get_ban_info(uid)[0]
+    hit, ban = _ucache_get(_BAN_CACHE, int(uid))
+    if hit:
+        banned, until_ts = ban
+        if not banned:
+            return False
+        if until_ts <= 0 or now_ts() < until_ts:
+            return True
+    epoch = _user_cache_epoch()
+    banned, until_ts, _reason = get_ban_info(uid)
+    _ucache_put(_BAN_CACHE, int(uid), (bool(banned), int(until_ts)), epoch)
+    return banned
 def ban_user(uid: int, by_id: int = 0, reason: str = "", *, duration_sec: int = 0) -> int:
     """
     Банит пользователя.
@@ -1506,6 +3806,7 @@ def ban_user(uid: int, by_id: int = 0, reason: str = "", *, duration_sec: int =
         (int(uid), 1, now_ts(), int(until_ts), int(by_id or 0), (reason or "")[:500]),
         commit=True
     )
+    user_cache_invalidate(uid)
     return int(until_ts)
 
 def unban_user(uid: int, by_id: int = 0, reason: str = "") -> None:
@@ -1515,44 +3816,112 @@ def unban_user(uid: int, by_id: int = 0, reason: str = "") -> None:
         (int(uid), 0, now_ts(), 0, int(by_id or 0), (reason or "")[:500]),
         commit=True
     )
+    user_cache_invalidate(uid)
+
+# FSM-состояния диалогов в ЛС (регистрация, репорт, сделки): читаются из памяти,
+# в таблицы пишутся фоном через DB_WRITER (ключ на пользователя — в базу уходит последнее).
+# При старте всё поднимается из таблиц (fsm_load_all).
+FSM_TABLES = {
+    "reg": ("reg_state", ("stage", "msg_id", "last_ts")),
+    "report": ("report_state", ("category", "stage", "created_ts")),
+    "trade": ("pm_trade_state", ("action", "payload", "stage", "created_ts")),
+}
+
+class FsmStore:
+    """Состояние пользователя по видам: kind -> {user_id: (значения колонок)}."""
+    def __init__(self, tables):
+        self._tables = dict(tables)
+        self._lock = threading.Lock()
+        self._data = {kind: {} for kind in self._tables}
+        self._sql = {}
+        for kind, (table, cols) in self._tables.items():
+            upd = ", ".join(f"{c}=excluded.{c}" for c in cols)
+            self._sql[kind] = (
+                f"INSERT INTO {table} (user_id, {', '.join(cols)}) VALUES (?{',?' * len(cols)}) "
+                f"ON CONFLICT(user_id) DO UPDATE SET {upd}",
+                f"DELETE FROM {table} WHERE user_id=?",
+            )
+
+    def load(self) -> int:
+        total = 0
+        for kind, (table, cols) in self._tables.items():
+            rows = db_all(f"SELECT user_id, {', '.join(cols)} FROM {table}")
+            data = {int(r[0]): tuple(r[1:]) for r in rows}
+            with self._lock:
+                self._data[kind] = data
+            total += len(data)
+        return total
+
+    def get(self, kind: str, uid: int) -> Optional[tuple]:
+        with self._lock:
+            return self._data[kind].get(int(uid))
+
+    def _persist(self, kind: str, uid: int) -> None:
+        # под self._lock: очередь DB_WRITER получает записи в том же порядке, что и память,
+        # и всегда с текущим значением (или DELETE, если его нет)
+        values = self._data[kind].get(uid)
+        if values is None:
+            DB_WRITER.submit(self._sql[kind][1], (uid,), key=("fsm", kind, uid))
+        else:
+            DB_WRITER.submit(self._sql[kind][0], (uid,) + values, key=("fsm", kind, uid))
+
+    def _persist_latest(self, kind: str, uid: int) -> None:
+        with self._lock:
+            self._persist(kind, uid)
+
+    def _write(self, kind: str, uid: int, values: Optional[tuple]) -> None:
+        # Внутри db_tx поток держит DB_LOCK: запись в базу — после коммита и без FSM-замка
+        # на время выполнения, иначе db_tx-поток и наш замок могут ждать друг друга.
+        in_tx = db_in_tx()
+        with self._lock:
+            if values is None:
+                self._data[kind].pop(uid, None)
+            else:
+                self._data[kind][uid] = values
+            if not in_tx:
+                self._persist(kind, uid)
+        if in_tx:
+            db_after_commit(self._persist_latest, kind, uid)
+
+    def set(self, kind: str, uid: int, values: tuple) -> None:
+        self._write(kind, int(uid), tuple(values))
+
+    def clear(self, kind: str, uid: int) -> None:
+        # DELETE уходит всегда: если старт не поднял таблицы, строка в базе могла остаться
+        self._write(kind, int(uid), None)
+
+    def sizes(self) -> Dict[str, int]:
+        with self._lock:
+            return {kind: len(d) for kind, d in self._data.items()}
+
+FSM_STATE = FsmStore(FSM_TABLES)
+
+def fsm_load_all() -> int:
+    return FSM_STATE.load()
 
 def report_set_state(uid: int, category: str, stage: str) -> None:
-    db_exec(
-        "INSERT INTO report_state (user_id, category, stage, created_ts) VALUES (?,?,?,?) "
-        "ON CONFLICT(user_id) DO UPDATE SET category=excluded.category, stage=excluded.stage, created_ts=excluded.created_ts",
-        (int(uid), str(category), str(stage), now_ts()),
-        commit=True
-    )
+    FSM_STATE.set("report", uid, (str(category), str(stage), now_ts()))
 
 def report_get_state(uid: int) -> Tuple[Optional[str], Optional[str]]:
-    r = db_one("SELECT stage, category FROM report_state WHERE user_id=?", (int(uid),))
+    r = FSM_STATE.get("report", uid)
     if not r:
         return None, None
-    return (r[0], r[1])
+    return (r[1], r[0])
 
 def report_clear_state(uid: int) -> None:
-    db_exec("DELETE FROM report_state WHERE user_id=?", (int(uid),), commit=True)
+    FSM_STATE.clear("report", uid)
 
 def trade_state_set(uid: int, action: str, payload: str = "", stage: str = "ready") -> None:
-    db_exec(
-        "INSERT INTO pm_trade_state (user_id, action, payload, stage, created_ts) VALUES (?,?,?,?,?) "
-        "ON CONFLICT(user_id) DO UPDATE SET action=excluded.action, payload=excluded.payload, "
-        "stage=excluded.stage, created_ts=excluded.created_ts",
-        (int(uid), str(action or ""), str(payload or ""), str(stage or "ready"), now_ts()),
-        commit=True
-    )
+    FSM_STATE.set("trade", uid, (str(action or ""), str(payload or ""), str(stage or "ready"), now_ts()))
 
 def trade_state_get(uid: int) -> Tuple[Optional[str], Optional[str], str]:
-    r = db_one(
-        "SELECT action, stage, payload FROM pm_trade_state WHERE user_id=?",
-        (int(uid),)
-    )
+    r = FSM_STATE.get("trade", uid)
     if not r:
         return None, None, ""
-    return (r[0], r[1], str(r[2] or ""))
+    return (r[0], r[2], str(r[1] or ""))
 
 def trade_state_clear(uid: int) -> None:
-    db_exec("DELETE FROM pm_trade_state WHERE user_id=?", (int(uid),), commit=True)
+    FSM_STATE.clear("trade", uid)
 
 def _trade_pack_payload(target_un: str = "", amount_raw: str = "") -> str:
     return f"{(target_un or '').strip()}|{(amount_raw or '').strip()}"
@@ -1811,50 +4180,213 @@ def render_contract_for_user(uid: int) -> Optional[str]:
 
     return f"{head}\n\n<blockquote expandable>{tail}</blockquote>"
 
-def upsert_user(uid: int, username: Optional[str]):
-    db_exec("""
+# Кэш пользователей (LRU + TTL): строки users, бан-флаги и @username -> user_id.
+# Сбрасываем после коммита каждой записи в users/bans; TTL — страховка.
+# Эпоха не даёт чтению, начатому до записи, положить в кэш старую строку.
+USER_CACHE_MAX = 5000
+USER_CACHE_TTL_SEC = 120
+
+_USER_CACHE: "OrderedDict[int, tuple]" = OrderedDict()
+_BAN_CACHE: "OrderedDict[int, tuple]" = OrderedDict()
+_UNAME_CACHE: "OrderedDict[str, tuple]" = OrderedDict()
+_USER_CACHE_LOCK = threading.Lock()
+_USER_CACHE_EPOCH = [0]
+_USER_CACHE_STATS = {"hits": 0, "misses": 0, "invalidations": 0}
+
+def _user_cache_epoch() -> int:
+    with _USER_CACHE_LOCK:
+        return _USER_CACHE_EPOCH[0]
+
+def _ucache_get(store, key):
+    with _USER_CACHE_LOCK:
+        item = store.get(key)
+        if item is not None and (now_ts() - item[0]) < USER_CACHE_TTL_SEC:
+            store.move_to_end(key)
+            _USER_CACHE_STATS["hits"] += 1
+            return True, item[1]
+        if item is not None:
+            store.pop(key, None)
+        _USER_CACHE_STATS["misses"] += 1
+        return False, None
+
+def _ucache_put(store, key, value, epoch: int):
+    with _USER_CACHE_LOCK:
+        if _USER_CACHE_EPOCH[0] != epoch:
+            return
+        store[key] = (now_ts(), value)
+        store.move_to_end(key)
+        while len(store) > USER_CACHE_MAX:
+            store.popitem(last=False)
+
+def _user_cache_drop(*uids):
+    with _USER_CACHE_LOCK:
+        _USER_CACHE_EPOCH[0] += 1
+        for uid in uids:
+            try:
+                uid = int(uid)
+            except Exception:
+                continue
+            a = _USER_CACHE.pop(uid, None)
+            b = _BAN_CACHE.pop(uid, None)
+            if a is not None or b is not None:
+                _USER_CACHE_STATS["invalidations"] += 1
+
+def user_cache_invalidate(*uids):
+    """Внутри транзакции — после коммита, иначе сразу."""
+    db_after_commit(_user_cache_drop, *uids)
+
+def user_cache_clear():
+    with _USER_CACHE_LOCK:
+        _USER_CACHE_EPOCH[0] += 1
+        _USER_CACHE.clear()
+        _BAN_CACHE.clear()
+        _UNAME_CACHE.clear()
+
+def user_cache_stats() -> Dict[str, int]:
+    with _USER_CACHE_LOCK:
+        out = dict(_USER_CACHE_STATS)
+        out["size"] = len(_USER_CACHE) + len(_BAN_CACHE) + len(_UNAME_CACHE)
+    return out
+
+UPSERT_USER_SQL = """
     INSERT INTO users (user_id, username, created_ts)
     VALUES (?,?,?)
     ON CONFLICT(user_id) DO UPDATE SET username=COALESCE(excluded.username, users.username)
-    """, (int(uid), username, now_ts()), commit=True)
+    """
+
+def upsert_user(uid: int, username: Optional[str], wait: bool = True):
+    """wait=False — через фоновый писатель (когда строка нужна не сразу, напр. inline)."""
+    if not wait:
+        # кэш сбрасываем после коммита фонового писателя: до него читатель увидит старую
+        # строку и положил бы её в кэш на весь TTL уже после нашего сброса
+        DB_WRITER.submit(
+            UPSERT_USER_SQL, (int(uid), username, now_ts()),
+            key=("user", int(uid)), on_commit=lambda: _user_cache_drop(uid),
+        )
+        return
+    db_exec(UPSERT_USER_SQL, (int(uid), username, now_ts()), commit=True)
+    user_cache_invalidate(uid)
 
 def set_short_name(uid: int, name: str):
     upsert_user(uid, None)
     db_exec("UPDATE users SET short_name=? WHERE user_id=?", (name, int(uid)), commit=True)
+    user_cache_invalidate(uid)
 
 def get_user(uid: int):
-    return db_one(
+    uid = int(uid)
+    hit, row = _ucache_get(_USER_CACHE, uid)
+    if hit:
+        return row
+    epoch = _user_cache_epoch()
+    row = db_one(
         "SELECT user_id, username, short_name, created_ts, contract_ts, balance_cents, demo_gift_cents, demon "
         "FROM users WHERE user_id=?",
-        (int(uid),)
+        (uid,)
     )
+    _ucache_put(_USER_CACHE, uid, row, epoch)
+    return row
 
 def set_reg_state(uid: int, stage: Optional[str], msg_id: Optional[int]):
-    db_exec("""
-    INSERT INTO reg_state (user_id, stage, msg_id, last_ts)
-    VALUES (?,?,?,?)
-    ON CONFLICT(user_id) DO UPDATE SET stage=excluded.stage, msg_id=excluded.msg_id, last_ts=excluded.last_ts
-    """, (int(uid), stage, msg_id, now_ts()), commit=True)
+    FSM_STATE.set("reg", uid, (stage, msg_id, now_ts()))
 
 def get_reg_state(uid: int):
-    row = db_one("SELECT stage, msg_id FROM reg_state WHERE user_id=?", (int(uid),))
-    return row if row else (None, None)
+    row = FSM_STATE.get("reg", uid)
+    return (row[0], row[1]) if row else (None, None)
 
 def wipe_user(uid: int):
     uid = int(uid)
+    ledger_close_account(uid)
     db_exec("DELETE FROM users WHERE user_id=?", (uid,), commit=True)
-    db_exec("DELETE FROM reg_state WHERE user_id=?", (uid,), commit=True)
+    FSM_STATE.clear("reg", uid)
     db_exec("DELETE FROM daily_mail WHERE user_id=?", (uid,), commit=True)
     db_exec("DELETE FROM game_stats WHERE user_id=?", (uid,), commit=True)
     db_exec("DELETE FROM slavery WHERE slave_id=? OR owner_id=?", (uid, uid), commit=True)
-
-def add_balance(uid: int, delta_cents: int):
-    upsert_user(int(uid), None)
-    db_exec(
-        "UPDATE users SET balance_cents = COALESCE(balance_cents,0) + ? WHERE user_id=?",
-        (int(delta_cents), int(uid)),
-        commit=True
+    status_cache_invalidate(uid)
+    user_cache_invalidate(uid)
+
+# ДЕНЬГИ: журнал проводок (ledger). Каждое движение денег — проводка из нескольких ног
+# (счёт, центы) с нулевой суммой; недостающую ногу добирает встречный счёт (по умолчанию
+# казино). Ноги пишутся одним executemany, users.balance_cents — снапшот, обновляется
+# в той же транзакции. Сверка снапшота с журналом: /ledger.
+LEDGER_HOUSE = 0        # казино: выигрыши, кредиты, выдачи владельца
+LEDGER_ESCROW = -1      # деньги, зарезервированные под сделки buyrab
+LEDGER_INSERT_SQL = "INSERT INTO ledger (posting_id, ts, account, amount_cents, kind, ref) VALUES (?,?,?,?,?,?)"
+LEDGER_BALANCE_SQL = "UPDATE users SET balance_cents = COALESCE(balance_cents,0) + ? WHERE user_id=?"
+
+def _ledger_rows(legs, kind: str, ref: str, ts: int, counter: int):
+    merged: Dict[int, int] = {}
+    for acc, amt in legs:
+        merged[int(acc)] = merged.get(int(acc), 0) + int(amt)
+    rest = -sum(merged.values())
+    if rest:
+        merged[int(counter)] = merged.get(int(counter), 0) + rest
+    merged = {a: v for a, v in merged.items() if v}
+    if not merged:
+        return "", [], [], []
+    pid = uuid.uuid4().hex
+    rows = [(pid, ts, a, v, str(kind), str(ref or "")) for a, v in merged.items()]
+    users = [a for a in merged if a > 0]
+    return pid, rows, [(u, ts) for u in users], [(merged[u], u) for u in users]
+
+def ledger_post(legs, kind: str, ref: str = "", counter: int = LEDGER_HOUSE) -> str:
+    """
+    Проводка legs=[(user_id, cents), ...] одной транзакцией: ноги журнала + снапшоты балансов.
+    Внутри внешнего db_tx сливается с ним. Возвращает posting_id ("" — двигать нечего).
+    """
+    ts = now_ts()
+    pid, rows, new_users, bal_rows = _ledger_rows(legs, kind, ref, ts, counter)
+    if not pid:
+        return ""
+    with db_tx():
+        db_exec_many("INSERT OR IGNORE INTO users (user_id, created_ts) VALUES (?,?)", new_users, commit=True)
+        db_exec_many(LEDGER_INSERT_SQL, rows, commit=True)
+        db_exec_many(LEDGER_BALANCE_SQL, bal_rows, commit=True)
+    uids = [u for _d, u in bal_rows]
+    status_cache_invalidate(*uids)
+    user_cache_invalidate(*uids)
+    return pid
+
+def ledger_post_cur(c, legs, kind: str, ref: str = "", counter: int = LEDGER_HOUSE) -> str:
+    """То же на курсоре ручной транзакции (BEGIN ... db_commit() под DB_LOCK). Кэши сбрасывает вызывающий."""
+    ts = now_ts()
+    pid, rows, new_users, bal_rows = _ledger_rows(legs, kind, ref, ts, counter)
+    if not pid:
+        return ""
+    c.executemany("INSERT OR IGNORE INTO users (user_id, created_ts) VALUES (?,?)", new_users)
+    c.executemany(LEDGER_INSERT_SQL, rows)
+    c.executemany(LEDGER_BALANCE_SQL, bal_rows)
+    return pid
+
+def ledger_close_account(uid: int, kind: str = "wipe") -> str:
+    """Перед удалением строки пользователя: остаток уходит казино, журнал сходится."""
+    return ledger_post([(int(uid), -get_balance_cents(uid))], kind)
+
+def ledger_reconcile(limit: int = 20) -> Dict[str, object]:
+    """Сверка: сумма ног по пользователю == users.balance_cents, эскроу == открытые hold_cents."""
+    bad = db_all(
+        "SELECT u.user_id, COALESCE(u.balance_cents,0), COALESCE(l.s,0) FROM users u "
+        "LEFT JOIN (SELECT account, SUM(amount_cents) AS s FROM ledger WHERE account>0 GROUP BY account) l "
+        "ON l.account=u.user_id WHERE COALESCE(u.balance_cents,0) <> COALESCE(l.s,0) LIMIT ?",
+        (int(limit),)
     )
+    tot = db_one("SELECT COALESCE(SUM(amount_cents),0), COUNT(*), COUNT(DISTINCT posting_id) FROM ledger")
+    esc = db_one("SELECT COALESCE(SUM(amount_cents),0) FROM ledger WHERE account=?", (LEDGER_ESCROW,))
+    hold = db_one("SELECT COALESCE(SUM(hold_cents),0) FROM buyrab_offers WHERE state=1")
+    house = db_one("SELECT COALESCE(SUM(amount_cents),0) FROM ledger WHERE account=?", (LEDGER_HOUSE,))
+    return {
+        "mismatches": [(int(u), int(b), int(s)) for u, b, s in bad],
+        "sum": int(tot[0] or 0),
+        "legs": int(tot[1] or 0),
+        "postings": int(tot[2] or 0),
+        "escrow": int(esc[0] or 0),
+        "hold": int(hold[0] or 0),
+        "house": int(house[0] or 0),
+    }
+
+def add_balance(uid: int, delta_cents: int, kind: str = "balance", ref: str = ""):
+    ledger_post([(int(uid), int(delta_cents))], kind, ref)
+
+USER_BY_USERNAME_SQL = "SELECT user_id FROM users WHERE username=? COLLATE NOCASE"
 
 def resolve_user_id_ref(ref: str) -> Optional[int]:
     """
@@ -1871,13 +4403,23 @@ def resolve_user_id_ref(ref: str) -> Optional[int]:
         uname = ref[1:].strip()
         if not uname:
             return None
-        r = db_one("SELECT user_id FROM users WHERE username=? COLLATE NOCASE", (uname,))
-        return int(r[0]) if r else None
+        key = uname.lower()
+        hit, uid = _ucache_get(_UNAME_CACHE, key)
+        if hit:
+            # проверяем по строке пользователя: ник мог уйти к другому
+            u = get_user(uid)
+            if u and (u[1] or "").lower() == key:
+                return int(uid)
+        epoch = _user_cache_epoch()
+        r = db_one(USER_BY_USERNAME_SQL, (uname,))
+        if not r:
+            return None
+        _ucache_put(_UNAME_CACHE, key, int(r[0]), epoch)
+        return int(r[0])
 
     if ref.isdigit():
         uid = int(ref)
-        r = db_one("SELECT 1 FROM users WHERE user_id=?", (uid,))
-        return uid if r else None
+        return uid if get_user(uid) else None
 
     return None
 
@@ -1905,6 +4447,7 @@ def add_custom_status(uid: int, status: str) -> bool:
         (int(uid), status, now_ts()),
         commit=True
     )
+    status_cache_invalidate(uid)
     return True
 
 # PAY
@@ -1982,6 +4525,16 @@ def calc_pay_fee_cents(amount_cents: int) -> int:
     # округляем вверх до цента
     return int((amount_cents * bp + 9999) // 10000)
 
+# анти-фрод: число переводов A→B за окно (всего / больше 100k / больше 1m)
+TRANSFER_FRAUD_COUNTS_SQL = """
+    SELECT
+      COALESCE(SUM(CASE WHEN amount_cents > 0 THEN 1 ELSE 0 END),0) AS c0,
+      COALESCE(SUM(CASE WHEN amount_cents > ? THEN 1 ELSE 0 END),0) AS c100k,
+      COALESCE(SUM(CASE WHEN amount_cents > ? THEN 1 ELSE 0 END),0) AS c1m
+    FROM transfers
+    WHERE from_id=? AND to_id=? AND ts>=?
+"""
+
 def transfer_balance(
     from_uid: int,
     to_uid: int,
@@ -2052,10 +4605,10 @@ def transfer_balance(
             to_until = _check_block(to_uid)
 
             if from_until > 0:
-                conn.commit()
+                db_commit()
                 return False, "blocked_sender", sbal, rbal, 0
             if to_until > 0:
-                conn.commit()
+                db_commit()
                 return False, "blocked_receiver", sbal, rbal, 0
 
             # анти-фрод: считаем переводы за окно времени
@@ -2064,14 +4617,7 @@ def transfer_balance(
             TH_1M = 1_000_000 * 100
 
             c.execute(
-                """
-                SELECT
-                  COALESCE(SUM(CASE WHEN amount_cents > 0 THEN 1 ELSE 0 END),0) AS c0,
-                  COALESCE(SUM(CASE WHEN amount_cents > ? THEN 1 ELSE 0 END),0) AS c100k,
-                  COALESCE(SUM(CASE WHEN amount_cents > ? THEN 1 ELSE 0 END),0) AS c1m
-                FROM transfers
-                WHERE from_id=? AND to_id=? AND ts>=?
-                """,
+                TRANSFER_FRAUD_COUNTS_SQL,
                 (TH_100K, TH_1M, from_uid, to_uid, ts0)
             )
             row = c.fetchone() or (0, 0, 0)
@@ -2110,7 +4656,7 @@ def transfer_balance(
                     )
                 )
                 
-                conn.commit()
+                db_commit()
                 log_transfer_block_file(
                     "block",
                     from_uid,
@@ -2127,27 +4673,23 @@ def transfer_balance(
                 conn.rollback()
                 return False, "insufficient", sbal, rbal, 0
 
-            c.execute(
-                "UPDATE users SET balance_cents = COALESCE(balance_cents,0) - ? WHERE user_id=?",
-                (total_debit, from_uid)
-            )
-            c.execute(
-                "UPDATE users SET balance_cents = COALESCE(balance_cents,0) + ? WHERE user_id=?",
-                (amount_cents, to_uid)
-            )
-
             c.execute(
                 "INSERT INTO transfers (from_id, to_id, amount_cents, fee_cents, ts, comment, chat_id, msg_id) VALUES (?,?,?,?,?,?,?,?)",
                 (from_uid, to_uid, amount_cents, int(fee_cents), ts, (comment or "")[:500], int(chat_id or 0), int(msg_id or 0))
             )
             transfer_id = int(c.lastrowid or 0)
 
+            # отправитель → получатель, комиссия — казино
+            ledger_post_cur(c, [(from_uid, -total_debit), (to_uid, amount_cents)], "transfer", str(transfer_id))
+
             c.execute("SELECT COALESCE(balance_cents,0) FROM users WHERE user_id=?", (from_uid,))
             sbal2 = int((c.fetchone() or [0])[0] or 0)
             c.execute("SELECT COALESCE(balance_cents,0) FROM users WHERE user_id=?", (to_uid,))
             rbal2 = int((c.fetchone() or [0])[0] or 0)
 
-            conn.commit()
+            db_commit()
+            status_cache_invalidate(from_uid, to_uid)
+            user_cache_invalidate(from_uid, to_uid)
             return True, "ok", sbal2, rbal2, transfer_id
 
         except Exception as e:
@@ -2163,11 +4705,12 @@ def transfer_balance(
                 pass
 
 def set_contract_signed(uid: int, gift_cents: int):
-    db_exec("""
-    UPDATE users
-    SET contract_ts=?, demo_gift_cents=?, balance_cents=COALESCE(balance_cents,0)+?
-    WHERE user_id=?
-    """, (now_ts(), int(gift_cents), int(gift_cents), int(uid)), commit=True)
+    with db_tx():
+        db_exec(
+            "UPDATE users SET contract_ts=?, demo_gift_cents=? WHERE user_id=?",
+            (now_ts(), int(gift_cents), int(uid)), commit=True
+        )
+        ledger_post([(int(uid), int(gift_cents))], "contract")
     ensure_daily_mail_row(int(uid))
 
 # Daily mail
@@ -2223,11 +4766,11 @@ def get_favorite_game_title(uid: int) -> str:
         return "—"
 
 def is_registered(uid: int) -> bool:
-    row = db_one("SELECT contract_ts, short_name FROM users WHERE user_id=?", (uid,))
+    row = get_user(uid)
     if not row:
         return False
-    contract_ts = int((row[0] if isinstance(row, (tuple, list)) else row["contract_ts"]) or 0)
-    short_name = (row[1] if isinstance(row, (tuple, list)) else row["short_name"])
+    contract_ts = int((row[4] if isinstance(row, (tuple, list)) else row["contract_ts"]) or 0)
+    short_name = (row[2] if isinstance(row, (tuple, list)) else row["short_name"])
     return contract_ts > 0 and bool(short_name)   
 
 def _mail_letter_text(kind: str, amount_cents: int) -> str:
@@ -2320,12 +4863,12 @@ def _mail_daemon():
                     kind = "intro"
                     amt = 40000
                     cur.execute("UPDATE daily_mail SET next_ts=?, intro_sent=1 WHERE user_id=?", (now + MAIL_PERIOD_SEC, uid))
-                    conn.commit()
+                    db_commit()
                     try:
                         if user_pm_notifications_enabled(uid):
                             _send_mail_prompt(uid, kind, amt)
                         else:
-                            add_balance(uid, amt)
+                            add_balance(uid, amt, "mail", kind)
                     except Exception:
                         pass
         except Exception:
@@ -2342,30 +4885,166 @@ def top_value_cents(uid: int) -> int:
         return -10**18
     return bal - gift
 
-def get_balance_cents(uid: int) -> int:
-    r = db_one("SELECT COALESCE(balance_cents,0) FROM users WHERE user_id=?", (int(uid),))
-    return int((r[0] if r else 0) or 0)
+# выражение должно совпадать с idx_users_top_value, иначе индекс не используется.
+# Топ-N по индексу — O(log N + N_топа); место игрока — подсчёт по индексу, O(место) (см. top_place).
+TOP_VALUE_SQL = "(COALESCE(balance_cents,0) - COALESCE(demo_gift_cents,0))"
+
+TOP_UIDS_SQL = f"SELECT user_id FROM users WHERE demon=0 ORDER BY {TOP_VALUE_SQL} DESC, user_id ASC LIMIT ?"
+
+def top_uids(limit: int) -> List[int]:
+    """Первые limit игроков топа (без демонов), порядок как у сортировки по top_value_cents."""
+    rows = db_all(TOP_UIDS_SQL, (int(limit),))
+    return [int(r[0]) for r in rows or []]
+
+def top_place(uid: int) -> Optional[int]:
+    """
+    Место игрока в топе (1..N) или None, если он демон/не найден.
+    Это подсчёт по idx_users_top_value, а не логарифмический ранг: поиск границы — O(log N),
+    но COUNT(*) проходит все записи индекса выше игрока, т.е. O(место). Лидерам дёшево,
+    хвосту — пропорционально числу игроков над ним (без чтения строк таблицы).
+    """
+    uid = int(uid)
+    r = db_one(f"SELECT {TOP_VALUE_SQL} FROM users WHERE user_id=? AND demon=0", (uid,))
+    if not r:
+        return None
+    val = int(r[0] or 0)
+    r = db_one(
+        f"SELECT (SELECT COUNT(*) FROM users WHERE demon=0 AND {TOP_VALUE_SQL} > ?)"
+        f" + (SELECT COUNT(*) FROM users WHERE demon=0 AND {TOP_VALUE_SQL} = ? AND user_id < ?)",
+        (val, val, uid)
+    )
+    return int((r[0] if r else 0) or 0) + 1
+
+def top_last_uid() -> Optional[int]:
+    """Последний игрок топа."""
+    r = db_one(
+        f"SELECT user_id FROM users WHERE demon=0 ORDER BY {TOP_VALUE_SQL} ASC, user_id DESC LIMIT 1",
+        ()
+    )
+    return int(r[0]) if r else None
+
+def get_balance_cents(uid: int) -> int:
+    r = db_one("SELECT COALESCE(balance_cents,0) FROM users WHERE user_id=?", (int(uid),))
+    return int((r[0] if r else 0) or 0)
+
+# Кэш статусов (LRU). Места в топе сюда не попадают — их считаем по индексу каждый раз,
+# т.к. "Богатейший"/"Сама нищета" зависят от чужих балансов.
+STATUS_CACHE_MAX = 2000
+STATUS_CACHE_TTL_SEC = 300  # страховка для путей без явной инвалидации (напр. "Вечный узник" по времени)
+
+_STATUS_CACHE: "OrderedDict[int, tuple]" = OrderedDict()
+_STATUS_CACHE_LOCK = threading.Lock()
+_STATUS_CACHE_STATS = {"hits": 0, "misses": 0, "invalidations": 0}
+# эпоха как у кэша пользователей: расчёт, начатый до сброса, в кэш не попадёт
+_STATUS_CACHE_EPOCH = [0]
+
+def _status_cache_epoch() -> int:
+    with _STATUS_CACHE_LOCK:
+        return _STATUS_CACHE_EPOCH[0]
+
+def _status_cache_drop(*uids):
+    with _STATUS_CACHE_LOCK:
+        _STATUS_CACHE_EPOCH[0] += 1
+        for uid in uids:
+            try:
+                if _STATUS_CACHE.pop(int(uid), None) is not None:
+                    _STATUS_CACHE_STATS["invalidations"] += 1
+            except Exception:
+                pass
+
+def status_cache_invalidate(*uids):
+    """Внутри транзакции — после коммита, иначе сразу."""
+    db_after_commit(_status_cache_drop, *uids)
+
+def status_cache_invalidate_game(game_id: str):
+    rows = db_all("SELECT user_id FROM game_players WHERE game_id=?", (game_id,))
+    status_cache_invalidate(*[int(r[0]) for r in rows or []])
+
+def status_cache_clear():
+    with _STATUS_CACHE_LOCK:
+        _STATUS_CACHE_EPOCH[0] += 1
+        _STATUS_CACHE.clear()
+
+def status_cache_stats() -> Dict[str, int]:
+    with _STATUS_CACHE_LOCK:
+        out = dict(_STATUS_CACHE_STATS)
+        out["size"] = len(_STATUS_CACHE)
+    return out
+
+def _status_cache_get(uid: int):
+    with _STATUS_CACHE_LOCK:
+        item = _STATUS_CACHE.get(uid)
+        if item is not None and (now_ts() - item[0]) < STATUS_CACHE_TTL_SEC:
+            _STATUS_CACHE.move_to_end(uid)
+            _STATUS_CACHE_STATS["hits"] += 1
+            return item[1]
+        if item is not None:
+            _STATUS_CACHE.pop(uid, None)
+        _STATUS_CACHE_STATS["misses"] += 1
+        return None
+
+def _status_cache_put(uid: int, parts, epoch: int):
+    with _STATUS_CACHE_LOCK:
+        if _STATUS_CACHE_EPOCH[0] != epoch:
+            return
+        _STATUS_CACHE[uid] = (now_ts(), parts)
+        _STATUS_CACHE.move_to_end(uid)
+        while len(_STATUS_CACHE) > STATUS_CACHE_MAX:
+            _STATUS_CACHE.popitem(last=False)
+
+def _dedup_keep_order(items: List[str]) -> List[str]:
+    seen = set()
+    out: List[str] = []
+    for it in items:
+        it = str(it or "").strip()
+        if not it or it in seen:
+            continue
+        seen.add(it)
+        out.append(it)
+    return out
 
 def compute_status(uid: int) -> str:
+    uid = int(uid)
+    parts = _status_cache_get(uid)
+    if parts is None:
+        epoch = _status_cache_epoch()
+        parts = _compute_status_parts(uid)
+        if parts is None:
+            return "-"
+        _status_cache_put(uid, parts, epoch)
+
+    demon, head, tail = parts
+    if demon:
+        return "ĐĒʋÍ£" + (", " + ", ".join(head) if head else "")
+
+    statuses: List[str] = list(head)
+
+    # богатейший/нищета
+    try:
+        first = top_uids(1)
+        if first and uid == first[0]:
+            statuses.append("Богатейший человек")
+        if uid == top_last_uid():
+            statuses.append("Сама нищета")
+    except Exception:
+        pass
+
+    statuses.extend(tail)
+    statuses = _dedup_keep_order(statuses)
+    return ", ".join(statuses) if statuses else "Без статуса"
+
+def _compute_status_parts(uid: int):
+    """
+    Всё, что не зависит от чужих балансов: (demon, статусы до места в топе, статусы после).
+    """
     u = get_user(uid)
     if not u:
-        return "-"
+        return None
 
     uid = int(uid)
     bal = int(u[5] or 0)
     demon = int(u[7] or 0)
 
-    def _dedup_keep_order(items: List[str]) -> List[str]:
-        seen = set()
-        out: List[str] = []
-        for it in items:
-            it = str(it or "").strip()
-            if not it or it in seen:
-                continue
-            seen.add(it)
-            out.append(it)
-        return out
-
     statuses: List[str] = []
 
     # админ / владелец бота
@@ -2380,8 +5059,7 @@ def compute_status(uid: int) -> str:
 
     # демон
     if demon == 1:
-        statuses = _dedup_keep_order(statuses)
-        return "ĐĒʋÍ£" + (", " + ", ".join(statuses) if statuses else "")
+        return (True, tuple(_dedup_keep_order(statuses)), ())
 
     # капитал
     if bal >= 2_000_000_000_00:
@@ -2412,18 +5090,8 @@ def compute_status(uid: int) -> str:
     except Exception:
         pass
 
-    # богатейший/нищета
-    try:
-        rows = db_all("SELECT user_id FROM users WHERE demon=0", ())
-        uids = [int(x[0]) for x in rows]
-        if uids:
-            uids.sort(key=lambda x: top_value_cents(x), reverse=True)
-            if uid == uids[0]:
-                statuses.append("Богатейший человек")
-            if uid == uids[-1]:
-                statuses.append("Сама нищета")
-    except Exception:
-        pass
+    head = tuple(statuses)
+    statuses = []
 
     # Вечный узник: раб > полугода
     if is_slave(uid):
@@ -2448,20 +5116,28 @@ def compute_status(uid: int) -> str:
             SELECT 1
             FROM games g
             JOIN game_results gr ON gr.game_id=g.game_id
+            WHERE g.game_type='cross'
+              AND g.state='finished'
+              AND COALESCE(g.cross_round,0) >= 9
+              AND gr.user_id=?
+              AND COALESCE(gr.delta_cents,0) <= ?
+            UNION ALL
+            SELECT 1
+            FROM games_archive g
+            JOIN game_results_archive gr ON gr.game_id=g.game_id
             WHERE g.game_type='cross'
               AND g.state='finished'
               AND COALESCE(g.cross_round,0) >= 9
               AND gr.user_id=?
               AND COALESCE(gr.delta_cents,0) <= ?
             LIMIT 1
-        """, (uid, -1_000_000 * 100))
+        """, (uid, -1_000_000 * 100, uid, -1_000_000 * 100))
         if r:
             statuses.append("Ломаный рот этой рулетки")
     except Exception:
         pass
 
-    statuses = _dedup_keep_order(statuses)
-    return ", ".join(statuses) if statuses else "Без статуса"
+    return (False, head, tuple(statuses))
 
 def get_demon_streak(uid: int) -> int:
     r = db_one("SELECT COALESCE(streak,0) FROM demon_streak WHERE user_id=?", (int(uid),))
@@ -2479,6 +5155,7 @@ def set_demon_streak(uid: int, new_streak: int):
         (uid, new_streak, best, ts),
         commit=True
     )
+    status_cache_invalidate(uid)
 
 def update_demon_streak_after_game(game_id: str):
     """
@@ -2668,7 +5345,7 @@ def _shop_catalog_regen(uid: int) -> List[str]:
 
     random.shuffle(keys)
     picks = keys[:min(SHOP_CATALOG_SIZE, len(keys))]
-    cur.execute(
+    db_exec(
         """INSERT INTO shop_catalog (user_id, cycle_start_ts, keys_csv)
            VALUES (?,?,?)
            ON CONFLICT(user_id) DO UPDATE SET
@@ -2676,8 +5353,8 @@ def _shop_catalog_regen(uid: int) -> List[str]:
              keys_csv=excluded.keys_csv
         """,
         (uid, now_ts(), ",".join(picks)),
+        commit=True
     )
-    conn.commit()
     return picks
 
 def get_shop_catalog(uid: int) -> List[str]:
@@ -2716,12 +5393,11 @@ def shop_get_qty(uid: int, key: str) -> int:
 
 def shop_set_qty(uid: int, key: str, qty: int):
     qty = max(0, int(qty))
-    cur.execute("""
+    db_exec("""
     INSERT INTO shop_inv (user_id, item_key, qty)
     VALUES (?,?,?)
     ON CONFLICT(user_id, item_key) DO UPDATE SET qty=excluded.qty
-    """, (uid, key, qty))
-    conn.commit()
+    """, (uid, key, qty), commit=True)
 
 def shop_get_active(uid: int) -> dict:
     cur.execute("SELECT item_key, remaining_games FROM shop_active WHERE user_id=?", (uid,))
@@ -2822,16 +5498,16 @@ def render_zero_boosts_inline(active: dict) -> str:
     return "Усиления: " + " ".join(icons)
 
 def shop_set_active(uid: int, key: str, remaining: int):
+    # зовётся из расчёта игры (shop_tick_after_game) внутри db_tx — коммитит внешний блок
     remaining = int(remaining)
     if remaining <= 0:
-        cur.execute("DELETE FROM shop_active WHERE user_id=? AND item_key=?", (uid, key))
+        db_exec("DELETE FROM shop_active WHERE user_id=? AND item_key=?", (uid, key), commit=True)
     else:
-        cur.execute("""
+        db_exec("""
         INSERT INTO shop_active (user_id, item_key, remaining_games)
         VALUES (?,?,?)
         ON CONFLICT(user_id, item_key) DO UPDATE SET remaining_games=excluded.remaining_games
-        """, (uid, key, remaining))
-    conn.commit()
+        """, (uid, key, remaining), commit=True)
 
 def shop_get_bound_game(uid: int) -> str | None:
     row = db_one("SELECT game_id FROM shop_bind WHERE user_id=?", (uid,))
@@ -2864,20 +5540,21 @@ def shop_bind_players_for_game(game_id: str):
 
 SHOP_BIND_STALE_SEC = 20 * 60  # 20 минут: старые лобби считаем зависшими для привязки активок
 
+USER_ACTIVE_GAMES_SQL = """
+    SELECT g.game_id, g.state, g.created_ts
+      FROM games g
+      JOIN game_players gp ON gp.game_id=g.game_id
+     WHERE gp.user_id=?
+       AND g.state NOT IN ('finished','cancelled')
+     ORDER BY g.created_ts ASC
+"""
+
 def shop_get_earliest_active_game(uid: int) -> str | None:
     """
     Возвращает самую раннюю активную игру пользователя для привязки усилений,
     но игнорирует "зависшие" лобби (старые lobby), которые часто остаются в БД и блокируют привязку.
     """
-    rows = db_all(
-        """SELECT g.game_id, g.state, g.created_ts
-             FROM games g
-             JOIN game_players gp ON gp.game_id=g.game_id
-            WHERE gp.user_id=?
-              AND g.state NOT IN ('finished','cancelled')
-            ORDER BY g.created_ts ASC""",
-        (uid,)
-    )
+    rows = db_all(USER_ACTIVE_GAMES_SQL, (uid,))
     if not rows:
         return None
 
@@ -2888,1023 +5565,684 @@ def shop_get_earliest_active_game(uid: int) -> str | None:
         except Exception:
             created_ts = 0
 
-        if state == "lobby" and created_ts and (now - created_ts) > SHOP_BIND_STALE_SEC:
-            continue
-
-        return str(game_id)
-
-    return None
-
-def shop_get_active_for_game(uid: int, game_id: str) -> dict:
-    """
-    Активные эффекты магазина, применяемые ТОЛЬКО к привязанной игре.
-
-    Дополнительно:
-    - фильтруем предметы по типу игры (в Зеро не работают клевер/магнит/вино/перец; в рулетке не работают зеро-фишки)
-    - если привязка указывает на "зависшее" старое lobby — очищаем её и даём привязаться к текущей игре.
-    """
-    active = shop_get_active(uid)
-    if not active:
-        return {}
-
-    gt = db_one("SELECT COALESCE(game_type,'roulette') FROM games WHERE game_id=?", (str(game_id),))
-    game_type = (gt[0] if gt else "roulette") or "roulette"
-    allowed = shop_allowed_items_for_game_type(str(game_type))
-
-    def _filter(d: dict) -> dict:
-        out = {}
-        for k, v in (d or {}).items():
-            try:
-                vv = int(v or 0)
-            except Exception:
-                vv = 0
-            if vv > 0 and k in allowed:
-                out[k] = vv
-        return out
-
-    now = int(time.time())
-    bound = shop_get_bound_game(uid)
-
-    if bound:
-        row = db_one("SELECT state, created_ts FROM games WHERE game_id=?", (bound,))
-        if not row:
-            shop_clear_bind(uid)
-            bound = None
-        else:
-            state, created_ts = row[0], row[1]
-            try:
-                created_ts = int(created_ts or 0)
-            except Exception:
-                created_ts = 0
-
-            if state in ("finished", "cancelled"):
-                shop_clear_bind(uid)
-                bound = None
-
-            elif state == "lobby" and created_ts and (now - created_ts) > SHOP_BIND_STALE_SEC:
-                shop_clear_bind(uid)
-                bound = None
-
-    if bound:
-        return _filter(active) if bound == game_id else {}
-
-    earliest = shop_get_earliest_active_game(uid)
-    if earliest and earliest == game_id:
-        shop_bind_to_game(uid, game_id)
-        return _filter(active)
-
-    return {}
-
-def shop_buy(uid: int, key: str) -> tuple[bool, str]:
-    if key not in SHOP_ITEMS:
-        return False, "Товар не найден."
-
-    if key == "paket" and is_slave(uid):
-        return False, "Этот товар недоступен для рабов."
-
-    item = SHOP_ITEMS[key]
-    have = shop_get_qty(uid, key)
-    if have >= item["max_qty"]:
-        return False, "У тебя уже максимальное количество этого предмета."
-
-    u = get_user(uid)
-    if not u or not u[2]:
-        return False, "Нет анкеты."
-
-    bal = int(u[5] or 0)
-    price, price_steps = shop_dynamic_price_cents(uid, key, bal)
-    if bal < price:
-        return False, f"Недостаточно средств. Необходимо {cents_to_money_str(price)}$"
-
-    add_balance(uid, -price)
-    shop_set_qty(uid, key, have + 1)
-    return True, "Покупка прошла успешно."
-
-def shop_activate(uid: int, key: str) -> tuple[bool, str]:
-    if key not in SHOP_ITEMS:
-        return False, "Товар не найден."
-
-    if key == "paket" and is_slave(uid):
-        return False, "Этот товар недоступен для рабов."
-
-    left = shop_item_cooldown_left(uid, key)
-    if left > 0:
-        nxt = shop_get_item_next_ts(uid, key)
-        nxt_txt = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(int(nxt)))
-        return False, f"Следующая активация через <b>{_format_duration(left)}</b> (<b>{nxt_txt}</b>)."
-
-    item = SHOP_ITEMS[key]
-    have = int(shop_get_qty(uid, key) or 0)
-    if have <= 0:
-        return False, "У тебя нет этого предмета."
-
-    active = shop_get_active(uid)
-    active_now = int(active.get(key, 0) or 0)
-
-    if key in SHOP_STACKABLE_ZERO_ITEMS:
-        if active_now >= SHOP_STACK_MAX:
-            cd = int(SHOP_ITEM_COOLDOWN_SEC.get(key, 0) or 0)
-            if cd > 0 and shop_item_cooldown_left(uid, key) <= 0:
-                shop_set_item_next_ts(uid, key, now_ts() + cd)
-            return False, "Достигнут максимальный стак этого эффекта."
-
-        free_slots = max(0, SHOP_STACK_MAX - active_now)
-        to_consume = min(have, free_slots, SHOP_STACK_MAX)
-
-        if to_consume <= 0:
-            return False, "Нечего активировать."
-
-        new_stack = active_now + to_consume
-
-        shop_set_qty(uid, key, have - to_consume)
-        shop_set_active(uid, key, new_stack)
-
-        if new_stack >= SHOP_STACK_MAX:
-            cd = int(SHOP_ITEM_COOLDOWN_SEC.get(key, 0) or 0)
-            if cd > 0:
-                shop_set_item_next_ts(uid, key, now_ts() + cd)
-
-        return True, (
-            f"Активировано. Списано: {to_consume}. "
-            f"Текущий стак: {new_stack}/{SHOP_STACK_MAX}."
-        )
-
-    if key in active and active_now > 0:
-        return False, "Этот эффект уже активен."
-
-    shop_set_qty(uid, key, have - 1)
-    shop_set_active(uid, key, int(item["duration_games"]))
-
-    if key in ("insurance", "paket"):
-        cd = int(SHOP_ITEM_COOLDOWN_SEC.get(key, 0) or 0)
-        if cd > 0:
-            shop_set_item_next_ts(uid, key, now_ts() + cd)
-
-    return True, f"Активировано на {item['duration_games']} игр."
-
-def shop_mark_used(uid: int, game_id: str, item_key: str):
-    db_exec(
-        "INSERT OR REPLACE INTO shop_used (user_id, game_id, item_key, used_ts) VALUES (?,?,?,?)",
-        (int(uid), str(game_id), str(item_key), int(time.time())),
-        commit=True
-    )
-
-def shop_is_used(uid: int, game_id: str, item_key: str) -> bool:
-    r = db_one(
-        "SELECT 1 FROM shop_used WHERE user_id=? AND game_id=? AND item_key=?",
-        (int(uid), str(game_id), str(item_key))
-    )
-    return bool(r)
-
-def shop_clear_used(uid: int, game_id: str):
-    db_exec(
-        "DELETE FROM shop_used WHERE user_id=? AND game_id=?",
-        (int(uid), str(game_id)),
-        commit=True
-    )
-
-def shop_tick_after_game(uid: int, game_id: str):
-    """
-    Списываем 1 'игру' со всех активных эффектов пользователя ТОЛЬКО если они были привязаны к этой игре.
-
-    Дополнительно: списываем только те предметы, которые реально работают в данном типе игры.
-    Для insurance/paket списываем только если эффект реально сработал в этой игре.
-    """
-    bound = shop_get_bound_game(uid)
-    if not bound or bound != game_id:
-        return
-
-    gt = db_one("SELECT COALESCE(game_type,'roulette') FROM games WHERE game_id=?", (str(game_id),))
-    game_type = (gt[0] if gt else "roulette") or "roulette"
-    allowed = shop_allowed_items_for_game_type(str(game_type))
-
-    active = shop_get_active(uid)
-    if not active:
-        shop_clear_bind(uid)
-        return
-
-    for k, rem in list(active.items()):
-        if k not in allowed:
-            continue
-
-        if k in ("insurance", "paket"):
-            if not shop_is_used(uid, game_id, k):
-                continue
-            shop_set_active(uid, k, int(rem) - 1)
-            continue
-
-        if k in SHOP_STACKABLE_ZERO_ITEMS:
-            shop_set_active(uid, k, 0)
+        if state == "lobby" and created_ts and (now - created_ts) > SHOP_BIND_STALE_SEC:
             continue
 
-        shop_set_active(uid, k, int(rem) - 1)
+        return str(game_id)
 
-    shop_clear_bind(uid)
-    shop_clear_used(uid, game_id)
+    return None
 
-def shop_menu_text(uid: int) -> str:
-    u = get_user(uid)
-    bal = int(u[5] or 0) if u else 0
-    price_steps = shop_price_steps_for_balance(bal)
-    price_markup = price_steps * SHOP_PRICE_STEP_ADD_PCT
+def shop_get_active_for_game(uid: int, game_id: str) -> dict:
+    """
+    Активные эффекты магазина, применяемые ТОЛЬКО к привязанной игре.
 
+    Дополнительно:
+    - фильтруем предметы по типу игры (в Зеро не работают клевер/магнит/вино/перец; в рулетке не работают зеро-фишки)
+    - если привязка указывает на "зависшее" старое lobby — очищаем её и даём привязаться к текущей игре.
+    """
     active = shop_get_active(uid)
+    if not active:
+        return {}
 
-    act_lines = []
-    for k, rem in active.items():
-        title = SHOP_ITEMS.get(k, {}).get("title", k)
-        if k in SHOP_STACKABLE_ZERO_ITEMS:
-            act_lines.append(f"• {html_escape(title)} - стак <b>{rem}</b>/<b>{SHOP_STACK_MAX}</b>")
-        else:
-            act_lines.append(f"• {html_escape(title)} - осталось <b>{rem}</b> игр")
-    act_block = "\n".join(act_lines) if act_lines else "Нет"
+    gt = db_one("SELECT COALESCE(game_type,'roulette') FROM games WHERE game_id=?", (str(game_id),))
+    game_type = (gt[0] if gt else "roulette") or "roulette"
+    allowed = shop_allowed_items_for_game_type(str(game_type))
 
-    return (
-        f"<b><u>Магазин улучшений</u></b>\n\n"
-        f"Ваш капитал: <b>{cents_to_money_str(bal)}</b>$\n"
-        f"Надбавка к цене: <b>+{price_markup}%</b>\n\n"
-        f"Активные эффекты:\n{act_block}\n\n"
-        f"Выбери товар:"
-    )
+    def _filter(d: dict) -> dict:
+        out = {}
+        for k, v in (d or {}).items():
+            try:
+                vv = int(v or 0)
+            except Exception:
+                vv = 0
+            if vv > 0 and k in allowed:
+                out[k] = vv
+        return out
 
-def shop_menu_kb(uid: int) -> InlineKeyboardMarkup:
-    kb = InlineKeyboardMarkup(row_width=3)
-    btns: list[InlineKeyboardButton] = []
-    for key in get_shop_catalog(uid):
-        item = SHOP_ITEMS[key]
-        have = shop_get_qty(uid, key)
-        btns.append(InlineKeyboardButton(
-            f"{item['title']} ×{have}",
-            callback_data=cb_pack(f"shop:item:{key}", uid)
-        ))
+    now = int(time.time())
+    bound = shop_get_bound_game(uid)
 
-    if btns:
-        kb.add(*btns)
-    return kb
+    if bound:
+        row = db_one("SELECT state, created_ts FROM games WHERE game_id=?", (bound,))
+        if not row:
+            shop_clear_bind(uid)
+            bound = None
+        else:
+            state, created_ts = row[0], row[1]
+            try:
+                created_ts = int(created_ts or 0)
+            except Exception:
+                created_ts = 0
 
-def shop_item_text(uid: int, key: str) -> str:
-    item = SHOP_ITEMS[key]
-    have = shop_get_qty(uid, key)
-    active = shop_get_active(uid)
-    rem = active.get(key, 0)
+            if state in ("finished", "cancelled"):
+                shop_clear_bind(uid)
+                bound = None
 
-    u = get_user(uid)
-    bal = int(u[5] or 0) if u else 0
-    price, price_steps = shop_dynamic_price_cents(uid, key, bal)
-    markup_line = (f"Надбавка к цене: <b>+{price_steps * SHOP_PRICE_STEP_ADD_PCT}%</b>\n" if price_steps > 0 else "")
+            elif state == "lobby" and created_ts and (now - created_ts) > SHOP_BIND_STALE_SEC:
+                shop_clear_bind(uid)
+                bound = None
 
-    cooldown_line = ""
-    cd_txt = shop_item_cooldown_text(uid, key)
-    if cd_txt:
-        cooldown_line = cd_txt + "\n"
+    if bound:
+        return _filter(active) if bound == game_id else {}
 
-    warn = ""
-    if key == "paket" and is_slave(uid):
-        warn = "\n<b>Недоступно для рабов.</b>\n"
+    earliest = shop_get_earliest_active_game(uid)
+    if earliest and earliest == game_id:
+        shop_bind_to_game(uid, game_id)
+        return _filter(active)
 
-    return (
-        f"{html_escape(item['title'])}\n\n"
-        f"{html_escape(item['desc'])}\n"
-        f"{warn}\n"
-        f"Цена: <b>{cents_to_money_str(int(price))}</b>$\n"
-        f"{markup_line}"
-        f"Количество: <b>{have}</b> из <b>{item['max_qty']}</b>\n"
-        f"{cooldown_line}"
-        f"{f'Активный стак: <b>{rem}</b> из <b>{SHOP_STACK_MAX}</b>' if key in SHOP_STACKABLE_ZERO_ITEMS else f'Активен: <b>{rem}</b> игр'}"
-    )
+    return {}
 
-def shop_item_kb(uid: int, key: str) -> InlineKeyboardMarkup:
-    kb = InlineKeyboardMarkup()
+def shop_buy(uid: int, key: str) -> tuple[bool, str]:
+    if key not in SHOP_ITEMS:
+        return False, "Товар не найден."
 
     if key == "paket" and is_slave(uid):
-        kb.add(InlineKeyboardButton("Назад", callback_data=cb_pack("shop:open", uid)))
-        return kb
-
-    kb.add(InlineKeyboardButton("Купить", callback_data=cb_pack(f"shop:buy:{key}", uid)))
-
-    qty = int(shop_get_qty(uid, key) or 0)
-    active_now = int(shop_get_active(uid).get(key, 0) or 0)
-    can_activate = False
-
-    if qty > 0:
-        # Для красной/чёрной фишек разрешаем дожимать стак до 3
-        if key in SHOP_STACKABLE_ZERO_ITEMS:
-            can_activate = (active_now < SHOP_STACK_MAX)
-            if can_activate and shop_item_cooldown_left(uid, key) > 0:
-                can_activate = False
-        else:
-            can_activate = (active_now <= 0)
-            if can_activate and key in ("insurance", "paket"):
-                if shop_item_cooldown_left(uid, key) > 0:
-                    can_activate = False
-
-    if can_activate:
-        kb.add(InlineKeyboardButton("Активировать", callback_data=cb_pack(f"shop:act:{key}", uid)))
-
-    kb.add(InlineKeyboardButton("Назад", callback_data=cb_pack("shop:open", uid)))
-    return kb
-# Шанс раба для Страховки и Пакета
-SLAVE_RISK_BASE_PCT = 15 #начальный %
-SLAVE_RISK_STEP_PCT = 10 #добавочный % после каждого использования
-
-def slave_risk_get_pct(uid: int) -> int:
-    row = db_one("SELECT chance_pct FROM enslave_risk WHERE user_id=?", (int(uid),))
-    if not row:
-        slave_risk_reset(uid)
-        return SLAVE_RISK_BASE_PCT
-    try:
-        ch = int(row[0] or SLAVE_RISK_BASE_PCT)
-    except Exception:
-        ch = SLAVE_RISK_BASE_PCT
-    return max(0, min(100, ch))
+        return False, "Этот товар недоступен для рабов."
 
-def slave_risk_set_pct(uid: int, pct: int) -> None:
-    pct = max(0, min(100, int(pct)))
-    db_exec(
-        "INSERT INTO enslave_risk (user_id, chance_pct) VALUES (?,?) "
-        "ON CONFLICT(user_id) DO UPDATE SET chance_pct=excluded.chance_pct",
-        (int(uid), int(pct)),
-        commit=True
-    )
+    item = SHOP_ITEMS[key]
+    have = shop_get_qty(uid, key)
+    if have >= item["max_qty"]:
+        return False, "У тебя уже максимальное количество этого предмета."
 
-def slave_risk_reset(uid: int) -> None:
-    slave_risk_set_pct(uid, SLAVE_RISK_BASE_PCT)
+    u = get_user(uid)
+    if not u or not u[2]:
+        return False, "Нет анкеты."
 
-def slave_risk_bump(uid: int) -> None:
-    slave_risk_set_pct(uid, min(100, slave_risk_get_pct(uid) + SLAVE_RISK_STEP_PCT))
+    bal = int(u[5] or 0)
+    price, price_steps = shop_dynamic_price_cents(uid, key, bal)
+    if bal < price:
+        return False, f"Недостаточно средств. Необходимо {cents_to_money_str(price)}$"
 
-def maybe_make_slave_by_shop_trigger(uid: int, protected_amount_cents: int, game_id: str) -> Optional[int]:
-    """
-    Вызывается только когда сработало 'страхование' или 'алая фишка'
-    (т.е. был проигрыш и предмет реально отработал).
-    Возвращает demon_id если рабство назначено, иначе None.
-    """
-    uid = int(uid)
-    if uid <= 0:
-        return None
+    add_balance(uid, -price, "shop", key)
+    shop_set_qty(uid, key, have + 1)
+    return True, "Покупка прошла успешно."
 
-    
-    if is_slave(uid): # Пока пользователь раб, шанс не накапливается и не срабатывает
-        return None
+def shop_activate(uid: int, key: str) -> tuple[bool, str]:
+    if key not in SHOP_ITEMS:
+        return False, "Товар не найден."
 
-    chance = slave_risk_get_pct(uid)
-    roll = random.randint(1, 100)
+    if key == "paket" and is_slave(uid):
+        return False, "Этот товар недоступен для рабов."
 
-    if roll <= chance:
-        rr = db_one("SELECT user_id FROM users WHERE demon=1 ORDER BY RANDOM() LIMIT 1")
-        if rr:
-            demon_id = int(rr[0] or 0)
-            if demon_id > 0 and demon_id != uid:
-                db_exec("DELETE FROM slavery WHERE slave_id=?", (uid,), commit=True)
-                slavery_add_owner(uid, demon_id, 6000)
-                try:
-                    set_slave_buyout(uid, int(abs(int(protected_amount_cents))) * 25) # назначение цены рабу
-                except Exception:
-                    pass
+    left = shop_item_cooldown_left(uid, key)
+    if left > 0:
+        nxt = shop_get_item_next_ts(uid, key)
+        nxt_txt = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(int(nxt)))
+        return False, f"Следующая активация через <b>{_format_duration(left)}</b> (<b>{nxt_txt}</b>)."
 
-                try:
-                    ensure_daily_mail_row(uid)
-                    _send_mail_prompt(uid, f"asset_slave|{demon_id}", 0)
-                except Exception:
-                    pass
+    item = SHOP_ITEMS[key]
+    have = int(shop_get_qty(uid, key) or 0)
+    if have <= 0:
+        return False, "У тебя нет этого предмета."
 
-                slave_risk_reset(uid)
-                return demon_id
+    active = shop_get_active(uid)
+    active_now = int(active.get(key, 0) or 0)
 
-        slave_risk_bump(uid)
-        return None
+    if key in SHOP_STACKABLE_ZERO_ITEMS:
+        if active_now >= SHOP_STACK_MAX:
+            cd = int(SHOP_ITEM_COOLDOWN_SEC.get(key, 0) or 0)
+            if cd > 0 and shop_item_cooldown_left(uid, key) <= 0:
+                shop_set_item_next_ts(uid, key, now_ts() + cd)
+            return False, "Достигнут максимальный стак этого эффекта."
 
-    slave_risk_bump(uid)
-    return None
+        free_slots = max(0, SHOP_STACK_MAX - active_now)
+        to_consume = min(have, free_slots, SHOP_STACK_MAX)
 
-# WORK / JOBS
-@dataclass
-class JobDef:
-    key: str
-    title: str
-    base_salary_cents: int
-    hours: int
-    success_pct: int
-    fail_texts: List[str]
-    ranks: List[Tuple[int, str]]  
+        if to_consume <= 0:
+            return False, "Нечего активировать."
 
-_jobs_cache: Dict[str, JobDef] = {}
-_jobs_mtime: int = 0
+        new_stack = active_now + to_consume
 
-def _normalize_job_key(s: str) -> str:
-    s = s.strip().lower()
-    s = re.sub(r"\s+", "_", s)
-    s = re.sub(r"[^a-z0-9а-яё_]+", "", s, flags=re.IGNORECASE)
-    return s[:32] or "job"
+        shop_set_qty(uid, key, have - to_consume)
+        shop_set_active(uid, key, new_stack)
 
-def _ensure_jobs_file():
-    if os.path.exists(JOBS_PATH):
-        return
-    sample = """[ Кассир
-Зарплата 120
-Длительность рабочего дня 6
-Шанс на успех 80%
-Опять зависла касса;Клиент устроил скандал;Пересчитали выручку - недостача
-Должности:
-0 - Стажёр
-7 - Кассир
-30 - Старший кассир
-]
+        if new_stack >= SHOP_STACK_MAX:
+            cd = int(SHOP_ITEM_COOLDOWN_SEC.get(key, 0) or 0)
+            if cd > 0:
+                shop_set_item_next_ts(uid, key, now_ts() + cd)
 
-[ Курьер
-Зарплата 90
-Длительность рабочего дня 5
-Шанс на успех 85%
-Попал под дождь и промок;Адрес оказался неверным;Сломался велосипед
-Должности:
-0 - Стажёр
-10 - Курьер
-40 - Опытный курьер
-]
-"""
-    with open(JOBS_PATH, "w", encoding="utf-8") as f:
-        f.write(sample)
+        return True, (
+            f"Активировано. Списано: {to_consume}. "
+            f"Текущий стак: {new_stack}/{SHOP_STACK_MAX}."
+        )
 
-def load_jobs() -> Dict[str, JobDef]:
-    global _jobs_cache, _jobs_mtime
-    _ensure_jobs_file()
+    if key in active and active_now > 0:
+        return False, "Этот эффект уже активен."
 
-    try:
-        mtime = int(os.path.getmtime(JOBS_PATH))
-    except Exception:
-        mtime = 0
+    shop_set_qty(uid, key, have - 1)
+    shop_set_active(uid, key, int(item["duration_games"]))
 
-    if _jobs_cache and mtime == _jobs_mtime:
-        return _jobs_cache
+    if key in ("insurance", "paket"):
+        cd = int(SHOP_ITEM_COOLDOWN_SEC.get(key, 0) or 0)
+        if cd > 0:
+            shop_set_item_next_ts(uid, key, now_ts() + cd)
 
-    txt = ""
-    with open(JOBS_PATH, "r", encoding="utf-8") as f:
-        txt = f.read()
+    return True, f"Активировано на {item['duration_games']} игр."
 
-    blocks = re.findall(r"\[\s*(.*?)\s*\]", txt, flags=re.S)
-    jobs: Dict[str, JobDef] = {}
+def shop_mark_used(uid: int, game_id: str, item_key: str):
+    DB_WRITER.submit(
+        "INSERT OR REPLACE INTO shop_used (user_id, game_id, item_key, used_ts) VALUES (?,?,?,?)",
+        (int(uid), str(game_id), str(item_key), int(time.time())),
+        key=("shop_used", int(uid), str(game_id), str(item_key))
+    )
 
-    for block in blocks:
-        lines = [ln.strip() for ln in block.splitlines() if ln.strip()]
-        if not lines:
-            continue
+def shop_is_used(uid: int, game_id: str, item_key: str) -> bool:
+    DB_WRITER.flush()
+    r = db_one(
+        "SELECT 1 FROM shop_used WHERE user_id=? AND game_id=? AND item_key=?",
+        (int(uid), str(game_id), str(item_key))
+    )
+    return bool(r)
 
-        title = lines[0]
-        key = _normalize_job_key(title)
+def shop_clear_used(uid: int, game_id: str):
+    DB_WRITER.flush()
+    db_exec(
+        "DELETE FROM shop_used WHERE user_id=? AND game_id=?",
+        (int(uid), str(game_id)),
+        commit=True
+    )
 
-        base_salary = 0
-        hours = 0
-        success_pct = 0
-        fail_texts: List[str] = []
-        ranks: List[Tuple[int, str]] = []
+def shop_tick_after_game(uid: int, game_id: str):
+    """
+    Списываем 1 'игру' со всех активных эффектов пользователя ТОЛЬКО если они были привязаны к этой игре.
 
-        in_ranks = False
-        for ln in lines[1:]:
-            if ln.lower().startswith("зарплата"):
-                m = re.search(r"(\d+(?:[.,]\d+)?)", ln)
-                if m:
-                    base_salary = money_to_cents(m.group(1)) or 0
-            elif ln.lower().startswith("длительность"):
-                m = re.search(r"(\d+)", ln)
-                if m:
-                    hours = int(m.group(1))
-            elif ln.lower().startswith("шанс"):
-                m = re.search(r"(\d+)\s*%", ln)
-                if m:
-                    success_pct = max(0, min(100, int(m.group(1))))
-            elif ln.lower().startswith("должности"):
-                in_ranks = True
-            else:
-                if in_ranks:
-                    m = re.match(r"(\d+)\s*-\s*(.+)$", ln)
-                    if m:
-                        ranks.append((int(m.group(1)), m.group(2).strip()))
-                else:
-                    if ";" in ln:
-                        fail_texts.extend([x.strip() for x in ln.split(";") if x.strip()])
-                    else:
-                        fail_texts.append(ln)
+    Дополнительно: списываем только те предметы, которые реально работают в данном типе игры.
+    Для insurance/paket списываем только если эффект реально сработал в этой игре.
+    """
+    bound = shop_get_bound_game(uid)
+    if not bound or bound != game_id:
+        return
 
-        ranks.sort(key=lambda x: x[0])
-        if not ranks:
-            ranks = [(0, "Стажёр")]
+    gt = db_one("SELECT COALESCE(game_type,'roulette') FROM games WHERE game_id=?", (str(game_id),))
+    game_type = (gt[0] if gt else "roulette") or "roulette"
+    allowed = shop_allowed_items_for_game_type(str(game_type))
 
-        if base_salary <= 0 or hours <= 0:
+    active = shop_get_active(uid)
+    if not active:
+        shop_clear_bind(uid)
+        return
+
+    for k, rem in list(active.items()):
+        if k not in allowed:
             continue
 
-        jobs[key] = JobDef(
-            key=key,
-            title=title,
-            base_salary_cents=int(base_salary),
-            hours=int(hours),
-            success_pct=int(success_pct or 75),
-            fail_texts=fail_texts or ["Неудачный рабочий день."],
-            ranks=ranks
-        )
+        if k in ("insurance", "paket"):
+            if not shop_is_used(uid, game_id, k):
+                continue
+            shop_set_active(uid, k, int(rem) - 1)
+            continue
 
-    _jobs_cache = jobs
-    _jobs_mtime = mtime
-    return jobs
+        if k in SHOP_STACKABLE_ZERO_ITEMS:
+            shop_set_active(uid, k, 0)
+            continue
 
-def get_work_stats(uid: int, job_key: str) -> Tuple[int, int, int]:
-    cur.execute("INSERT OR IGNORE INTO work_stats (user_id, job_key) VALUES (?,?)", (uid, job_key))
-    conn.commit()
-    cur.execute("SELECT shifts, days, earned_cents FROM work_stats WHERE user_id=? AND job_key=?", (uid, job_key))
-    r = cur.fetchone()
-    return (int(r[0] or 0), int(r[1] or 0), int(r[2] or 0))
+        shop_set_active(uid, k, int(rem) - 1)
 
-def _rank_for_days(job: JobDef, days: int) -> str:
-    rank = job.ranks[0][1]
-    for need, title in job.ranks:
-        if days >= need:
-            rank = title
+    shop_clear_bind(uid)
+    shop_clear_used(uid, game_id)
+
+def shop_menu_text(uid: int) -> str:
+    u = get_user(uid)
+    bal = int(u[5] or 0) if u else 0
+    price_steps = shop_price_steps_for_balance(bal)
+    price_markup = price_steps * SHOP_PRICE_STEP_ADD_PCT
+
+    active = shop_get_active(uid)
+
+    act_lines = []
+    for k, rem in active.items():
+        title = SHOP_ITEMS.get(k, {}).get("title", k)
+        if k in SHOP_STACKABLE_ZERO_ITEMS:
+            act_lines.append(f"• {html_escape(title)} - стак <b>{rem}</b>/<b>{SHOP_STACK_MAX}</b>")
         else:
-            break
-    return rank
+            act_lines.append(f"• {html_escape(title)} - осталось <b>{rem}</b> игр")
+    act_block = "\n".join(act_lines) if act_lines else "Нет"
 
-def _salary_with_seniority(job: JobDef, days: int) -> int:
-    thresholds = 0
-    for need, _ in job.ranks:
-        if days >= need:
-            thresholds += 1
-    mult = 1.0 + 0.1 * max(0, thresholds - 1)
-    return int(round(job.base_salary_cents * mult))
+    return (
+        f"<b><u>Магазин улучшений</u></b>\n\n"
+        f"Ваш капитал: <b>{cents_to_money_str(bal)}</b>$\n"
+        f"Надбавка к цене: <b>+{price_markup}%</b>\n\n"
+        f"Активные эффекты:\n{act_block}\n\n"
+        f"Выбери товар:"
+    )
 
-def get_current_shift(uid: int):
-    cur.execute("SELECT user_id, job_key, started_ts, ends_ts, salary_full_cents, success_pct FROM work_shift WHERE user_id=?", (uid,))
-    return cur.fetchone()
+def shop_menu_kb(uid: int) -> InlineKeyboardMarkup:
+    kb = InlineKeyboardMarkup(row_width=3)
+    btns: list[InlineKeyboardButton] = []
+    for key in get_shop_catalog(uid):
+        item = SHOP_ITEMS[key]
+        have = shop_get_qty(uid, key)
+        btns.append(InlineKeyboardButton(
+            f"{item['title']} ×{have}",
+            callback_data=cb_pack(f"shop:item:{key}", uid)
+        ))
 
-def start_shift(uid: int, job_key: str) -> Tuple[int, int]:
-    jobs = load_jobs()
-    job = jobs.get(job_key)
-    if not job:
-        raise ValueError("Unknown job")
+    if btns:
+        kb.add(*btns)
+    return kb
 
-    shifts, days, earned = get_work_stats(uid, job_key)
+def shop_item_text(uid: int, key: str) -> str:
+    item = SHOP_ITEMS[key]
+    have = shop_get_qty(uid, key)
+    active = shop_get_active(uid)
+    rem = active.get(key, 0)
 
-    salary_full = _salary_with_seniority(job, days)
-    ends_ts = now_ts() + int(job.hours) * 3600
+    u = get_user(uid)
+    bal = int(u[5] or 0) if u else 0
+    price, price_steps = shop_dynamic_price_cents(uid, key, bal)
+    markup_line = (f"Надбавка к цене: <b>+{price_steps * SHOP_PRICE_STEP_ADD_PCT}%</b>\n" if price_steps > 0 else "")
 
-    cur.execute("""
-    INSERT INTO work_shift (user_id, job_key, started_ts, ends_ts, salary_full_cents, success_pct)
-    VALUES (?,?,?,?,?,?)
-    ON CONFLICT(user_id) DO UPDATE SET
-      job_key=excluded.job_key,
-      started_ts=excluded.started_ts,
-      ends_ts=excluded.ends_ts,
-      salary_full_cents=excluded.salary_full_cents,
-      success_pct=excluded.success_pct
-    """, (uid, job_key, now_ts(), ends_ts, int(salary_full), int(job.success_pct)))
-    conn.commit()
-    return ends_ts, salary_full
+    cooldown_line = ""
+    cd_txt = shop_item_cooldown_text(uid, key)
+    if cd_txt:
+        cooldown_line = cd_txt + "\n"
 
-def finish_shift(uid: int):
-    row = get_current_shift(uid)
-    if not row:
-        return
+    warn = ""
+    if key == "paket" and is_slave(uid):
+        warn = "\n<b>Недоступно для рабов.</b>\n"
 
-    _uid, job_key, started_ts, ends_ts, salary_full_cents, success_pct = row
-    if now_ts() < int(ends_ts):
-        return
+    return (
+        f"{html_escape(item['title'])}\n\n"
+        f"{html_escape(item['desc'])}\n"
+        f"{warn}\n"
+        f"Цена: <b>{cents_to_money_str(int(price))}</b>$\n"
+        f"{markup_line}"
+        f"Количество: <b>{have}</b> из <b>{item['max_qty']}</b>\n"
+        f"{cooldown_line}"
+        f"{f'Активный стак: <b>{rem}</b> из <b>{SHOP_STACK_MAX}</b>' if key in SHOP_STACKABLE_ZERO_ITEMS else f'Активен: <b>{rem}</b> игр'}"
+    )
 
-    jobs = load_jobs()
-    job = jobs.get(job_key)
-    if not job:
-        job = JobDef(job_key, job_key, int(salary_full_cents), 1, int(success_pct), ["Неудача."], [(0, "Стажёр")])
+def shop_item_kb(uid: int, key: str) -> InlineKeyboardMarkup:
+    kb = InlineKeyboardMarkup()
 
-    roll = random.randint(1, 100)
-    success = 1 if roll <= int(success_pct) else 0
-    if success:
-        paid = int(salary_full_cents)
-        text = "Рабочий день прошёл успешно."
-    else:
-        paid = int(round(int(salary_full_cents) * 0.10))
-        text = random.choice(job.fail_texts) if job.fail_texts else "Неудачный день."
+    if key == "paket" and is_slave(uid):
+        kb.add(InlineKeyboardButton("Назад", callback_data=cb_pack("shop:open", uid)))
+        return kb
 
-    paid_after_slave = apply_slave_cut(uid, paid, reason="work")
+    kb.add(InlineKeyboardButton("Купить", callback_data=cb_pack(f"shop:buy:{key}", uid)))
 
-    add_balance(uid, paid_after_slave)
+    qty = int(shop_get_qty(uid, key) or 0)
+    active_now = int(shop_get_active(uid).get(key, 0) or 0)
+    can_activate = False
 
-    cur.execute("""
-    INSERT INTO work_stats (user_id, job_key, shifts, days, earned_cents)
-    VALUES (?,?,?,?,?)
-    ON CONFLICT(user_id, job_key) DO UPDATE SET
-      shifts = work_stats.shifts + 1,
-      days = work_stats.days + 1,
-      earned_cents = work_stats.earned_cents + excluded.earned_cents
-    """, (uid, job_key, 1, 1, int(paid_after_slave)))
-    conn.commit()
+    if qty > 0:
+        # Для красной/чёрной фишек разрешаем дожимать стак до 3
+        if key in SHOP_STACKABLE_ZERO_ITEMS:
+            can_activate = (active_now < SHOP_STACK_MAX)
+            if can_activate and shop_item_cooldown_left(uid, key) > 0:
+                can_activate = False
+        else:
+            can_activate = (active_now <= 0)
+            if can_activate and key in ("insurance", "paket"):
+                if shop_item_cooldown_left(uid, key) > 0:
+                    can_activate = False
 
-    cur.execute("""
-    INSERT INTO work_history (user_id, job_key, started_ts, ends_ts, success, paid_cents, text)
-    VALUES (?,?,?,?,?,?,?)
-    """, (uid, job_key, int(started_ts), int(ends_ts), int(success), int(paid_after_slave), text))
-    conn.commit()
+    if can_activate:
+        kb.add(InlineKeyboardButton("Активировать", callback_data=cb_pack(f"shop:act:{key}", uid)))
 
-    cur.execute("DELETE FROM work_shift WHERE user_id=?", (uid,))
-    conn.commit()
+    kb.add(InlineKeyboardButton("Назад", callback_data=cb_pack("shop:open", uid)))
+    return kb
+# Шанс раба для Страховки и Пакета
+SLAVE_RISK_BASE_PCT = 15 #начальный %
+SLAVE_RISK_STEP_PCT = 10 #добавочный % после каждого использования
 
+def slave_risk_get_pct(uid: int) -> int:
+    row = db_one("SELECT chance_pct FROM enslave_risk WHERE user_id=?", (int(uid),))
+    if not row:
+        slave_risk_reset(uid)
+        return SLAVE_RISK_BASE_PCT
     try:
-        money_s = cents_to_money_str(paid_after_slave)
-        bot.send_message(uid, f"Смена завершена: <b>{html_escape(job.title)}</b>\n{text}\nНачислено на ваш счёт: <b>{money_s}</b>$", parse_mode="HTML")
+        ch = int(row[0] or SLAVE_RISK_BASE_PCT)
     except Exception:
-        pass
-
-def has_work_history(uid: int) -> bool:
-    cur.execute("SELECT 1 FROM work_history WHERE user_id=? LIMIT 1", (uid,))
-    return cur.fetchone() is not None
+        ch = SLAVE_RISK_BASE_PCT
+    return max(0, min(100, ch))
 
-def _format_duration(seconds: int) -> str:
-    seconds = max(0, int(seconds))
-    h = seconds // 3600
-    m = (seconds % 3600) // 60
-    if h <= 0:
-        return f"{m} мин"
-    return f"{h} ч {m} мин"
+def slave_risk_set_pct(uid: int, pct: int) -> None:
+    pct = max(0, min(100, int(pct)))
+    db_exec(
+        "INSERT INTO enslave_risk (user_id, chance_pct) VALUES (?,?) "
+        "ON CONFLICT(user_id) DO UPDATE SET chance_pct=excluded.chance_pct",
+        (int(uid), int(pct)),
+        commit=True
+    )
 
-# ROULETTE (1x3) helpers
-R_EMO = {
-    0: "💀",
-    1: "🍒",
-    2: "🍀",
-    3: "🍋",
-    4: "7⃣",
-    5: "👹",
-}
-# 1x3 шансы на 💀 👹 7⃣ , стандартные 🍒🍀🍋
-R_WEIGHTS_1x3 = [
-    (0, 2),   # 💀
-    (5, 1),   # 👹
-    (4, 4),   # 7⃣
-    (1, 6),   # 🍒
-    (2, 6),   # 🍀
-    (3, 6),   # 🍋
-]
-# 3x3 такие же шансы, как 1x3
-R_WEIGHTS_3x3 = R_WEIGHTS_1x3
-# 3x5 шансы
-R_WEIGHTS_3x5 = [
-    (5, 2),   # 👹
-    (4, 5),   # 7⃣
-    (1, 8),   # 🍒
-    (2, 8),   # 🍀
-    (3, 8),   # 🍋
-    (0, 4),   # 💀
-]
+def slave_risk_reset(uid: int) -> None:
+    slave_risk_set_pct(uid, SLAVE_RISK_BASE_PCT)
 
-def weighted_pick(pairs):
-    total = sum(w for _, w in pairs)
-    r = random.randint(1, total)
-    s = 0
-    for val, w in pairs:
-        s += w
-        if r <= s:
-            return val
-    return pairs[-1][0]
+def slave_risk_bump(uid: int) -> None:
+    slave_risk_set_pct(uid, min(100, slave_risk_get_pct(uid) + SLAVE_RISK_STEP_PCT))
 
-def roulette_weights_for(uid: int, rfmt: str, game_id: str | None = None):
+def maybe_make_slave_by_shop_trigger(uid: int, protected_amount_cents: int, game_id: str) -> Optional[int]:
     """
-    Возвращает модифицированные веса под активные эффекты магазина.
-    Ожидается формат списка: [(code, weight), ...]
-    code: 0..5 (💀🍒🍀🍋7⃣👹)
+    Вызывается только когда сработало 'страхование' или 'алая фишка'
+    (т.е. был проигрыш и предмет реально отработал).
+    Возвращает demon_id если рабство назначено, иначе None.
     """
-    if rfmt == "1x3":
-        base = list(R_WEIGHTS_1x3)
-    elif rfmt == "3x3":
-        base = list(R_WEIGHTS_3x3)
-    else:
-        base = list(R_WEIGHTS_3x5)
-    active = shop_get_active_for_game(uid, game_id) if game_id else shop_get_active(uid)
-
-    mul = {0: 1.0, 1: 1.0, 2: 1.0, 3: 1.0, 4: 1.0, 5: 1.0}
-
-    # Магнит: стандартные 🍒🍀🍋 (1,2,3) +10%
-    if active.get("magnet", 0) > 0:
-        for c in (1, 2, 3):
-            mul[c] *= 1.10
-
-    # Вино: 7⃣ (4) и 💀 (0) +20%
-    if active.get("wine", 0) > 0:
-        mul[4] *= 1.20
-        mul[0] *= 1.20
-
-    out = []
-    for code, w in base:
-        code = int(code)
-        w2 = int(round(float(w) * mul.get(code, 1.0)))
-        out.append((code, max(1, w2)))
-    return out
-
-def apply_fake_clover_to_state(uid: int, rfmt: str, state, game_id: str | None = None):
-    active = shop_get_active_for_game(uid, game_id) if game_id else shop_get_active(uid)
-    if active.get("fake_clover", 0) <= 0:
-        return state
-
-    # выбираем 1 клетку и форсим: 50% 7⃣(4) иначе 💀(0)
-    forced = 4 if random.random() < 0.5 else 0
-
-    if rfmt == "1x3":
-        idx = random.randrange(3)
-        st = list(state)
-        st[idx] = forced
-        return st
+    uid = int(uid)
+    if uid <= 0:
+        return None
 
-    # 3x3 или 3x5
-    rows = len(state)
-    cols = len(state[0]) if rows else 0
-    r = random.randrange(rows)
-    c = random.randrange(cols)
-    st = [list(row) for row in state]
-    st[r][c] = forced
-    return st
+    
+    if is_slave(uid): # Пока пользователь раб, шанс не накапливается и не срабатывает
+        return None
 
-def render_1x3(codes: List[int]) -> str:
-    return "".join(R_EMO[c] for c in codes)
+    chance = slave_risk_get_pct(uid)
+    roll = random.randint(1, 100)
 
-def render_3x3(grid: List[List[int]]) -> str:
-    return "\n".join("".join(R_EMO[c] for c in row) for row in grid)
+    if roll <= chance:
+        rr = db_one("SELECT user_id FROM users WHERE demon=1 ORDER BY RANDOM() LIMIT 1")
+        if rr:
+            demon_id = int(rr[0] or 0)
+            if demon_id > 0 and demon_id != uid:
+                db_exec("DELETE FROM slavery WHERE slave_id=?", (uid,), commit=True)
+                slavery_add_owner(uid, demon_id, 6000)
+                try:
+                    set_slave_buyout(uid, int(abs(int(protected_amount_cents))) * 25) # назначение цены рабу
+                except Exception:
+                    pass
 
-def render_3x5(grid: List[List[int]]) -> str:
-    return "\n".join("".join(R_EMO[c] for c in row) for row in grid)
+                def _mail_asset_slave():
+                    try:
+                        ensure_daily_mail_row(uid)
+                        _send_mail_prompt(uid, f"asset_slave|{demon_id}", 0)
+                    except Exception:
+                        pass
+                db_after_commit(_mail_asset_slave)
 
-def empty_grid_text(fmt: str) -> str:
-    if fmt == "1x3":
-        return "🔲🔲🔲"
-    if fmt == "3x3":
-        return "🔲🔲🔲\n🔲🔲🔲\n🔲🔲🔲"
-    if fmt == "3x5":
-        return "🔲🔲🔲🔲🔲\n🔲🔲🔲🔲🔲\n🔲🔲🔲🔲🔲"
-    return "🔲"
+                slave_risk_reset(uid)
+                return demon_id
 
-def pepper_triggers_demon(state, rfmt: str) -> bool:
-    """Триггер для 'Перца дьявола': 3💀 в 1×3/3×3 (по линии), 5💀 по строке в 3×5."""
-    try:
-        if rfmt == "1x3":
-            return (isinstance(state, list) and len(state) == 3 and all(int(x) == 0 for x in state))
+        slave_risk_bump(uid)
+        return None
 
-        if rfmt == "3x3":
-            g = state
-            if not g or len(g) != 3 or len(g[0]) != 3:
-                return False
-            # строки
-            for r in range(3):
-                if all(int(g[r][c]) == 0 for c in range(3)):
-                    return True
-            # столбцы
-            for c in range(3):
-                if all(int(g[r][c]) == 0 for r in range(3)):
-                    return True
-            # диагонали
-            if all(int(g[i][i]) == 0 for i in range(3)):
-                return True
-            if all(int(g[i][2 - i]) == 0 for i in range(3)):
-                return True
-            return False
+    slave_risk_bump(uid)
+    return None
 
-        if rfmt == "3x5":
-            g = state
-            if not g or len(g) != 3 or len(g[0]) != 5:
-                return False
-            # 5💀 подряд — трактуем как строка из пяти 💀
-            for r in range(3):
-                if all(int(g[r][c]) == 0 for c in range(5)):
-                    return True
-            return False
-    except Exception:
-        return False
+# WORK / JOBS
+@dataclass
+class JobDef:
+    key: str
+    title: str
+    base_salary_cents: int
+    hours: int
+    success_pct: int
+    fail_texts: List[str]
+    ranks: List[Tuple[int, str]]  
 
-    return False
+_jobs_cache: Dict[str, JobDef] = {}
+_jobs_mtime: int = 0
 
-def calc_delta_1x3(codes: List[int], stake_cents: int) -> int:
-    """
-    Возвращает изменение баланса (в центах) за ход.
-    Правила - упрощённо/логично по твоему ТЗ:
-    - если есть 💀: штраф зависит от количества 💀 (1=-2x, 2=-3x, 3=-(всё) и долг -2x) -> долг реализуем позже; сейчас: -5x
-    - 7⃣: если 1 шт -> 1x, 2 -> +2x, 3 -> +3x
-    - 👹: 1 -> 1x, 2 -> +4x, 3 -> +5x
-    - 🍒🍀🍋:
-        3 одинаковых -> +0.1x
-        2 одинаковых рядом -> 0
-        иначе -> -1x
-    """
-    stake = int(stake_cents)
+def _normalize_job_key(s: str) -> str:
+    s = s.strip().lower()
+    s = re.sub(r"\s+", "_", s)
+    s = re.sub(r"[^a-z0-9а-яё_]+", "", s, flags=re.IGNORECASE)
+    return s[:32] or "job"
 
-    skulls = codes.count(0)
-    if skulls > 0:
-        if skulls == 1:
-            return -2 * stake
-        if skulls == 2:
-            return -3 * stake
-        return -5 * stake
-    
-    def is_std(x): return x in (1, 2, 3)
-    if is_std(codes[0]) and is_std(codes[1]) and codes[0] == codes[1]:
-        return 0
-    if is_std(codes[1]) and is_std(codes[2]) and codes[1] == codes[2]:
-        return 0
-    
-    std_adjacent = ((is_std(codes[0]) and is_std(codes[1])) or (is_std(codes[1]) and is_std(codes[2])))
-    sevens = codes.count(4)
-    demons = codes.count(5)
-    if std_adjacent:
-        if sevens == 1 and demons == 0:
-            return 0
-        if demons == 1 and sevens == 0:
-            return 0
+def _ensure_jobs_file():
+    if os.path.exists(JOBS_PATH):
+        return
+    sample = """[ Кассир
+Зарплата 120
+Длительность рабочего дня 6
+Шанс на успех 80%
+Опять зависла касса;Клиент устроил скандал;Пересчитали выручку - недостача
+Должности:
+0 - Стажёр
+7 - Кассир
+30 - Старший кассир
+]
 
-    if sevens > 0:
-        if sevens == 1:
-            return +1 * stake
-        if sevens == 2:
-            return +2 * stake
-        return +3 * stake
+[ Курьер
+Зарплата 90
+Длительность рабочего дня 5
+Шанс на успех 85%
+Попал под дождь и промок;Адрес оказался неверным;Сломался велосипед
+Должности:
+0 - Стажёр
+10 - Курьер
+40 - Опытный курьер
+]
+"""
+    with open(JOBS_PATH, "w", encoding="utf-8") as f:
+        f.write(sample)
 
-    if demons > 0:
-        if demons == 1:
-            return +1 * stake
-        if demons == 2:
-            return +4 * stake
-        return +5 * stake
+def load_jobs() -> Dict[str, JobDef]:
+    global _jobs_cache, _jobs_mtime
+    _ensure_jobs_file()
 
-    if codes[0] == codes[1] == codes[2]:
-        return int(round(1 * stake))
-    if codes[0] == codes[1] or codes[1] == codes[2]:
-        return 0
-    return -1 * stake
+    try:
+        mtime = int(os.path.getmtime(JOBS_PATH))
+    except Exception:
+        mtime = 0
 
-def calc_line_delta_len3(codes: List[int], stake_cents: int) -> int:
-    return calc_delta_1x3(codes, stake_cents)
+    if _jobs_cache and mtime == _jobs_mtime:
+        return _jobs_cache
 
-def calc_delta_3x3(grid: List[List[int]], stake_cents: int) -> int:
-    stake = int(stake_cents)
-    total = 0
+    txt = ""
+    with open(JOBS_PATH, "r", encoding="utf-8") as f:
+        txt = f.read()
 
-    for r in range(3):
-        total += calc_line_delta_len3(grid[r], stake)
+    blocks = re.findall(r"\[\s*(.*?)\s*\]", txt, flags=re.S)
+    jobs: Dict[str, JobDef] = {}
 
-    for c in range(3):
-        col = [grid[r][c] for r in range(3)]
-        total += calc_line_delta_len3(col, stake)
+    for block in blocks:
+        lines = [ln.strip() for ln in block.splitlines() if ln.strip()]
+        if not lines:
+            continue
 
-    d1 = [grid[i][i] for i in range(3)]
-    if d1[0] == d1[1] == d1[2]:
-        total += calc_line_delta_len3(d1, stake)
+        title = lines[0]
+        key = _normalize_job_key(title)
 
-    d2 = [grid[i][2 - i] for i in range(3)]
-    if d2[0] == d2[1] == d2[2]:
-        total += calc_line_delta_len3(d2, stake)
+        base_salary = 0
+        hours = 0
+        success_pct = 0
+        fail_texts: List[str] = []
+        ranks: List[Tuple[int, str]] = []
 
-    return total
+        in_ranks = False
+        for ln in lines[1:]:
+            if ln.lower().startswith("зарплата"):
+                m = re.search(r"(\d+(?:[.,]\d+)?)", ln)
+                if m:
+                    base_salary = money_to_cents(m.group(1)) or 0
+            elif ln.lower().startswith("длительность"):
+                m = re.search(r"(\d+)", ln)
+                if m:
+                    hours = int(m.group(1))
+            elif ln.lower().startswith("шанс"):
+                m = re.search(r"(\d+)\s*%", ln)
+                if m:
+                    success_pct = max(0, min(100, int(m.group(1))))
+            elif ln.lower().startswith("должности"):
+                in_ranks = True
+            else:
+                if in_ranks:
+                    m = re.match(r"(\d+)\s*-\s*(.+)$", ln)
+                    if m:
+                        ranks.append((int(m.group(1)), m.group(2).strip()))
+                else:
+                    if ";" in ln:
+                        fail_texts.extend([x.strip() for x in ln.split(";") if x.strip()])
+                    else:
+                        fail_texts.append(ln)
 
-def _max_run_len(row: List[int], sym: int) -> int:
-    best = 0
-    cur_run = 0
-    for x in row:
-        if x == sym:
-            cur_run += 1
-            best = max(best, cur_run)
-        else:
-            cur_run = 0
-    return best
+        ranks.sort(key=lambda x: x[0])
+        if not ranks:
+            ranks = [(0, "Стажёр")]
 
-def _has_run_len(row: List[int], sym: int, n: int) -> bool:
-    return _max_run_len(row, sym) >= n
+        if base_salary <= 0 or hours <= 0:
+            continue
 
-def _skull_penalty_row5(row: List[int], stake: int) -> int:
-    skulls = row.count(0)
-    if skulls >= 3:
-        if skulls == 3:
-            return -1 * stake
-        if skulls == 4:
-            return -3 * stake
-        # 5 skulls: "минус все и долг"
-        return -5 * stake
+        jobs[key] = JobDef(
+            key=key,
+            title=title,
+            base_salary_cents=int(base_salary),
+            hours=int(hours),
+            success_pct=int(success_pct or 75),
+            fail_texts=fail_texts or ["Неудачный рабочий день."],
+            ranks=ranks
+        )
 
-    # 2 подряд из пяти -> -0.2 ставки
-    if skulls == 2 and _has_run_len(row, 0, 2):
-        return int(round(-0.2 * stake))
+    _jobs_cache = jobs
+    _jobs_mtime = mtime
+    return jobs
 
-    # 1 skull "ничего"
-    return 0
+def get_work_stats(uid: int, job_key: str) -> Tuple[int, int, int]:
+    db_exec("INSERT OR IGNORE INTO work_stats (user_id, job_key) VALUES (?,?)", (uid, job_key), commit=True)
+    r = db_one("SELECT shifts, days, earned_cents FROM work_stats WHERE user_id=? AND job_key=?", (uid, job_key))
+    return (int(r[0] or 0), int(r[1] or 0), int(r[2] or 0))
 
-def calc_row_delta_3x5(row: List[int], stake_cents: int) -> int:
-    stake = int(stake_cents)
+def _rank_for_days(job: JobDef, days: int) -> str:
+    rank = job.ranks[0][1]
+    for need, title in job.ranks:
+        if days >= need:
+            rank = title
+        else:
+            break
+    return rank
 
-    # сначала 💀 (они могут полностью перебить)
-    skull_pen = _skull_penalty_row5(row, stake)
-    if skull_pen != 0:
-        return skull_pen
+def _salary_with_seniority(job: JobDef, days: int) -> int:
+    thresholds = 0
+    for need, _ in job.ranks:
+        if days >= need:
+            thresholds += 1
+    mult = 1.0 + 0.1 * max(0, thresholds - 1)
+    return int(round(job.base_salary_cents * mult))
 
-    # 👹 джекпот/крупные серии
-    if _has_run_len(row, 5, 5):  # 👹👹👹👹👹
-        return 666 * stake
-    if _has_run_len(row, 5, 4):  # 👹 x4
-        return 6 * stake
+def get_current_shift(uid: int):
+    cur.execute("SELECT user_id, job_key, started_ts, ends_ts, salary_full_cents, success_pct FROM work_shift WHERE user_id=?", (uid,))
+    return cur.fetchone()
 
-    # 7⃣ серии
-    if _has_run_len(row, 4, 5):
-        return 5 * stake
-    if _has_run_len(row, 4, 4):
-        return 4 * stake
+def start_shift(uid: int, job_key: str) -> Tuple[int, int]:
+    jobs = load_jobs()
+    job = jobs.get(job_key)
+    if not job:
+        raise ValueError("Unknown job")
 
-    # стандарт 🍒🍀🍋 серии (любой из этих)
-    for sym in (1, 2, 3):
-        if _has_run_len(row, sym, 5):
-            return 2 * stake
-        if _has_run_len(row, sym, 4):
-            return 1 * stake
-        if _has_run_len(row, sym, 3):
-            return int(round(0.5 * stake))
+    with db_tx():
+        shifts, days, earned = get_work_stats(uid, job_key)
 
-    return 0
+        salary_full = _salary_with_seniority(job, days)
+        ends_ts = now_ts() + int(job.hours) * 3600
+
+        db_exec("""
+        INSERT INTO work_shift (user_id, job_key, started_ts, ends_ts, salary_full_cents, success_pct)
+        VALUES (?,?,?,?,?,?)
+        ON CONFLICT(user_id) DO UPDATE SET
+          job_key=excluded.job_key,
+          started_ts=excluded.started_ts,
+          ends_ts=excluded.ends_ts,
+          salary_full_cents=excluded.salary_full_cents,
+          success_pct=excluded.success_pct
+        """, (uid, job_key, now_ts(), ends_ts, int(salary_full), int(job.success_pct)), commit=True)
+    return ends_ts, salary_full
 
-def calc_delta_3x5(grid: List[List[int]], stake_cents: int) -> int:
-    stake = int(stake_cents)
-    total = 0
+def finish_shift(uid: int):
+    row = get_current_shift(uid)
+    if not row:
+        return
 
-    for r in range(3):
-        total += calc_row_delta_3x5(grid[r], stake)
+    _uid, job_key, started_ts, ends_ts, salary_full_cents, success_pct = row
+    if now_ts() < int(ends_ts):
+        return
 
-    for c in range(5):
-        col = [grid[r][c] for r in range(3)]
-        total += calc_line_delta_len3(col, stake)
+    jobs = load_jobs()
+    job = jobs.get(job_key)
+    if not job:
+        job = JobDef(job_key, job_key, int(salary_full_cents), 1, int(success_pct), ["Неудача."], [(0, "Стажёр")])
 
-    for c0 in range(0, 3):
-        d = [grid[0][c0], grid[1][c0+1], grid[2][c0+2]]
-        if d[0] == d[1] == d[2]:
-            total += calc_line_delta_len3(d, stake)
+    roll = random.randint(1, 100)
+    success = 1 if roll <= int(success_pct) else 0
+    if success:
+        paid = int(salary_full_cents)
+        text = "Рабочий день прошёл успешно."
+    else:
+        paid = int(round(int(salary_full_cents) * 0.10))
+        text = random.choice(job.fail_texts) if job.fail_texts else "Неудачный день."
 
-    for c0 in range(2, 5):
-        d = [grid[0][c0], grid[1][c0-1], grid[2][c0-2]]
-        if d[0] == d[1] == d[2]:
-            total += calc_line_delta_len3(d, stake)
+    # выплата, стаж, запись в трудовую и закрытие смены — одной транзакцией;
+    # смену удаляем по ends_ts, чтобы параллельный проход демона не выплатил её второй раз
+    with db_tx():
+        rc, _ = db_exec("DELETE FROM work_shift WHERE user_id=? AND ends_ts=?", (uid, int(ends_ts)), commit=True)
+        if not rc:
+            return
 
-    return total
+        paid_after_slave = credit_income(uid, paid, "work", job_key)
 
-def debt_mult_from_skulls(state, rfmt: str) -> int:
-    """
-    Возвращает множитель долга, если выпал "долговой черепной исход".
-    0 = долга нет.
+        db_exec("""
+        INSERT INTO work_stats (user_id, job_key, shifts, days, earned_cents)
+        VALUES (?,?,?,?,?)
+        ON CONFLICT(user_id, job_key) DO UPDATE SET
+          shifts = work_stats.shifts + 1,
+          days = work_stats.days + 1,
+          earned_cents = work_stats.earned_cents + excluded.earned_cents
+        """, (uid, job_key, 1, 1, int(paid_after_slave)), commit=True)
+
+        db_exec("""
+        INSERT INTO work_history (user_id, job_key, started_ts, ends_ts, success, paid_cents, text)
+        VALUES (?,?,?,?,?,?,?)
+        """, (uid, job_key, int(started_ts), int(ends_ts), int(success), int(paid_after_slave), text), commit=True)
 
-    Условия по твоему ТЗ:
-    - 3×3: любая линия 💀💀💀 (гор/верт/диаг) => долг 2×ставка (вайп + долг)
-    - 3×5: строка 💀×5 => долг 5×ставка (вайп + долг)
-           любая линия 💀💀💀 (вертикаль или диагональ длины 3) => долг 2×ставка (вайп + долг)
-    - 1×3: 💀💀💀 => долг 2×ставка (вайп + долг)
-    """
-    # state может быть list[int] (1x3) или list[list[int]] (3x3/3x5)
     try:
-        if rfmt == "1x3":
-            codes = list(state)
-            return 2 if len(codes) == 3 and codes.count(0) == 3 else 0
+        money_s = cents_to_money_str(paid_after_slave)
+        bot.send_message(uid, f"Смена завершена: <b>{html_escape(job.title)}</b>\n{text}\nНачислено на ваш счёт: <b>{money_s}</b>$", parse_mode="HTML")
+    except Exception:
+        pass
 
-        if rfmt == "3x3":
-            g = state  # 3x3 grid
-            # rows
-            for r in range(3):
-                if g[r][0] == g[r][1] == g[r][2] == 0:
-                    return 2
-            # cols
-            for c in range(3):
-                if g[0][c] == g[1][c] == g[2][c] == 0:
-                    return 2
-            # diags
-            if g[0][0] == g[1][1] == g[2][2] == 0:
-                return 2
-            if g[0][2] == g[1][1] == g[2][0] == 0:
-                return 2
-            return 0
+def has_work_history(uid: int) -> bool:
+    cur.execute("SELECT 1 FROM work_history WHERE user_id=? LIMIT 1", (uid,))
+    return cur.fetchone() is not None
 
-        # 3x5
-        g = state
-        best = 0
+def _format_duration(seconds: int) -> str:
+    seconds = max(0, int(seconds))
+    h = seconds // 3600
+    m = (seconds % 3600) // 60
+    if h <= 0:
+        return f"{m} мин"
+    return f"{h} ч {m} мин"
 
-        # строка из 5 черепов => долг 5x
-        for r in range(3):
-            if all(x == 0 for x in g[r]):
-                best = max(best, 5)
+# ROULETTE helpers (символы, веса и выплаты — в блоке SLOT MATH в начале файла)
+def roulette_weights_for(uid: int, rfmt: str, game_id: str | None = None):
+    """
+    Возвращает модифицированные веса под активные эффекты магазина.
+    Ожидается формат списка: [(code, weight), ...]
+    code: 0..5 (💀🍒🍀🍋7⃣👹)
+    """
+    if rfmt == "1x3":
+        base = list(R_WEIGHTS_1x3)
+    elif rfmt == "3x3":
+        base = list(R_WEIGHTS_3x3)
+    else:
+        base = list(R_WEIGHTS_3x5)
+    active = shop_get_active_for_game(uid, game_id) if game_id else shop_get_active(uid)
+    return roulette_weights_apply(base, active)
 
-        # вертикаль длины 3 => долг 2x
-        for c in range(5):
-            if g[0][c] == g[1][c] == g[2][c] == 0:
-                best = max(best, 2)
+def apply_fake_clover_to_state(uid: int, rfmt: str, state, game_id: str | None = None):
+    active = shop_get_active_for_game(uid, game_id) if game_id else shop_get_active(uid)
+    if active.get("fake_clover", 0) <= 0:
+        return state
+    return fake_clover_apply(rfmt, state)
 
-        # диагонали длины 3 (лево->право)
-        for c0 in range(0, 3):
-            if g[0][c0] == g[1][c0+1] == g[2][c0+2] == 0:
-                best = max(best, 2)
+def render_1x3(codes: List[int]) -> str:
+    return "".join(R_EMO[c] for c in codes)
 
-        # диагонали длины 3 (право->лево)
-        for c0 in range(2, 5):
-            if g[0][c0] == g[1][c0-1] == g[2][c0-2] == 0:
-                best = max(best, 2)
+def render_3x3(grid: List[List[int]]) -> str:
+    return "\n".join("".join(R_EMO[c] for c in row) for row in grid)
 
-        return best
-    except Exception:
-        return 0
+def render_3x5(grid: List[List[int]]) -> str:
+    return "\n".join("".join(R_EMO[c] for c in row) for row in grid)
+
+def empty_grid_text(fmt: str) -> str:
+    if fmt == "1x3":
+        return "🔲🔲🔲"
+    if fmt == "3x3":
+        return "🔲🔲🔲\n🔲🔲🔲\n🔲🔲🔲"
+    if fmt == "3x5":
+        return "🔲🔲🔲🔲🔲\n🔲🔲🔲🔲🔲\n🔲🔲🔲🔲🔲"
+    return "🔲"
 
 #Shop callback
-@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("shop:"))
+@cb_route("shop")
 def on_shop_callbacks(call: CallbackQuery):
     base, owner = cb_unpack(call.data)
     clicker = call.from_user.id
@@ -3968,7 +6306,7 @@ def on_shop_callbacks(call: CallbackQuery):
     bot.answer_callback_query(call.id)
 
 # Credit callback
-@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("credit:"))
+@cb_route("credit")
 def on_credit(call: CallbackQuery):
     base, owner = cb_unpack(call.data)
     uid = call.from_user.id
@@ -4000,7 +6338,7 @@ def on_credit(call: CallbackQuery):
             bot.answer_callback_query(call.id, "Недостаточно средств для выплаты.", show_alert=True)
             return
 
-        add_balance(uid, -due)
+        add_balance(uid, -due, "credit_pay")
 
         remaining = int(loan[9] or 0)
         postponed = int(loan[10] or 0)
@@ -4096,7 +6434,7 @@ def on_credit(call: CallbackQuery):
             bot.answer_callback_query(call.id, "Недостаточно средств для досрочного погашения.", show_alert=True)
             return
 
-        add_balance(uid, -need)
+        add_balance(uid, -need, "credit_close")
         db_exec(
             "UPDATE credit_loans SET status='closed', remaining_cents=0, postponed_cents=0 WHERE user_id=?",
             (uid,),
@@ -4225,7 +6563,7 @@ def on_credit(call: CallbackQuery):
         )
 
         # выдаём кредит
-        add_balance(uid, sum_cents)
+        add_balance(uid, sum_cents, "credit_issue")
 
         edit_inline_or_message(
             call,
@@ -4282,7 +6620,7 @@ def cb_unpack(data: str) -> Tuple[str, Optional[int]]:
             return base, int(tail)
     return data, None
 
-@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("mail:open"))
+@cb_route("mail:open")
 def on_mail_open(call: CallbackQuery):
     base, owner = cb_unpack(call.data)
     uid = call.from_user.id
@@ -4335,7 +6673,7 @@ def on_mail_open(call: CallbackQuery):
         return
 
     if amt_cents > 0:
-        add_balance(uid, amt_cents)
+        add_balance(uid, amt_cents, "mail", kind)
 
     try:
         bot.edit_message_text(text, chat_id=uid, message_id=msg_id, parse_mode="HTML")
@@ -4347,7 +6685,7 @@ def on_mail_open(call: CallbackQuery):
 
     bot.answer_callback_query(call.id)
 
-@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("settings:toggle:"))
+@cb_route("settings:toggle")
 def on_settings_toggle(call: CallbackQuery):
     base, owner = cb_unpack(call.data)
     uid = call.from_user.id
@@ -4376,7 +6714,7 @@ def on_settings_toggle(call: CallbackQuery):
     except Exception:
         bot.answer_callback_query(call.id, "Не удалось обновить настройки.", show_alert=True)
 
-@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("dealpm:"))
+@cb_route("dealpm")
 def on_dealpm_callbacks(call: CallbackQuery):
     base, owner = cb_unpack(call.data)
     uid = call.from_user.id
@@ -4617,33 +6955,416 @@ def _cfg_get(name: str) -> str:
     except Exception:
         return ""
 
-def get_inline_thumb_url(key: str) -> str:
-    key = (key or "").strip().lower()
-    if not key:
-        return ""
+def get_inline_thumb_url(key: str) -> str:
+    key = (key or "").strip().lower()
+    if not key:
+        return ""
+
+    if key in _INLINE_THUMB_URL_CACHE:
+        return _INLINE_THUMB_URL_CACHE.get(key, "") or ""
+
+    varname = _INLINE_THUMB_VARNAMES.get(key, "")
+    if not varname:
+        _INLINE_THUMB_URL_CACHE[key] = ""
+        return ""
+
+    url = _cfg_get(varname)
+    url = _normalize_github_url(url)
+
+    if not (url.startswith("http://") or url.startswith("https://")):
+        url = ""
+
+    _INLINE_THUMB_URL_CACHE[key] = url
+    return url
+
+# INLINE: каждая карточка — отдельный поставщик со своими ключевыми словами.
+# По тексту запроса считаются только те, что могут подойти (голое число — игра и кредит,
+# пустой запрос или незнакомый текст — все). Поставщики делят один контекст запроса
+# и считаются параллельно в небольшом пуле; что не уложилось в бюджет — не попадает в ответ.
+# Пока игрок печатает, каждое нажатие — новый запрос, а показан будет только последний:
+# фильтр хендлера (он идёт в потоке поллинга, по порядку прихода) запоминает последний
+# id запроса на игрока, а устаревшие запросы бросаются в очереди и на границах поставщиков.
+INLINE_POOL_WORKERS = 4
+INLINE_BUDGET_SEC = 2.5
+INLINE_WAIT_SLICE_SEC = 0.1
+INLINE_STATS = {"queries": 0, "built": 0, "skipped": 0, "timeouts": 0, "errors": 0,
+                "superseded": 0, "aborted": 0}
+_INLINE_STATS_LOCK = threading.Lock()
+_INLINE_LATEST: Dict[int, str] = {}
+INLINE_POOL = ThreadPoolExecutor(max_workers=INLINE_POOL_WORKERS, thread_name_prefix="inline")
+
+# (ключ, слова, нужен ли для числа в запросе, функция) в порядке показа
+INLINE_PROVIDERS: List[Tuple[str, Tuple[str, ...], bool, object]] = []
+
+def inline_provider(key: str, words: Tuple[str, ...], on_number: bool = False):
+    """Регистрирует поставщика inline-карточки. Функция получает InlineCtx и возвращает список результатов."""
+    def deco(fn):
+        INLINE_PROVIDERS.append((key, tuple(words), bool(on_number), fn))
+        return fn
+    return deco
+
+def _inline_stat(**kw):
+    with _INLINE_STATS_LOCK:
+        for k, v in kw.items():
+            INLINE_STATS[k] += int(v)
+
+def inline_note_query(q: InlineQuery) -> bool:
+    """Фильтр inline-хендлера: запоминает последний запрос игрока. Всегда True."""
+    try:
+        with _INLINE_STATS_LOCK:
+            _INLINE_LATEST[int(q.from_user.id)] = str(q.id)
+    except Exception:
+        pass
+    return True
+
+def inline_is_stale(uid: int, query_id: str) -> bool:
+    with _INLINE_STATS_LOCK:
+        latest = _INLINE_LATEST.get(int(uid))
+    return latest is not None and latest != str(query_id)
+
+def inline_done(uid: int, query_id: str):
+    """Последний запрос отвечен — запись игрока больше не нужна."""
+    with _INLINE_STATS_LOCK:
+        if _INLINE_LATEST.get(int(uid)) == str(query_id):
+            del _INLINE_LATEST[int(uid)]
+
+@dataclass
+class InlineCtx:
+    uid: int
+    user: tuple
+    query_text: str
+    words: List[str]
+    stake_cents: Optional[int]
+    is_demon: bool
+    life_flag: bool
+    query_id: str = ""
+
+    @property
+    def balance(self) -> int:
+        return int(self.user[5] or 0)
+
+    def stale(self) -> bool:
+        return bool(self.query_id) and inline_is_stale(self.uid, self.query_id)
+
+def inline_build_ctx(uid: int, user: tuple, query_text: str, query_id: str = "") -> InlineCtx:
+    qt_low = (query_text or "").lower()
+    stake_cents = None
+    m = re.search(r"\b(\d+(?:[.,]\d+)?)\b", query_text)
+    if m:
+        stake_cents = money_to_cents(m.group(1))
+    is_demon = bool(user and int(user[7] or 0) == 1)
+    life_flag = is_demon and any(w in qt_low for w in ["жизн", "life"])
+    # если демон пишет только "жизнь" без числа — дефолт 1000$
+    if life_flag and stake_cents is None:
+        stake_cents = 1000 * 100
+    return InlineCtx(
+        uid=uid,
+        user=user,
+        query_text=query_text,
+        words=re.findall(r"[^\W\d_]+", qt_low),
+        stake_cents=stake_cents,
+        is_demon=is_demon,
+        life_flag=life_flag,
+        query_id=query_id,
+    )
+
+def inline_pick_providers(ctx: InlineCtx) -> list:
+    """Поставщики, которые могут подойти под запрос (слово — префикс ключевого или наоборот)."""
+    has_number = ctx.stake_cents is not None
+    picked = []
+    for key, words, on_number, fn in INLINE_PROVIDERS:
+        if has_number and on_number:
+            picked.append((key, fn))
+            continue
+        if any(w.startswith(k) or k.startswith(w) for w in ctx.words for k in words):
+            picked.append((key, fn))
+    if not picked and not has_number:
+        picked = [(key, fn) for key, _, _, fn in INLINE_PROVIDERS]
+    return picked
+
+@inline_provider("game", ("игр", "game", "ставк", "слот", "рулет", "марафон", "зеро", "жизн", "life"), on_number=True)
+def _inline_game(ctx: InlineCtx) -> list:
+    uid = ctx.uid
+    stake_cents = ctx.stake_cents
+    if stake_cents is None:
+        text = "Не думай, что всё так просто. Сделай ставку, введи сумму"
+        return [inline_article("Начать игру", "Сделай свою ставку", text, None, thumb_key="game")]
+    if stake_cents <= 0:
+        text = "Мы не работаем в долг. Сделай ставку, введи сумму"
+        return [inline_article("Начать игру", "Сделай свою ставку", text, None, thumb_key="game")]
+
+    mode = "life:" if ctx.life_flag else ""
+    kb = InlineKeyboardMarkup()
+    kb.add(InlineKeyboardButton(
+        "Слот автомат / Рулетка",
+        callback_data=cb_pack(f"game:start:roulette:{mode}{stake_cents}", uid)
+    ))
+    kb.add(InlineKeyboardButton(
+        "Марафон рулетка",
+        callback_data=cb_pack(f"game:start:cross:{mode}{stake_cents}", uid)
+    ))
+    kb.add(InlineKeyboardButton(
+        "Зеро-рулетка",
+        callback_data=cb_pack(f"game:start:zero:{mode}{stake_cents}", uid)
+    ))
+    game_text = (
+        "<b><u>⟢♣♦ Игры ♥♠⟣</u></b>\n\n"
+        f"Текущая ставка: <b>{cents_to_money_str(stake_cents)}</b>$\n"
+        "Выберите игру:"
+    )
+    return [inline_article("Начать игру", "Выбери игру", game_text, kb, thumb_key="game")]
+
+@inline_provider("work", ("работ", "work", "смен", "ваканс", "труд"))
+def _inline_work(ctx: InlineCtx) -> list:
+    uid = ctx.uid
+    u = ctx.user
+    if not u or not u[2]:
+        return [inline_article(
+            "Работа",
+            "Выбрать вакансию и выйти в смену",
+            "Вас ожидают.",
+            None,
+            thumb_key="work"
+        )]
+
+    sh = get_current_shift(uid)
+    if sh and now_ts() < int(sh[3]):
+        job_key = sh[1]
+        jobs = load_jobs()
+        job = jobs.get(job_key)
+        job_title = job.title if job else job_key
+        left = int(sh[3]) - now_ts()
+        text = (
+            f"Имя: <b>{html_escape(u[2])}</b>" + (f" (@{html_escape(u[1])})" if u[1] else "") +
+            f"\n\nРаботает по вакансии <b>{html_escape(job_title)}</b>\n"
+            f"Вернётся через <b>{_format_duration(left)}</b>"
+        )
+        return [inline_article("Работа", "Текущая смена", text, None, thumb_key="work")]
+
+    jobs = load_jobs()
+    if not jobs:
+        return [inline_article(
+            "Работа",
+            "Выбрать вакансию и выйти в смену",
+            "Файл jobs.txt пуст или сломан.",
+            None,
+            thumb_key="work"
+        )]
+
+    rows = db_all("SELECT job_key, shifts FROM work_stats WHERE user_id=?", (uid,))
+    if not rows:
+        position = "Безработный"
+        seniority_days = 0
+    else:
+        rows2 = [(r[0], int(r[1] or 0)) for r in rows]
+        mx = max(s for _, s in rows2)
+        best = [jk for jk, s in rows2 if s == mx and mx > 0]
+        if len(best) != 1:
+            position = "Разнорабочий"
+        else:
+            jk = best[0]
+            job = jobs.get(jk)
+            _, days, _ = get_work_stats(uid, jk)
+            position = _rank_for_days(job, days) if job else "Работник"
+        seniority_days = sum(get_work_stats(uid, r[0])[1] for r in rows2)
+
+    text = (
+        f"Имя: <b>{html_escape(u[2])}</b>" + (f" (@{html_escape(u[1])})" if u[1] else "") +
+        f"\nСтаж: <b>{seniority_days} дней</b>\n"
+        f"Должность: <b>{html_escape(position)}</b>\n\n"
+        "Выбери сегодняшнюю вакансию:"
+    )
+
+    kb = InlineKeyboardMarkup()
+    job_buttons = []
+    for jk, job in jobs.items():
+        job_buttons.append(
+            InlineKeyboardButton(
+                job.title,
+                callback_data=cb_pack(f"work:pick:{jk}", uid)
+            )
+        )
+    for i in range(0, len(job_buttons), 2):
+        kb.row(*job_buttons[i:i + 2])
+    return [inline_article("Работа", "Выбрать вакансию и выйти в смену", text, kb, thumb_key="work")]
+
+@inline_provider("profile", ("проф", "profile", "стату", "капитал", "контракт"))
+def _inline_profile(ctx: InlineCtx) -> list:
+    uid = ctx.uid
+    u = ctx.user
+    if not u or not u[2]:
+        return [inline_article(
+            "Профиль",
+            "Основная сводка по вашей деятельности в боте",
+            "Вас ожидают.",
+            None,
+            thumb_key="profile"
+        )]
+
+    uid2, uname, short_name, created_ts, contract_ts, bal, gift, demon = u
+    place = (top_place(uid2) or "-") if demon == 0 else "-"
+
+    status = compute_status(uid)
+
+    text = (
+        f"Имя пользователя: <i>{html_escape(short_name)}</i>\n"
+        f"Дата подписания контракта: <b>{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(contract_ts or created_ts or now_ts()))}</b>\n"
+        f"Статус: <b>{html_escape(status)}</b>\n"
+        f"Капитал: <b>{cents_to_money_str(ctx.balance)}</b>$\n"
+        f"Место в топе: <b>{place}</b>"
+    )
+
+    kb = InlineKeyboardMarkup()
+    kb.add(InlineKeyboardButton("Статистика по играм", callback_data=cb_pack("profile:games", uid)))
+    kb.add(InlineKeyboardButton("Контракт", callback_data=cb_pack("profile:contract", uid)))
+    if uid == OWNER_ID:
+        kb.add(InlineKeyboardButton("Команды", callback_data=cb_pack("profile:commands", uid)))
+    if credit_has_active(uid):
+        kb.add(InlineKeyboardButton("Договор по кредиту", callback_data=cb_pack("profile:credit", uid)))
+    if has_work_history(uid):
+        kb.add(InlineKeyboardButton("Трудовая книга", callback_data=cb_pack("profile:workbook", uid)))
+    if owns_slaves(uid):
+        kb.add(InlineKeyboardButton("Список рабов", callback_data=cb_pack("profile:slaves", uid)))
+    if is_slave(uid):
+        kb.add(InlineKeyboardButton("Статус раба", callback_data=cb_pack("profile:slave_status", uid)))
+
+    return [inline_article("Профиль", "Основная сводка по вашей деятельности в боте", text, kb, thumb_key="profile")]
+
+@inline_provider("credit", ("кред", "credit", "долг", "займ", "заем"), on_number=True)
+def _inline_credit(ctx: InlineCtx) -> list:
+    uid = ctx.uid
+    loan = credit_get_active(uid)
+    if loan:
+        text = credit_format_contract(uid, loan, as_active_view=True)
+
+        kb = InlineKeyboardMarkup()
+        kb.add(InlineKeyboardButton("Внести выплату сразу", callback_data=cb_pack("credit:pay", uid)))
+        kb.add(InlineKeyboardButton("Внести всю сумму долга досрочно", callback_data=cb_pack("credit:payfull", uid)))
+
+    else:
+        sum_cents = int(ctx.stake_cents or 0)
+        min_c, max_c, wins = credit_limits_cents(uid)
+
+        if sum_cents <= 0:
+            text = (
+                "Вы указали недостоверную сумму, согласно лимиту.\n"
+                f"Лимит кредита: <b>{cents_to_money_str(min_c)}</b>$ — <b>{cents_to_money_str(max_c)}</b>$.\n"
+                "Повторите свой запрос с учетом лимита.\n\n"
+                "Примечание: за каждые 10 побед мы предоставляем повышенные условия по лимиту."
+            )
+            kb = InlineKeyboardMarkup()
+        else:
+            ok, msg = credit_amount_ok(uid, sum_cents)
+            if not ok:
+                text = (
+                    "<i><u>Кредитная организация НПАО \"G®️eed\"</u></i>\n"
+                    "Номер 7660006213 ОГРН 132066630021\n"
+                    "Предоставление частных кредитных услуг на комфортные сроки под приятные процентные ставки.\n"
+                    f"Запрошено: <b>{cents_to_money_str(sum_cents)}</b>$\n\n"
+                    f"{html_escape(msg)}"
+                )
+                kb = InlineKeyboardMarkup()
+            else:
+                text = (
+                    "<i><u>Кредитная организация НПАО \"G®️eed\"</u></i>\n"
+                    "Номер 7660006213 ОГРН 132066630021\n"
+                    "Предоставление частных кредитных услуг на комфортные сроки под приятные процентные ставки.\n"
+                    f"Желаемая сумма: <b>{cents_to_money_str(sum_cents)}</b>$\n\n"
+                    "Выберите срок погашения кредита:"
+                )
+                kb = InlineKeyboardMarkup()
+                kb.add(InlineKeyboardButton("30 дней", callback_data=cb_pack(f"credit:term:{sum_cents}:30", uid)))
+                kb.add(InlineKeyboardButton("60 дней", callback_data=cb_pack(f"credit:term:{sum_cents}:60", uid)))
+                kb.add(InlineKeyboardButton("90 дней", callback_data=cb_pack(f"credit:term:{sum_cents}:90", uid)))
+
+    return [inline_article("Кредит", "Оформить кредит", text, kb, thumb_key="credit")]
 
-    if key in _INLINE_THUMB_URL_CACHE:
-        return _INLINE_THUMB_URL_CACHE.get(key, "") or ""
+@inline_provider("stats", ("стат", "stat", "топ", "top", "рейтинг", "рабовлад"))
+def _inline_stats(ctx: InlineCtx) -> list:
+    uid = ctx.uid
+    header = "📄<b><u>Статистика</u>\nПо количеству денежного трафика</b>\n\n"
+    lines = []
+    topn = top_uids(STATS_TOP_LIMIT)
+    for i2, uid_top in enumerate(topn, start=1):
+        lines.append(format_user_line(uid_top, i2, uid))
 
-    varname = _INLINE_THUMB_VARNAMES.get(key, "")
-    if not varname:
-        _INLINE_THUMB_URL_CACHE[key] = ""
-        return ""
+    my_place = top_place(uid)
+    if my_place:
+        if my_place > STATS_TOP_LIMIT:
+            lines.append("…")
+            lines.append(format_user_line(uid, my_place, uid))
 
-    url = _cfg_get(varname)
-    url = _normalize_github_url(url)
+    text = header + "\n".join(lines if lines else ["Пусто"])
 
-    if not (url.startswith("http://") or url.startswith("https://")):
-        url = ""
+    kb = stats_kb(uid, "money")
+    return [inline_article(
+        "Статистика",
+        f"Топ {STATS_TOP_LIMIT} по трафику / рабовладельцам",
+        text,
+        kb,
+        thumb_key="stats"
+    )]
 
-    _INLINE_THUMB_URL_CACHE[key] = url
-    return url
+def _inline_run(fn, ctx: InlineCtx):
+    # граница поставщика: устаревший запрос дальше не считаем
+    if ctx.stale():
+        return None
+    return fn(ctx)
+
+def inline_collect(ctx: InlineCtx, budget_sec: float = INLINE_BUDGET_SEC) -> Optional[list]:
+    """
+    Запускает подходящих поставщиков в пуле и собирает то, что успело к сроку, в порядке показа.
+    None — запрос вытеснен более новым того же игрока, отвечать не нужно.
+    """
+    picked = inline_pick_providers(ctx)
+    _inline_stat(queries=1, built=len(picked), skipped=len(INLINE_PROVIDERS) - len(picked))
+    futs = [(key, INLINE_POOL.submit(_inline_run, fn, ctx)) for key, fn in picked]
+    pending = {f for _, f in futs}
+    deadline = time.monotonic() + budget_sec
+    while pending:
+        left = deadline - time.monotonic()
+        if left <= 0:
+            break
+        _, pending = futures_wait(pending, timeout=min(INLINE_WAIT_SLICE_SEC, left))
+        if pending and ctx.stale():
+            break
+    if ctx.stale():
+        for _, fut in futs:
+            fut.cancel()
+        _inline_stat(aborted=1)
+        return None
+
+    results = []
+    for key, fut in futs:
+        if not fut.done():
+            # досчитается в фоне и будет выброшено; следующий запрос начнёт заново
+            fut.cancel()
+            _inline_stat(timeouts=1)
+            continue
+        exc = fut.exception()
+        if exc is not None:
+            _inline_stat(errors=1)
+            send_error_report(f"inline:{key}", exc)
+            continue
+        results.extend(fut.result() or [])
+    return results
 
-@bot.inline_handler(func=lambda q: True)
+@bot.inline_handler(func=inline_note_query)
 def on_inline(q: InlineQuery):
+    uid = q.from_user.id
+    if inline_is_stale(uid, q.id):
+        # пока запрос ждал свободного потока, игрок напечатал следующий
+        _inline_stat(superseded=1)
+        return
+    try:
+        _on_inline(q)
+    finally:
+        inline_done(uid, q.id)
+
+def _on_inline(q: InlineQuery):
     uid = q.from_user.id
     username = getattr(q.from_user, "username", None)
-    upsert_user(uid, username)
+    upsert_user(uid, username, wait=False)
     
     # Бан (inline)
     banned, until_ts, reason = get_ban_info(uid)
@@ -4683,305 +7404,13 @@ def on_inline(q: InlineQuery):
         bot.answer_inline_query(q.id, results, cache_time=0)
         return
 
-    stake_cents = None
-    m = re.search(r"\b(\d+(?:[.,]\d+)?)\b", query_text)
-    if m:
-        stake_cents = money_to_cents(m.group(1))
-
-    u_me = get_user(uid)
-    is_demon_me = bool(u_me and int(u_me[7] or 0) == 1)
-    
-    qt_low = (query_text or "").lower()
-    life_flag = is_demon_me and any(w in qt_low for w in ["жизн", "life"])
-    
-    # если демон пишет только "жизнь" без числа — дефолт 1000$
-    if life_flag and stake_cents is None:
-        stake_cents = 1000 * 100
-
-    # Начать игру  
-    if stake_cents is None:
-        text = "Не думай, что всё так просто. Сделай ставку, введи сумму"
-        results.append(inline_article(
-            "Начать игру",
-            "Сделай свою ставку",
-            text,
-            None,
-            thumb_key="game"
-        ))
-    elif stake_cents <= 0:
-        text = "Мы не работаем в долг. Сделай ставку, введи сумму"
-        results.append(inline_article(
-            "Начать игру",
-            "Сделай свою ставку",
-            text,
-            None,
-            thumb_key="game"
-        ))
-    else:
-        kb = InlineKeyboardMarkup()
-        if life_flag:
-            kb.add(InlineKeyboardButton(
-                "Слот автомат / Рулетка",
-                callback_data=cb_pack(f"game:start:roulette:life:{stake_cents}", uid)
-            ))
-            kb.add(InlineKeyboardButton(
-                "Марафон рулетка",
-                callback_data=cb_pack(f"game:start:cross:life:{stake_cents}", uid)
-            ))
-            kb.add(InlineKeyboardButton(
-                "Зеро-рулетка",
-                callback_data=cb_pack(f"game:start:zero:life:{stake_cents}", uid)
-            ))
-        else:
-            kb.add(InlineKeyboardButton(
-                "Слот автомат / Рулетка",
-                callback_data=cb_pack(f"game:start:roulette:{stake_cents}", uid)
-            ))
-            kb.add(InlineKeyboardButton(
-                "Марафон рулетка",
-                callback_data=cb_pack(f"game:start:cross:{stake_cents}", uid)
-            ))
-            kb.add(InlineKeyboardButton(
-                "Зеро-рулетка",
-                callback_data=cb_pack(f"game:start:zero:{stake_cents}", uid)
-            ))
-        if life_flag:
-            game_text = (
-                "<b><u>⟢♣♦ Игры ♥♠⟣</u></b>\n\n"
-                f"Текущая ставка: <b>{cents_to_money_str(stake_cents)}</b>$\n"
-                "Выберите игру:"
-            )
-        else:
-            game_text = (
-                "<b><u>⟢♣♦ Игры ♥♠⟣</u></b>\n\n"
-                f"Текущая ставка: <b>{cents_to_money_str(stake_cents)}</b>$\n"
-                "Выберите игру:"
-            )
-        results.append(inline_article(
-            "Начать игру",
-            "Выбери игру",
-            game_text,
-            kb,
-            thumb_key="game"
-        ))
-
-    # Работа
-    u = get_user(uid)
-    if not u or not u[2]:
-        results.append(inline_article(
-            "Работа",
-            "Выбрать вакансию и выйти в смену",
-            "Вас ожидают.",
-            None,
-            thumb_key="work"
-        ))
-    else:
-        sh = get_current_shift(uid)
-        if sh and now_ts() < int(sh[3]):
-            job_key = sh[1]
-            jobs = load_jobs()
-            job = jobs.get(job_key)
-            job_title = job.title if job else job_key
-            left = int(sh[3]) - now_ts()
-            text = (
-                f"Имя: <b>{html_escape(u[2])}</b>" + (f" (@{html_escape(u[1])})" if u[1] else "") +
-                f"\n\nРаботает по вакансии <b>{html_escape(job_title)}</b>\n"
-                f"Вернётся через <b>{_format_duration(left)}</b>"
-            )
-            results.append(inline_article(
-                "Работа",
-                "Текущая смена",
-                text,
-                None,
-                thumb_key="work"
-            ))
-        else:
-            jobs = load_jobs()
-            if not jobs:
-                results.append(inline_article(
-                    "Работа",
-                    "Выбрать вакансию и выйти в смену",
-                    "Файл jobs.txt пуст или сломан.",
-                    None,
-                    thumb_key="work"
-                ))
-            else:
-                rows = db_all("SELECT job_key, shifts FROM work_stats WHERE user_id=?", (uid,))
-                if not rows:
-                    position = "Безработный"
-                    seniority_days = 0
-                else:
-                    rows2 = [(r[0], int(r[1] or 0)) for r in rows]
-                    mx = max(s for _, s in rows2)
-                    best = [jk for jk, s in rows2 if s == mx and mx > 0]
-                    if len(best) != 1:
-                        position = "Разнорабочий"
-                    else:
-                        jk = best[0]
-                        job = jobs.get(jk)
-                        _, days, _ = get_work_stats(uid, jk)
-                        position = _rank_for_days(job, days) if job else "Работник"
-                    seniority_days = sum(get_work_stats(uid, r[0])[1] for r in rows2)
-
-                text = (
-                    f"Имя: <b>{html_escape(u[2])}</b>" + (f" (@{html_escape(u[1])})" if u[1] else "") +
-                    f"\nСтаж: <b>{seniority_days} дней</b>\n"
-                    f"Должность: <b>{html_escape(position)}</b>\n\n"
-                    "Выбери сегодняшнюю вакансию:"
-                )
-
-                kb = InlineKeyboardMarkup()
-                job_buttons = []
-                for jk, job in jobs.items():
-                    job_buttons.append(
-                        InlineKeyboardButton(
-                            job.title,
-                            callback_data=cb_pack(f"work:pick:{jk}", uid)
-                        )
-                    )
-                for i in range(0, len(job_buttons), 2):
-                    kb.row(*job_buttons[i:i + 2])
-                results.append(inline_article(
-                    "Работа",
-                    "Выбрать вакансию и выйти в смену",
-                    text,
-                    kb,
-                    thumb_key="work"
-                ))
-
-    # Профиль
-    u = get_user(uid)
-    if not u or not u[2]:
-        results.append(inline_article(
-            "Профиль",
-            "Основная сводка по вашей деятельности в боте",
-            "Вас ожидают.",
-            None,
-            thumb_key="profile"
-        ))
-    else:
-        uid2, uname, short_name, created_ts, contract_ts, bal, gift, demon = u
-        cur.execute("SELECT user_id FROM users WHERE demon=0")
-        uids = [r[0] for r in cur.fetchall()]
-        uids.sort(key=lambda x: top_value_cents(x), reverse=True)
-        place = (uids.index(uid2) + 1) if (demon == 0 and uid2 in uids) else "-"
-
-        status = compute_status(uid)
-
-        text = (
-            f"Имя пользователя: <i>{html_escape(short_name)}</i>\n"
-            f"Дата подписания контракта: <b>{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(contract_ts or created_ts or now_ts()))}</b>\n"
-            f"Статус: <b>{html_escape(status)}</b>\n"
-            f"Капитал: <b>{cents_to_money_str(int(bal or 0))}</b>$\n"
-            f"Место в топе: <b>{place}</b>"
-        )
-
-        kb = InlineKeyboardMarkup()
-        kb.add(InlineKeyboardButton("Статистика по играм", callback_data=cb_pack("profile:games", uid)))
-        kb.add(InlineKeyboardButton("Контракт", callback_data=cb_pack("profile:contract", uid)))
-        if uid == OWNER_ID:
-            kb.add(InlineKeyboardButton("Команды", callback_data=cb_pack("profile:commands", uid)))
-        if credit_has_active(uid):
-            kb.add(InlineKeyboardButton("Договор по кредиту", callback_data=cb_pack("profile:credit", uid)))
-        if has_work_history(uid):
-            kb.add(InlineKeyboardButton("Трудовая книга", callback_data=cb_pack("profile:workbook", uid)))
-        if owns_slaves(uid):
-            kb.add(InlineKeyboardButton("Список рабов", callback_data=cb_pack("profile:slaves", uid)))
-        if is_slave(uid):
-            kb.add(InlineKeyboardButton("Статус раба", callback_data=cb_pack("profile:slave_status", uid)))
-
-        results.append(inline_article(
-            "Профиль",
-            "Основная сводка по вашей деятельности в боте",
-            text,
-            kb,
-            thumb_key="profile"
-        ))
-
-    # Кредит
-    try:
-        loan = credit_get_active(uid)
-        if loan:
-            text = credit_format_contract(uid, loan, as_active_view=True)
-    
-            kb = InlineKeyboardMarkup()
-            kb.add(InlineKeyboardButton("Внести выплату сразу", callback_data=cb_pack("credit:pay", uid)))
-            kb.add(InlineKeyboardButton("Внести всю сумму долга досрочно", callback_data=cb_pack("credit:payfull", uid)))
-        
-        else:
-            sum_cents = int(stake_cents or 0)
-            min_c, max_c, wins = credit_limits_cents(uid)
-
-            if sum_cents <= 0:
-                text = (
-                    "Вы указали недостоверную сумму, согласно лимиту.\n"
-                    f"Лимит кредита: <b>{cents_to_money_str(min_c)}</b>$ — <b>{cents_to_money_str(max_c)}</b>$.\n"
-                    "Повторите свой запрос с учетом лимита.\n\n"
-                    "Примечание: за каждые 10 побед мы предоставляем повышенные условия по лимиту."
-                )
-                kb = InlineKeyboardMarkup()
-            else:
-                ok, msg = credit_amount_ok(uid, sum_cents)
-                if not ok:
-                    text = (
-                        "<i><u>Кредитная организация НПАО \"G®️eed\"</u></i>\n"
-                        "Номер 7660006213 ОГРН 132066630021\n"
-                        "Предоставление частных кредитных услуг на комфортные сроки под приятные процентные ставки.\n"
-                        f"Запрошено: <b>{cents_to_money_str(sum_cents)}</b>$\n\n"
-                        f"{html_escape(msg)}"
-                    )
-                    kb = InlineKeyboardMarkup()
-                else:
-                    text = (
-                        "<i><u>Кредитная организация НПАО \"G®️eed\"</u></i>\n"
-                        "Номер 7660006213 ОГРН 132066630021\n"
-                        "Предоставление частных кредитных услуг на комфортные сроки под приятные процентные ставки.\n"
-                        f"Желаемая сумма: <b>{cents_to_money_str(sum_cents)}</b>$\n\n"
-                        "Выберите срок погашения кредита:"
-                    )
-                    kb = InlineKeyboardMarkup()
-                    kb.add(InlineKeyboardButton("30 дней", callback_data=cb_pack(f"credit:term:{sum_cents}:30", uid)))
-                    kb.add(InlineKeyboardButton("60 дней", callback_data=cb_pack(f"credit:term:{sum_cents}:60", uid)))
-                    kb.add(InlineKeyboardButton("90 дней", callback_data=cb_pack(f"credit:term:{sum_cents}:90", uid)))
-    
-        results.append(inline_article(
-            "Кредит",
-            "Оформить кредит",
-            text,
-            kb,
-            thumb_key="credit"
-        ))
-    except Exception:
-        pass
-
-    # Статистика
-    cur.execute("SELECT user_id FROM users WHERE demon=0")
-    all_uids = [r[0] for r in cur.fetchall()]
-    all_uids.sort(key=lambda u: top_value_cents(u), reverse=True)
-    
-    header = "📄<b><u>Статистика</u>\nПо количеству денежного трафика</b>\n\n"
-    lines = []
-    topn = all_uids[:STATS_TOP_LIMIT]
-    for i2, uid_top in enumerate(topn, start=1):
-        lines.append(format_user_line(uid_top, i2, uid))
-    
-    if uid in all_uids:
-        my_place = all_uids.index(uid) + 1
-        if my_place > STATS_TOP_LIMIT:
-            lines.append("…")
-            lines.append(format_user_line(uid, my_place, uid))
-    
-    text = header + "\n".join(lines if lines else ["Пусто"])
-    
-    kb = stats_kb(uid, "money")
-    results.append(inline_article(
-        "Статистика",
-        f"Топ {STATS_TOP_LIMIT} по трафику / рабовладельцам",
-        text,
-        kb,
-        thumb_key="stats"
-    ))
-
+    ctx = inline_build_ctx(uid, u, query_text, query_id=str(q.id))
+    if ctx.stale():
+        _inline_stat(aborted=1)
+        return
+    results = inline_collect(ctx)
+    if results is None:
+        return
     bot.answer_inline_query(q.id, results, cache_time=0)
 
 # /start
@@ -5045,7 +7474,7 @@ def cmd_settings(message):
     show_settings_menu(message.chat.id, uid, prefer_edit=True)
 
 # REGISTRATION callbacks
-@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("reg:"))
+@cb_route("reg")
 def on_reg_callbacks(call: CallbackQuery):
     base, owner = cb_unpack(call.data)
     clicker = call.from_user.id
@@ -5100,10 +7529,7 @@ def on_reg_callbacks(call: CallbackQuery):
     m.chat.type == "private"
     and m.text
     and not m.text.startswith("/")
-    and db_one(
-        "SELECT 1 FROM report_state WHERE user_id=? AND stage='await_content' LIMIT 1",
-        (int(m.from_user.id),),
-    ) is None
+    and report_get_state(m.from_user.id)[0] != "await_content"
 ))
 def on_private_text(message):
     uid = message.from_user.id
@@ -5233,7 +7659,7 @@ def get_slave_owner_ranking() -> list[tuple[int, int, int]]:
     out.sort(key=lambda x: (x[1], x[2]), reverse=True)
     return out
 
-@bot.callback_query_handler(func=lambda c: c.data and (c.data.startswith("stats:") or c.data.startswith("profile:") or c.data.startswith("work:") or c.data.startswith("game:")))
+@cb_route("stats", "profile", "work", "game")
 def on_main_callbacks(call: CallbackQuery):
     base, owner = cb_unpack(call.data)
     clicker = call.from_user.id
@@ -5253,18 +7679,14 @@ def on_main_callbacks(call: CallbackQuery):
 
     #STATS TOP
     if kind == "stats" and parts[1] == "top":
-        cur.execute("SELECT user_id FROM users WHERE demon=0")
-        all_uids = [r[0] for r in cur.fetchall()]
-        all_uids.sort(key=lambda u: top_value_cents(u), reverse=True)
-    
         header = "📄<b><u>Статистика</u>\nПо количеству денежного трафика</b>\n\n"
         lines = []
-        topn = all_uids[:STATS_TOP_LIMIT]
+        topn = top_uids(STATS_TOP_LIMIT)
         for i, uid in enumerate(topn, start=1):
             lines.append(format_user_line(uid, i, clicker))
     
-        if clicker in all_uids:
-            my_place = all_uids.index(clicker) + 1
+        my_place = top_place(clicker)
+        if my_place:
             if my_place > STATS_TOP_LIMIT:
                 lines.append("…")
                 lines.append(format_user_line(clicker, my_place, clicker))
@@ -5386,10 +7808,7 @@ def on_main_callbacks(call: CallbackQuery):
             return
 
         uid, uname, short_name, created_ts, contract_ts, bal, gift, demon = u
-        cur.execute("SELECT user_id FROM users WHERE demon=0")
-        uids = [r[0] for r in cur.fetchall()]
-        uids.sort(key=lambda x: top_value_cents(x), reverse=True)
-        place = (uids.index(uid) + 1) if (demon == 0 and uid in uids) else "-"
+        place = (top_place(uid) or "-") if demon == 0 else "-"
 
         status = compute_status(uid)
 
@@ -5434,6 +7853,10 @@ def on_main_callbacks(call: CallbackQuery):
             "ㅤ☛ блокировка /blockcash\n"
             "☛ работа /work"
             "☛ чистка чатов /clearpm\n"
+            "☛ производительность /perf\n"
+            "☛ планы запросов /qplan\n"
+            "☛ маршруты кнопок /routes\n"
+            "☛ сверка денег /ledger\n"
         )
 
         kb = InlineKeyboardMarkup()
@@ -6106,7 +8529,7 @@ def on_main_callbacks(call: CallbackQuery):
               origin_chat_id, origin_message_id, origin_inline_id, game_key, 1,
               stake_kind, int(life_demon_id), 0))
         cur.execute("INSERT INTO game_players (game_id, user_id, status) VALUES (?,?,?)", (game_id, clicker, "ready"))
-        conn.commit()
+        db_commit()
 
         schedule_lobby_end(game_id)
 
@@ -6136,7 +8559,7 @@ def on_main_callbacks(call: CallbackQuery):
 
     bot.answer_callback_query(call.id)
 
-@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("buy:"))
+@cb_route("buy")
 def on_buy_callbacks(call: CallbackQuery):
     base, owner = cb_unpack(call.data)
     clicker = call.from_user.id
@@ -6187,7 +8610,7 @@ def on_buy_callbacks(call: CallbackQuery):
 
     if action == "dec":
         cur.execute("UPDATE buy_offer_resp SET status=-1 WHERE offer_id=? AND owner_id=?", (offer_id, clicker))
-        conn.commit()
+        db_commit()
         try:
             bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=None)
         except Exception:
@@ -6203,7 +8626,7 @@ def on_buy_callbacks(call: CallbackQuery):
         sr = cur.fetchone()
         if not sr:
             cur.execute("UPDATE buy_offer_resp SET status=-1 WHERE offer_id=? AND owner_id=?", (offer_id, clicker))
-            conn.commit()
+            db_commit()
             bot.answer_callback_query(call.id, "У тебя уже нет доли за владение рабом.", show_alert=True)
             return
         seller_bp = int(sr[0] or 0)
@@ -6213,12 +8636,11 @@ def on_buy_callbacks(call: CallbackQuery):
         buyer_bal = int(br[0] or 0) if br else 0
         if buyer_bal < price_cents or buyer_bal < 0:
             cur.execute("UPDATE buy_offer_resp SET status=-1 WHERE offer_id=? AND owner_id=?", (offer_id, clicker))
-            conn.commit()
+            db_commit()
             bot.answer_callback_query(call.id, "У покупателя не хватает средств.", show_alert=True)
             return
 
-        add_balance(buyer_id, -price_cents)
-        add_balance(clicker, price_cents)
+        ledger_post([(buyer_id, -price_cents), (clicker, price_cents)], "rebuy", str(offer_id))
 
         cur.execute("DELETE FROM slavery WHERE slave_id=? AND owner_id=?", (slave_id, clicker))
         cur.execute("SELECT share_bp FROM slavery WHERE slave_id=? AND owner_id=?", (slave_id, buyer_id))
@@ -6228,10 +8650,10 @@ def on_buy_callbacks(call: CallbackQuery):
             cur.execute("UPDATE slavery SET share_bp=? WHERE slave_id=? AND owner_id=?", (new_bp, slave_id, buyer_id))
         else:
             cur.execute("INSERT OR IGNORE INTO slavery (slave_id, owner_id, share_bp, earned_cents) VALUES (?,?,?,0)", (slave_id, buyer_id, seller_bp))
-        conn.commit()
+        db_commit()
 
         cur.execute("UPDATE buy_offer_resp SET status=1 WHERE offer_id=? AND owner_id=?", (offer_id, clicker))
-        conn.commit()
+        db_commit()
 
         try:
             bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=None)
@@ -6248,7 +8670,7 @@ def on_buy_callbacks(call: CallbackQuery):
     pending = int(cur.fetchone()[0] or 0)
     if pending == 0:
         cur.execute("UPDATE buy_offers SET active=0 WHERE offer_id=?", (offer_id,))
-        conn.commit()
+        db_commit()
         cur.execute("SELECT COUNT(1) FROM buy_offer_resp WHERE offer_id=? AND status=1", (offer_id,))
         acc = int(cur.fetchone()[0] or 0)
         cur.execute("SELECT COUNT(1) FROM buy_offer_resp WHERE offer_id=? AND status=-1", (offer_id,))
@@ -6334,16 +8756,14 @@ def _buyrab_finalize_if_ready(offer_id: str):
 
             refund = max(0, hold_cents)
             if refund > 0 and buyer_id > 0:
-                c.execute(
-                    "UPDATE users SET balance_cents=COALESCE(balance_cents,0)+? WHERE user_id=?",
-                    (refund, buyer_id),
-                )
+                ledger_post_cur(c, [(buyer_id, refund)], "buyrab_refund", offer_id, counter=LEDGER_ESCROW)
 
             c.execute(
                 "UPDATE buyrab_offers SET hold_cents=0, state=2 WHERE offer_id=?",
                 (offer_id,),
             )
-            conn.commit()
+            db_commit()
+            user_cache_invalidate(buyer_id)
 
             spent = max(0, total_cents - refund)
 
@@ -6372,7 +8792,7 @@ def _buyrab_finalize_if_ready(offer_id: str):
             except Exception:
                 pass
 
-@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("buyrab:"))
+@cb_route("buyrab")
 def on_buyrab_callbacks(call: CallbackQuery):
     base, owner = cb_unpack(call.data)
     clicker = call.from_user.id
@@ -6426,7 +8846,7 @@ def on_buyrab_callbacks(call: CallbackQuery):
                         return
                     c.execute("UPDATE buyrab_offers SET state=-1 WHERE offer_id=?", (offer_id,))
                     c.execute("DELETE FROM buyrab_offer_resp WHERE offer_id=?", (offer_id,))
-                    conn.commit()
+                    db_commit()
 
                     try:
                         bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=None)
@@ -6453,10 +8873,7 @@ def on_buyrab_callbacks(call: CallbackQuery):
                     bot.answer_callback_query(call.id, "Недостаточно средств для оформления сделки.", show_alert=True)
                     return
 
-                c.execute(
-                    "UPDATE users SET balance_cents=COALESCE(balance_cents,0)-? WHERE user_id=?",
-                    (total_cents, buyer_id),
-                )
+                ledger_post_cur(c, [(buyer_id, -total_cents)], "buyrab_hold", offer_id, counter=LEDGER_ESCROW)
                 c.execute(
                     "UPDATE buyrab_offers SET hold_cents=?, state=1 WHERE offer_id=?",
                     (total_cents, offer_id),
@@ -6475,7 +8892,8 @@ def on_buyrab_callbacks(call: CallbackQuery):
                 buyer_name = ur[0] or "Покупатель"
                 buyer_un = ur[1] or ""
 
-                conn.commit()
+                db_commit()
+                user_cache_invalidate(buyer_id)
 
             except Exception as e:
                 try:
@@ -6524,7 +8942,7 @@ def on_buyrab_callbacks(call: CallbackQuery):
                             "UPDATE buyrab_offer_resp SET status=-1 WHERE offer_id=? AND owner_id=? AND status=0",
                             (offer_id, int(oid)),
                         )
-                    conn.commit()
+                    db_commit()
                 except Exception:
                     try:
                         conn.rollback()
@@ -6601,7 +9019,7 @@ def on_buyrab_callbacks(call: CallbackQuery):
                         "UPDATE buyrab_offer_resp SET status=-1 WHERE offer_id=? AND owner_id=?",
                         (offer_id, clicker),
                     )
-                    conn.commit()
+                    db_commit()
 
                 else:
                     c.execute("SELECT share_bp FROM slavery WHERE slave_id=? AND owner_id=?", (slave_id, clicker))
@@ -6611,7 +9029,7 @@ def on_buyrab_callbacks(call: CallbackQuery):
                             "UPDATE buyrab_offer_resp SET status=-1 WHERE offer_id=? AND owner_id=?",
                             (offer_id, clicker),
                         )
-                        conn.commit()
+                        db_commit()
                         bot.answer_callback_query(call.id, "У вас уже нет доли владения этим рабом.", show_alert=True)
                         return
                     seller_bp = int(sr[0] or 0)
@@ -6621,7 +9039,7 @@ def on_buyrab_callbacks(call: CallbackQuery):
                             "UPDATE buyrab_offer_resp SET status=-1 WHERE offer_id=? AND owner_id=?",
                             (offer_id, clicker),
                         )
-                        conn.commit()
+                        db_commit()
                         bot.answer_callback_query(call.id, "Некорректная сумма сделки.", show_alert=True)
                         return
 
@@ -6630,14 +9048,11 @@ def on_buyrab_callbacks(call: CallbackQuery):
                             "UPDATE buyrab_offer_resp SET status=-1 WHERE offer_id=? AND owner_id=?",
                             (offer_id, clicker),
                         )
-                        conn.commit()
+                        db_commit()
                         bot.answer_callback_query(call.id, "У покупателя не хватает зарезервированных средств.", show_alert=True)
                         return
 
-                    c.execute(
-                        "UPDATE users SET balance_cents=COALESCE(balance_cents,0)+? WHERE user_id=?",
-                        (pay_cents, clicker),
-                    )
+                    ledger_post_cur(c, [(clicker, pay_cents)], "buyrab_pay", offer_id, counter=LEDGER_ESCROW)
                     c.execute(
                         "UPDATE buyrab_offers SET hold_cents=COALESCE(hold_cents,0)-? WHERE offer_id=?",
                         (pay_cents, offer_id),
@@ -6663,7 +9078,8 @@ def on_buyrab_callbacks(call: CallbackQuery):
                         "UPDATE buyrab_offer_resp SET status=1 WHERE offer_id=? AND owner_id=?",
                         (offer_id, clicker),
                     )
-                    conn.commit()
+                    db_commit()
+                    user_cache_invalidate(clicker)
 
             except Exception as e:
                 try:
@@ -6829,14 +9245,7 @@ def render_lobby(game_id: str) -> Tuple[str, InlineKeyboardMarkup]:
     return text, kb
 
 def schedule_lobby_end(game_id: str, delay: float = 0.5):
-    def _fire():
-        try:
-            end_lobby_if_needed(game_id)
-        except Exception:
-            pass
-    t = threading.Timer(delay, _fire)
-    t.daemon = True
-    t.start()
+    schedule_durable("lobby", game_id, delay)
 
 def end_lobby_if_needed(game_id: str):
     row = db_one(
@@ -6867,6 +9276,7 @@ def end_lobby_if_needed(game_id: str):
 
     if others_n == 0:
         db_exec("UPDATE games SET state='cancelled' WHERE game_id=?", (game_id,), commit=True)
+        live_game_evict(game_id)
         edit_game_message(game_id, "Регистрация завершена. Никто не присоединился.\nИгра отменена", reply_markup=None)
         return
 
@@ -6878,6 +9288,7 @@ def end_lobby_if_needed(game_id: str):
             (rfmt, r, game_id),
             commit=True,
         )
+        live_game_evict(game_id)
         shop_bind_players_for_game(game_id)
 
         order = turn_order_get(game_id)
@@ -6905,6 +9316,7 @@ def end_lobby_if_needed(game_id: str):
             (game_id,),
             commit=True,
         )
+        live_game_evict(game_id)
         shop_bind_players_for_game(game_id)
         try:
             zero_init_game(game_id)
@@ -6927,6 +9339,7 @@ def end_lobby_if_needed(game_id: str):
         return
 
     db_exec("UPDATE games SET state='choose_format' WHERE game_id=?", (game_id,), commit=True)
+    live_game_evict(game_id)
     text = (
         "Выберите формат рулетки:\n"
         "Режим ¨Кросс¨ 3 слота (Формат 1×3)\n"
@@ -6939,8 +9352,131 @@ def end_lobby_if_needed(game_id: str):
     kb.add(InlineKeyboardButton("ĐĒʋÍ£ 3×5", callback_data=cb_pack(f"rfmt:set:{game_id}:3x5", int(creator_id))))
     edit_game_message(game_id, text, reply_markup=kb, parse_mode="HTML")
 
+# LIVE GAMES: состояние идущих игр в памяти процесса.
+# Игра в state='playing' поднимается из базы один раз и дальше живёт здесь; все записи
+# идут в SQLite как раньше и дублируются сюда (write-through). На finish/cancel — выселяем.
+# Для остальных состояний live_game() отдаёт разовый снимок строки games без кэширования.
+class GameState:
+    __slots__ = (
+        "game_id", "game_type", "state", "creator_id", "stake_cents", "stake_kind",
+        "roulette_format", "turn_index", "cross_round",
+        "origin_chat_id", "origin_message_id", "origin_inline_id",
+        "players", "order", "order_round", "picks",
+    )
+
+    def __init__(self, game_id: str, row):
+        self.game_id = str(game_id)
+        (game_type, state, creator_id, stake_cents, stake_kind, rfmt, turn_index, cross_round,
+         origin_chat_id, origin_message_id, origin_inline_id) = row
+        self.game_type = game_type or "roulette"
+        self.state = state or ""
+        self.creator_id = int(creator_id or 0)
+        self.stake_cents = int(stake_cents or 0)
+        self.stake_kind = stake_kind or "money"
+        self.roulette_format = rfmt
+        self.turn_index = int(turn_index or 0)
+        self.cross_round = int(cross_round or 1)
+        self.origin_chat_id = origin_chat_id
+        self.origin_message_id = origin_message_id
+        self.origin_inline_id = origin_inline_id
+        self.players = None       # {uid: status} в порядке входа (только у живых)
+        self.order = None         # порядок ходов
+        self.order_round = 0
+        self.picks = None         # зеро: {uid: [codes]}
+
+_LIVE_GAMES: Dict[str, GameState] = {}
+_LIVE_GAMES_LOCK = threading.RLock()
+LIVE_GAMES_STATS = {"hits": 0, "loads": 0, "evictions": 0}
+_LIVE_GAMES_EPOCH = [0]  # растёт на каждой записи: загрузка, обогнанная записью, в кэш не попадает
+
+def _live_game_load(game_id: str) -> Optional[GameState]:
+    row = db_one(
+        "SELECT COALESCE(game_type,'roulette'), COALESCE(state,''), creator_id, stake_cents, "
+        "COALESCE(stake_kind,'money'), roulette_format, COALESCE(turn_index,0), COALESCE(cross_round,1), "
+        "origin_chat_id, origin_message_id, origin_inline_id "
+        "FROM games WHERE game_id=?",
+        (str(game_id),)
+    )
+    if not row:
+        return None
+    gs = GameState(game_id, row)
+    if gs.state != "playing":
+        return gs
+
+    rows = db_all("SELECT user_id, COALESCE(status,'') FROM game_players WHERE game_id=? ORDER BY rowid", (gs.game_id,))
+    gs.players = {int(uid): st for uid, st in rows or []}
+
+    tor = db_one("SELECT order_csv, COALESCE(round,0) FROM turn_orders WHERE game_id=?", (gs.game_id,))
+    if tor:
+        order = [int(x) for x in (tor[0] or "").split(",") if x.strip().lstrip("-").isdigit()]
+        gs.order = order or None
+        gs.order_round = int(tor[1] or 0)
+
+    if gs.game_type == "zero":
+        picks: Dict[int, list] = {uid: [] for uid in gs.players}
+        for uid, code in db_all(
+            "SELECT user_id, code FROM zero_bets WHERE game_id=? ORDER BY user_id, slot", (gs.game_id,)
+        ) or []:
+            picks.setdefault(int(uid), []).append((code or "").strip())
+        gs.picks = picks
+    return gs
+
+def live_game(game_id: str) -> Optional[GameState]:
+    game_id = str(game_id)
+    with _LIVE_GAMES_LOCK:
+        gs = _LIVE_GAMES.get(game_id)
+        if gs is not None:
+            LIVE_GAMES_STATS["hits"] += 1
+            return gs
+        epoch = _LIVE_GAMES_EPOCH[0]
+    gs = _live_game_load(game_id)
+    if gs is not None and gs.state == "playing":
+        with _LIVE_GAMES_LOCK:
+            if _LIVE_GAMES_EPOCH[0] == epoch:
+                gs = _LIVE_GAMES.setdefault(game_id, gs)
+                LIVE_GAMES_STATS["loads"] += 1
+    return gs
+
+def live_game_set(game_id: str, **fields):
+    """Записать в кэш поля, уже записанные в базу."""
+    with _LIVE_GAMES_LOCK:
+        _LIVE_GAMES_EPOCH[0] += 1
+        gs = _LIVE_GAMES.get(str(game_id))
+        if gs is None:
+            return
+        for k, v in fields.items():
+            setattr(gs, k, v)
+        if gs.state != "playing":
+            _LIVE_GAMES.pop(str(game_id), None)
+            LIVE_GAMES_STATS["evictions"] += 1
+
+def live_game_player_status(game_id: str, uid: int) -> str:
+    gs = live_game(game_id)
+    if gs is not None and gs.players is not None:
+        return gs.players.get(int(uid), "") or ""
+    row = db_one("SELECT status FROM game_players WHERE game_id=? AND user_id=?", (str(game_id), int(uid)))
+    return (row[0] if row else "") or ""
+
+def live_game_evict(game_id: str):
+    with _LIVE_GAMES_LOCK:
+        _LIVE_GAMES_EPOCH[0] += 1
+        if _LIVE_GAMES.pop(str(game_id), None) is not None:
+            LIVE_GAMES_STATS["evictions"] += 1
+
+def live_games_clear():
+    with _LIVE_GAMES_LOCK:
+        _LIVE_GAMES_EPOCH[0] += 1
+        _LIVE_GAMES.clear()
+
+def live_games_count() -> int:
+    with _LIVE_GAMES_LOCK:
+        return len(_LIVE_GAMES)
+
 # TURN ORDER (случайный порядок ходов)
 def game_players_list(game_id: str) -> list:
+    gs = live_game(game_id)
+    if gs is not None and gs.players is not None:
+        return list(gs.players.keys())
     rows = db_all("SELECT user_id FROM game_players WHERE game_id=? ORDER BY rowid", (str(game_id),))
     return [int(r[0]) for r in rows]
 
@@ -6953,11 +9489,16 @@ def turn_order_get(game_id: str) -> list:
     if not players:
         return []
 
-    rr = db_one("SELECT COALESCE(game_type,'roulette'), COALESCE(cross_round,1) FROM games WHERE game_id=?", (str(game_id),))
-    game_type = (rr[0] if rr else "roulette") or "roulette"
-    cross_round = int((rr[1] if rr else 1) or 1)
+    gs = live_game(game_id)
+    if gs is None:
+        return []
+    game_type = gs.game_type
+    cross_round = int(gs.cross_round or 1)
     desired_round = cross_round if str(game_type) == "cross" else 0
 
+    if gs.order is not None and gs.order_round == desired_round and len(gs.order) == len(players) and set(gs.order) == set(players):
+        return list(gs.order)
+
     row = db_one("SELECT order_csv, COALESCE(round,0) FROM turn_orders WHERE game_id=?", (str(game_id),))
     if row:
         csv = (row[0] or "").strip()
@@ -6974,6 +9515,7 @@ def turn_order_get(game_id: str) -> list:
                     pass
 
         if stored_round == desired_round and len(order) == len(players) and set(order) == set(players):
+            live_game_set(game_id, order=list(order), order_round=desired_round)
             return order
 
     # Перегенерация
@@ -6985,24 +9527,16 @@ def turn_order_get(game_id: str) -> list:
         (str(game_id), ",".join(str(x) for x in order), int(desired_round), int(now_ts())),
         commit=True
     )
+    live_game_set(game_id, order=list(order), order_round=desired_round)
     return order
 
 def turn_order_reset(game_id: str):
-    db_exec("DELETE FROM turn_orders WHERE game_id=?", (str(game_id),), commit=True)
-
-# ZERO-ROULETTE
-ZERO_RULES_URL = "https://teletype.in/@vers_octava/zero_roulete_gude" # ссылка
-ZERO_EMPTY = "ㅤㅤ"
-ZERO_RED = { # Цвета чисел
-    1,3,5,7,9,12,14,16,18,19,21,23,25,27,30,32,34,36
-}
-
-def zero_color(num: int) -> str:
-    """R/B/W (W = зеро)."""
-    num = int(num)
-    if num == 0:
-        return "W"
-    return "R" if num in ZERO_RED else "B"
+    db_exec("DELETE FROM turn_orders WHERE game_id=?", (str(game_id),), commit=True)
+    live_game_set(game_id, order=None, order_round=0)
+
+# ZERO-ROULETTE
+ZERO_RULES_URL = "https://teletype.in/@vers_octava/zero_roulete_gude" # ссылка
+ZERO_EMPTY = "ㅤㅤ"
 
 def zero_num_label(num: int) -> str:
     num = int(num)
@@ -7010,14 +9544,6 @@ def zero_num_label(num: int) -> str:
         return "Зеро⚪"
     return f"{num}{'🔴' if zero_color(num) == 'R' else '⚫'}"
 
-def zero_code_is_num(code: str) -> bool:
-    return bool(code) and (code == "Z" or code.startswith("N"))
-
-def zero_code_to_num(code: str) -> int:
-    if code == "Z":
-        return 0
-    return int(code[1:])
-
 def zero_code_label(code: str) -> str:
     if not code:
         return ""
@@ -7038,34 +9564,21 @@ def zero_code_label(code: str) -> str:
             return code
     return code
 
-ZERO_SEQ_TIER = [33,16,24,5,10,23,8,30,11,36,13,27]
-ZERO_SEQ_ORPHELINS = [9,31,14,20,1,6,34,17]
-ZERO_SEQ_VOISINS = [22,18,29,7,28,19,4,21,2,25]
-ZERO_SEQ_ZERO_SPIEL = [12,35,3,26,0,32,15]
-
-def zero_seq_match(nums: list, seq: list) -> bool:
-    """nums == contiguous subseq of seq OR reverse(seq)."""
-    n = len(nums)
-    if n <= 0:
-        return False
-    for base in (seq, list(reversed(seq))):
-        for i in range(0, len(base) - n + 1):
-            if base[i:i+n] == nums:
-                return True
-    return False
-
 def zero_get_order(game_id: str) -> list:
     return turn_order_get(game_id)
 
 def zero_get_turn_uid(game_id: str) -> int:
-    row = db_one("SELECT COALESCE(turn_index,0) FROM games WHERE game_id=?", (str(game_id),))
-    turn_index = int((row[0] if row else 0) or 0)
+    gs = live_game(game_id)
+    turn_index = int(gs.turn_index if gs else 0)
     order = turn_order_get(game_id)
     if not order:
         return 0
     return int(order[turn_index % len(order)])
 
 def zero_get_picks(game_id: str, uid: int) -> list:
+    gs = live_game(game_id)
+    if gs is not None and gs.picks is not None:
+        return list(gs.picks.get(int(uid), []))
     rows = db_all(
         "SELECT slot, code FROM zero_bets WHERE game_id=? AND user_id=? ORDER BY slot",
         (game_id, int(uid))
@@ -7077,6 +9590,11 @@ def zero_get_picks(game_id: str, uid: int) -> list:
 
 def zero_clear_picks(game_id: str, uid: int):
     db_exec("DELETE FROM zero_bets WHERE game_id=? AND user_id=?", (game_id, int(uid)), commit=True)
+    with _LIVE_GAMES_LOCK:
+        _LIVE_GAMES_EPOCH[0] += 1
+        gs = _LIVE_GAMES.get(str(game_id))
+        if gs is not None and gs.picks is not None:
+            gs.picks[int(uid)] = []
 
 def zero_set_locked(game_id: str, uid: int, locked: bool):
     db_exec(
@@ -7111,6 +9629,11 @@ def zero_init_game(game_id: str):
     db_exec("DELETE FROM zero_bets WHERE game_id=?", (game_id,), commit=True)
     db_exec("DELETE FROM zero_lock WHERE game_id=?", (game_id,), commit=True)
     db_exec("DELETE FROM zero_outcomes WHERE game_id=?", (game_id,), commit=True)
+    with _LIVE_GAMES_LOCK:
+        _LIVE_GAMES_EPOCH[0] += 1
+        gs = _LIVE_GAMES.get(str(game_id))
+        if gs is not None and gs.picks is not None:
+            gs.picks = {int(u): [] for u in order}
 
     db_exec(
         "INSERT INTO zero_state (game_id, stage, revealed, gen_csv, gen_ts) VALUES (?,?,?,?,?) "
@@ -7156,6 +9679,11 @@ def zero_add_pick(game_id: str, uid: int, code: str) -> Tuple[bool, str]:
         (game_id, int(uid), int(slot), code),
         commit=True
     )
+    with _LIVE_GAMES_LOCK:
+        _LIVE_GAMES_EPOCH[0] += 1
+        gs = _LIVE_GAMES.get(str(game_id))
+        if gs is not None and gs.picks is not None:
+            gs.picks[int(uid)] = picks + [code]
     return True, ""
 
 def zero_parse_gen(game_id: str) -> list:
@@ -7191,14 +9719,10 @@ def zero_format_gen_row(gen_nums: list, revealed: int) -> str:
     return "".join(parts)
 
 def zero_render_screen(game_id: str) -> Tuple[str, Optional[InlineKeyboardMarkup]]:
-    g = db_one(
-        "SELECT stake_cents, COALESCE(stake_kind,'money'), COALESCE(turn_index,0), COALESCE(state,'') "
-        "FROM games WHERE game_id=?",
-        (game_id,)
-    )
-    if not g:
+    gs = live_game(game_id)
+    if gs is None:
         return "Игра не найдена.", None
-    stake_cents, stake_kind, turn_index, gstate = int(g[0] or 0), (g[1] or "money"), int(g[2] or 0), (g[3] or "")
+    stake_cents, stake_kind, turn_index, gstate = gs.stake_cents, gs.stake_kind, gs.turn_index, gs.state
 
     z = db_one("SELECT COALESCE(stage,'betting'), COALESCE(revealed,0) FROM zero_state WHERE game_id=?", (game_id,))
     stage = (z[0] if z else "betting") or "betting"
@@ -7300,173 +9824,7 @@ def zero_build_keyboard(game_id: str, active_uid: int) -> InlineKeyboardMarkup:
 
     return kb
 
-def zero_compute_combo(picks: list, gen_nums: list) -> Tuple[str, int]:
-    slots = []
-    for code in picks[:5]:
-        if zero_code_is_num(code):
-            n = zero_code_to_num(code)
-            slots.append(n if n in gen_nums else None)
-        else:
-            slots.append(None)
-
-    best = ("", 1)
-
-    def consider(name: str, mult: int):
-        nonlocal best
-        mult = int(mult)
-        if mult > best[1]:
-            best = (name, mult)
-
-    i = 0
-    while i < len(slots):
-        if slots[i] is None:
-            i += 1
-            continue
-        j = i
-        seg = []
-        while j < len(slots) and slots[j] is not None:
-            seg.append(int(slots[j]))
-            j += 1
-
-        L = len(seg)
-
-        if L >= 3:
-            ok = True
-            for k in range(1, L):
-                if abs(seg[k] - seg[k-1]) != 1:
-                    ok = False
-                    break
-            if ok:
-                consider("Strit", 2 if L == 3 else (3 if L == 4 else 5))
-
-            ok = True
-            if any(x == 0 for x in seg):
-                ok = False
-            else:
-                c0 = zero_color(seg[0])
-                for k in range(1, L):
-                    if abs(seg[k] - seg[k-1]) != 2 or zero_color(seg[k]) != c0:
-                        ok = False
-                        break
-            if ok:
-                consider("Flash", 2 if L == 3 else (3 if L == 4 else 5))
-
-        if L >= 4:
-            if zero_seq_match(seg, ZERO_SEQ_TIER):
-                consider("Tier", 2 if L == 4 else 3)
-            if zero_seq_match(seg, ZERO_SEQ_ORPHELINS):
-                consider("Orphelins", 2 if L == 4 else 3)
-            if zero_seq_match(seg, ZERO_SEQ_VOISINS):
-                consider("Voisins Du Zero", 2 if L == 4 else 3)
-            if zero_seq_match(seg, ZERO_SEQ_ZERO_SPIEL):
-                if seg and seg[0] == 0:
-                    consider("Zero Spiel", 3 if L == 4 else 5)
-                else:
-                    consider("Zero Spiel", 2 if L == 4 else 3)
-
-        i = j
-
-    return best[0], best[1]
-
-def zero_compute_delta(picks: list, gen_nums: list, stake_cents: int) -> Tuple[int, str, int]:
-    stake_cents = int(stake_cents or 0)
-
-    nums_only = [zero_code_to_num(c) for c in picks if zero_code_is_num(c)]
-    special_zero = (len(nums_only) > 0 and set(nums_only) == {0})
-
-    if special_zero:
-        if 0 in gen_nums:
-            return stake_cents * 10, "", 1
-        return -stake_cents * 5, "", 1
-
-    delta = 0
-    even_cnt = sum(1 for n in gen_nums if n != 0 and (n % 2 == 0))
-    odd_cnt = sum(1 for n in gen_nums if n != 0 and (n % 2 == 1))
-    red_cnt = sum(1 for n in gen_nums if zero_color(n) == "R")
-    black_cnt = sum(1 for n in gen_nums if zero_color(n) == "B")
-
-    for code in picks[:5]:
-        if zero_code_is_num(code):
-            n = zero_code_to_num(code)
-            delta += (stake_cents if n in gen_nums else -stake_cents)
-            continue
-
-        if code in ("E", "O") and even_cnt != odd_cnt:
-            if code == "E":
-                if even_cnt > odd_cnt:
-                    delta += (stake_cents * even_cnt + 1) // 2
-                else:
-                    delta -= (stake_cents * odd_cnt * 3 + 1) // 2
-            else:
-                if odd_cnt > even_cnt:
-                    delta += (stake_cents * odd_cnt + 1) // 2
-                else:
-                    delta -= (stake_cents * even_cnt * 3 + 1) // 2
-            continue
-
-        if code in ("R", "B") and red_cnt != black_cnt:
-            if code == "R":
-                if red_cnt > black_cnt:
-                    delta += (stake_cents * red_cnt + 1) // 2
-                else:
-                    delta -= (stake_cents * black_cnt * 3 + 1) // 2
-            else:
-                if black_cnt > red_cnt:
-                    delta += (stake_cents * black_cnt + 1) // 2
-                else:
-                    delta -= (stake_cents * red_cnt * 3 + 1) // 2
-            continue
-
-    combo_name, mult = zero_compute_combo(picks, gen_nums)
-    if mult > 1:
-        delta = int(delta) * int(mult)
-
-    return int(delta), combo_name, int(mult)
-
 # ZERO-ROULETTE: генерация с учётом зеро-фишек
-ZERO_LUCKY_PROC_PCT = 25        # шанс срабатывания удачной фишки
-ZERO_COLOR_BONUS_PCT = 5        # +% к весам (за каждую активную фишку)
-
-def _weighted_sample_unique(pool: list, weight_fn, k: int) -> list:
-    pool = list(pool)
-    out = []
-    for _ in range(int(k)):
-        if not pool:
-            break
-        weights = []
-        for x in pool:
-            try:
-                w = float(weight_fn(x))
-            except Exception:
-                w = 0.0
-            if w <= 0:
-                w = 0.0
-            weights.append(w)
-        total = sum(weights)
-        if total <= 0:
-            idx = random.randrange(len(pool))
-        else:
-            r = random.random() * total
-            s = 0.0
-            idx = 0
-            for i, w in enumerate(weights):
-                s += w
-                if r <= s:
-                    idx = i
-                    break
-        out.append(pool.pop(idx))
-    return out
-
-def _zero_picks_nums(picks: list) -> list:
-    nums = []
-    for code in (picks or []):
-        if zero_code_is_num(code):
-            try:
-                nums.append(int(zero_code_to_num(code)))
-            except Exception:
-                pass
-    return nums
-
 def zero_generate_numbers(game_id: str) -> list:
     """Генерация 5 уникальных чисел 0..36 с учётом зеро-фишек."""
     stake_row = db_one("SELECT stake_cents FROM games WHERE game_id=?", (str(game_id),))
@@ -7487,21 +9845,12 @@ def zero_generate_numbers(game_id: str) -> list:
         if a.get("lucky_chip", 0) > 0:
             lucky_users.append(int(uid))
 
-    red_mul = 1.0 + (ZERO_COLOR_BONUS_PCT / 100.0) * red_cnt
-    black_mul = 1.0 + (ZERO_COLOR_BONUS_PCT / 100.0) * black_cnt
-
-    def w(n: int) -> float:
-        n = int(n)
-        if n == 0:
-            return 1.0
-        return red_mul if zero_color(n) == "R" else black_mul
-
-    gen = _weighted_sample_unique(list(range(0, 37)), w, 5)
+    ww = zero_weights(red_cnt, black_cnt)
+    gen = _weighted_sample_unique(list(range(0, 37)), ww.__getitem__, 5)
 
     # Удачная фишка: с шансом 25% обеспечиваем минимум 2 удачных ставки (по числам)
     if lucky_users:
         random.shuffle(lucky_users)
-        gen_set = set(gen)
 
         for uid in lucky_users:
             if random.randint(1, 100) > ZERO_LUCKY_PROC_PCT:
@@ -7509,36 +9858,8 @@ def zero_generate_numbers(game_id: str) -> list:
 
             picks = zero_get_picks(game_id, uid)
             nums = _zero_picks_nums(picks)
-            if not nums:
-                maybe_make_slave_by_shop_trigger(uid, max(0, stake_cents * 2), game_id)
-                continue
-
-            hits = sum(1 for n in nums if n in gen_set)
-            if hits < 2:
-                from collections import Counter
-                cnt = Counter(nums)
-
-                cand = [n for n in cnt.keys() if n not in gen_set]
-                cand.sort(key=lambda n: cnt[n], reverse=True)
-
-                to_put = []
-                for n in cand:
-                    if hits >= 2:
-                        break
-                    to_put.append(int(n))
-                    hits += int(cnt[n])
-
-                for n in to_put:
-                    if n in gen_set:
-                        continue
-                    idx = random.randrange(len(gen))
-                    for _ in range(10):
-                        if gen[idx] != n and gen[idx] not in to_put:
-                            break
-                        idx = random.randrange(len(gen))
-                    gen_set.discard(gen[idx])
-                    gen[idx] = int(n)
-                    gen_set.add(int(n))
+            if nums:
+                zero_lucky_apply(gen, nums)
 
             maybe_make_slave_by_shop_trigger(uid, max(0, stake_cents * 2), game_id)
 
@@ -7559,32 +9880,97 @@ def zero_start_reveal(game_id: str):
 
     zero_schedule_reveal(game_id, 1)
 
+def zero_reveal_tick(game_id: str, revealed: int):
+    try:
+        z = db_one("SELECT COALESCE(stage,'') FROM zero_state WHERE game_id=?", (game_id,))
+        if not z or (z[0] or "") != "reveal":
+            return
+
+        db_exec(
+            "UPDATE zero_state SET revealed=? WHERE game_id=?",
+            (int(revealed), game_id),
+            commit=True
+        )
+
+        text, _kb = zero_render_screen(game_id)
+        edit_game_message(game_id, text, reply_markup=None, parse_mode="HTML")
+
+        if int(revealed) < 5:
+            zero_schedule_reveal(game_id, int(revealed) + 1)
+        else:
+            zero_finish_game(game_id)
+    except Exception:
+        pass
+
 def zero_schedule_reveal(game_id: str, revealed: int):
-    def _tick():
-        try:
-            z = db_one("SELECT COALESCE(stage,'') FROM zero_state WHERE game_id=?", (game_id,))
-            if not z or (z[0] or "") != "reveal":
-                return
+    schedule_durable("zero_reveal", game_id, 2.0, int(revealed))
 
-            db_exec(
-                "UPDATE zero_state SET revealed=? WHERE game_id=?",
-                (int(revealed), game_id),
-                commit=True
-            )
+# Durable jobs: строка в scheduled_jobs + событие в SCHEDULER. Строка удаляется после
+# выполнения (только если за это время её не перепланировали), при старте — загружаются обратно.
+DURABLE_JOB_HANDLERS = {
+    "lobby": lambda ref, arg: end_lobby_if_needed(ref),
+    "zero_reveal": lambda ref, arg: zero_reveal_tick(ref, int(arg)),
+}
+SCHEDULED_JOBS_LOAD_BATCH = 500
 
-            text, _kb = zero_render_screen(game_id)
-            edit_game_message(game_id, text, reply_markup=None, parse_mode="HTML")
+def schedule_durable(kind: str, ref: str, delay: float, arg: int = 0):
+    due = time.time() + max(0.0, float(delay))
+    db_exec(
+        "INSERT OR REPLACE INTO scheduled_jobs (kind, ref, arg, due_ts) VALUES (?,?,?,?)",
+        (str(kind), str(ref), int(arg), due),
+        commit=True
+    )
+    SCHEDULER.call_at(due, _run_durable_job, str(kind), str(ref), int(arg), due, key=(str(kind), str(ref)))
 
-            if int(revealed) < 5:
-                zero_schedule_reveal(game_id, int(revealed) + 1)
-            else:
-                zero_finish_game(game_id)
-        except Exception:
-            pass
+def _run_durable_job(kind: str, ref: str, arg: int, due: float):
+    fn = DURABLE_JOB_HANDLERS.get(kind)
+    try:
+        if fn:
+            fn(ref, arg)
+    finally:
+        db_exec(
+            "DELETE FROM scheduled_jobs WHERE kind=? AND ref=? AND due_ts=?",
+            (kind, ref, due),
+            commit=True
+        )
+
+# лобби без задачи (зависшие до появления scheduled_jobs)
+RESUME_LOBBY_JOBS_SQL = """
+    INSERT OR IGNORE INTO scheduled_jobs (kind, ref, arg, due_ts)
+    SELECT 'lobby', game_id, 0, COALESCE(reg_ends_ts,0) + 0.5
+    FROM games WHERE state='lobby'
+"""
+# страница задач по (due_ts, kind, ref) — keyset, без OFFSET
+SCHEDULED_JOBS_PAGE_SQL = (
+    "SELECT kind, ref, arg, due_ts FROM scheduled_jobs "
+    "WHERE (due_ts, kind, ref) > (?, ?, ?) "
+    "ORDER BY due_ts, kind, ref LIMIT ?"
+)
 
-    t = threading.Timer(2.0, _tick)
-    t.daemon = True
-    t.start()
+def load_scheduled_jobs() -> int:
+    """
+    Старт: поднимаем сохранённые задачи пачками по due_ts. Заодно подхватываем игры,
+    зависшие до появления таблицы: лобби без задачи и зеро в стадии reveal.
+    """
+    db_exec(RESUME_LOBBY_JOBS_SQL, (), commit=True)
+    db_exec("""
+        INSERT OR IGNORE INTO scheduled_jobs (kind, ref, arg, due_ts)
+        SELECT 'zero_reveal', z.game_id, MIN(COALESCE(z.revealed,0) + 1, 5), ?
+        FROM zero_state z JOIN games g ON g.game_id=z.game_id
+        WHERE z.stage='reveal' AND g.state='playing'
+    """, (time.time() + 2.0,), commit=True)
+
+    loaded = 0
+    last_due, last_kind, last_ref = -1.0, "", ""
+    while True:
+        rows = db_all(SCHEDULED_JOBS_PAGE_SQL, (last_due, last_kind, last_ref, SCHEDULED_JOBS_LOAD_BATCH))
+        if not rows:
+            break
+        for kind, ref, arg, due in rows:
+            SCHEDULER.call_at(float(due), _run_durable_job, kind, ref, int(arg or 0), float(due), key=(kind, ref))
+            loaded += 1
+        last_kind, last_ref, last_due = rows[-1][0], rows[-1][1], float(rows[-1][3])
+    return loaded
 
 def zero_finish_game(game_id: str):
     g = db_one("SELECT stake_cents, COALESCE(game_type,'roulette'), COALESCE(state,'') FROM games WHERE game_id=?", (game_id,))
@@ -7594,79 +9980,107 @@ def zero_finish_game(game_id: str):
     game_type = (g[1] or "roulette")
     if game_type != "zero":
         return
+    if (g[2] or "") == "finished":  # повторный тик после рестарта — уже рассчитано
+        return
 
     gen_nums = zero_parse_gen(game_id)
     order = zero_get_order(game_id)
     if not order:
         return
 
-    for uid in order:
-        picks = zero_get_picks(game_id, uid)
-        delta, combo_name, mult = zero_compute_delta(picks, gen_nums, stake_cents)
+    # Вся раздача по игре — одна транзакция; однотипные записи по игрокам — executemany
+    with db_tx():
+        legs = []
+        cuts = []
+        result_rows = []
+        outcome_rows = []
+        win_rows = []
+        lose_rows = []
+
+        for uid in order:
+            picks = zero_get_picks(game_id, uid)
+            delta, combo_name, mult = zero_compute_delta(picks, gen_nums, stake_cents)
+
+            active = shop_get_active_for_game(uid, game_id)
+
+            insured = (active.get("insurance", 0) > 0) or (active.get("paket", 0) > 0)
+            if insured and int(delta) < 0:
+                protected_amt = abs(int(delta))
+                if active.get("paket", 0) > 0:
+                    shop_mark_used(uid, game_id, "paket")
+                    delta = protected_amt
+                else:
+                    shop_mark_used(uid, game_id, "insurance")
+                    delta = 0
+                maybe_make_slave_by_shop_trigger(uid, protected_amt, game_id)
 
-        active = shop_get_active_for_game(uid, game_id)
+            u = get_user(uid)
+            is_demon = (u and int(u[7] or 0) == 1)
+            if not is_demon:
+                if delta > 0:
+                    kept, parts = slave_cut_split(uid, int(delta))
+                    legs.extend(parts)
+                    legs.append((int(uid), int(kept)))
+                    cuts.append((int(uid), parts))
+                else:
+                    legs.append((int(uid), int(delta)))
 
-        insured = (active.get("insurance", 0) > 0) or (active.get("paket", 0) > 0)
-        if insured and int(delta) < 0:
-            protected_amt = abs(int(delta))
-            if active.get("paket", 0) > 0:
-                shop_mark_used(uid, game_id, "paket")
-                delta = protected_amt
+            result_rows.append((game_id, int(uid), int(delta)))
+            outcome_rows.append((game_id, int(uid), combo_name or "", float(mult)))
+            if int(delta) >= 0:
+                win_rows.append((int(delta), int(uid)))
             else:
-                shop_mark_used(uid, game_id, "insurance")
-                delta = 0
-            maybe_make_slave_by_shop_trigger(uid, protected_amt, game_id)
+                lose_rows.append((int(abs(int(delta))), int(uid)))
 
-        u = get_user(uid)
-        is_demon = (u and int(u[7] or 0) == 1)
-        if not is_demon:
-            if delta > 0:
-                kept = apply_slave_cut(uid, int(delta), reason="zero")
-                add_balance(uid, kept)
-            else:
-                add_balance(uid, int(delta))
+        uids = [(int(uid),) for uid in order]
 
-        db_exec(
+        # вся раздача — одна проводка: выигрыши (с долями владельцев) и проигрыши
+        ledger_post(legs, "zero", game_id)
+        for sid, parts in cuts:
+            slave_cut_record(sid, parts)
+        db_exec_many(
             "INSERT INTO game_results (game_id, user_id, delta_cents, finished) "
             "VALUES (?,?,?,1) "
             "ON CONFLICT(game_id,user_id) DO UPDATE SET delta_cents=excluded.delta_cents, finished=1",
-            (game_id, int(uid), int(delta)),
-            commit=True
+            result_rows, commit=True
         )
-
-        db_exec(
+        db_exec_many(
             "INSERT INTO zero_outcomes (game_id, user_id, combo, mult) VALUES (?,?,?,?) "
             "ON CONFLICT(game_id,user_id) DO UPDATE SET combo=excluded.combo, mult=excluded.mult",
-            (game_id, int(uid), combo_name or "", float(mult)),
-            commit=True
+            outcome_rows, commit=True
+        )
+        db_exec_many("INSERT OR IGNORE INTO game_stats (user_id) VALUES (?)", uids, commit=True)
+        db_exec_many(
+            "UPDATE game_stats SET games_total=games_total+1, wins=wins+1, max_win_cents=MAX(max_win_cents, ?) WHERE user_id=?",
+            win_rows, commit=True
+        )
+        db_exec_many(
+            "UPDATE game_stats SET games_total=games_total+1, losses=losses+1, max_lose_cents=MAX(max_lose_cents, ?) WHERE user_id=?",
+            lose_rows, commit=True
+        )
+        db_exec_many(
+            "INSERT OR IGNORE INTO game_type_stats (user_id, game_type, cnt) VALUES (?,'zero',0)",
+            uids, commit=True
+        )
+        db_exec_many(
+            "UPDATE game_type_stats SET cnt=cnt+1 WHERE user_id=? AND game_type='zero'",
+            uids, commit=True
         )
 
-        db_exec("INSERT OR IGNORE INTO game_stats (user_id) VALUES (?)", (int(uid),), commit=True)
-        if int(delta) >= 0:
-            db_exec(
-                "UPDATE game_stats SET games_total=games_total+1, wins=wins+1, max_win_cents=MAX(max_win_cents, ?) WHERE user_id=?",
-                (int(delta), int(uid)),
-                commit=True
-            )
-        else:
-            db_exec(
-                "UPDATE game_stats SET games_total=games_total+1, losses=losses+1, max_lose_cents=MAX(max_lose_cents, ?) WHERE user_id=?",
-                (int(abs(int(delta))), int(uid)),
-                commit=True
-            )
-        bump_game_type_stat(int(uid), "zero")
+        db_exec("UPDATE games SET state='finished' WHERE game_id=?", (game_id,), commit=True)
 
-    db_exec("UPDATE games SET state='finished' WHERE game_id=?", (game_id,), commit=True)
+        try:
+            for pid in set(order):
+                shop_tick_after_game(int(pid), game_id)
+        except Exception:
+            pass
 
-    try:
-        for pid in set(order):
-            shop_tick_after_game(int(pid), game_id)
-    except Exception:
-        pass
+        apply_demon_life_settlement(game_id)
+        update_demon_streak_after_game(game_id)
+        emancipate_slaves_after_game(game_id)
 
-    apply_demon_life_settlement(game_id)
-    update_demon_streak_after_game(game_id)
-    emancipate_slaves_after_game(game_id)
+    live_game_evict(game_id)
+    status_cache_invalidate_game(game_id)
 
     creator_row = db_one("SELECT creator_id FROM games WHERE game_id=?", (game_id,))
     creator_id = int((creator_row[0] if creator_row else 0) or 0)
@@ -7674,7 +10088,7 @@ def zero_finish_game(game_id: str):
     totals_text, totals_kb = render_game_totals(game_id, creator_id)
     edit_game_message(game_id, totals_text, reply_markup=totals_kb, parse_mode="HTML")
 
-@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("zero:"))
+@cb_route("zero")
 def on_zero_callbacks(call: CallbackQuery):
     base, owner = cb_unpack(call.data)
     clicker = call.from_user.id
@@ -7755,11 +10169,12 @@ def on_zero_callbacks(call: CallbackQuery):
                 pass
             return
 
-        row = db_one("SELECT COALESCE(turn_index,0) FROM games WHERE game_id=?", (game_id,))
-        turn_index = int((row[0] if row else 0) or 0)
+        gs = live_game(game_id)
+        turn_index = int(gs.turn_index if gs else 0)
         order = zero_get_order(game_id)
         next_index = (turn_index + 1) % len(order) if order else 0
         db_exec("UPDATE games SET turn_index=? WHERE game_id=?", (int(next_index), game_id), commit=True)
+        live_game_set(game_id, turn_index=int(next_index))
 
         text, kb = zero_render_screen(game_id)
         edit_zero_message(call, text, reply_markup=kb, parse_mode="HTML")
@@ -7950,7 +10365,7 @@ def start_rematch_from_votes(call: CallbackQuery, old_game_id: str, yes_set: set
             if st == "need_life":
                cur.execute("INSERT OR IGNORE INTO life_wait (game_id, user_id, stake_cents) VALUES (?,?,?)", (new_game_id, uid, int(stake_cents))) 
 
-    conn.commit()
+    db_commit()
     shop_bind_players_for_game(new_game_id)
     
     if pending_life:
@@ -8008,14 +10423,12 @@ def start_rematch_from_votes(call: CallbackQuery, old_game_id: str, yes_set: set
 
 
 def edit_game_message(game_id: str, text: str, reply_markup=None, parse_mode="HTML"):
-    row = db_one("SELECT origin_chat_id, origin_message_id, origin_inline_id FROM games WHERE game_id=?", (game_id,))
-    if not row:
+    gs = live_game(game_id)
+    if gs is None:
         return
-    chat_id, msg_id, inline_id = row
-
-    g = db_one("SELECT COALESCE(game_type,'roulette'), COALESCE(state,'') FROM games WHERE game_id=?", (game_id,))
-    game_type = (g[0] if g else "roulette") or "roulette"
-    state = (g[1] if g else "") or ""
+    chat_id, msg_id, inline_id = gs.origin_chat_id, gs.origin_message_id, gs.origin_inline_id
+    game_type = gs.game_type
+    state = gs.state
 
     if game_type == "zero" and state != "lobby" and zero_media_enabled():
         try:
@@ -8044,17 +10457,16 @@ def edit_game_message(game_id: str, text: str, reply_markup=None, parse_mode="HT
     elif chat_id and msg_id:
         limited_edit_message_text(text=text, chat_id=chat_id, msg_id=msg_id, reply_markup=reply_markup, parse_mode=parse_mode)
 
+USER_LOBBIES_SQL = """
+    SELECT gp.game_id
+    FROM game_players gp
+    JOIN games g ON g.game_id = gp.game_id
+    WHERE gp.user_id=? AND g.state='lobby'
+"""
+
 def refresh_lobbies_for_user(uid: int):
     """После регистрации обновляет все лобби, где пользователь находится как 'Аноним'."""
-    rows = db_all(
-        """
-        SELECT gp.game_id
-        FROM game_players gp
-        JOIN games g ON g.game_id = gp.game_id
-        WHERE gp.user_id=? AND g.state='lobby'
-        """,
-        (int(uid),),
-    )
+    rows = db_all(USER_LOBBIES_SQL, (int(uid),))
     for (game_id,) in rows:
         db_exec(
             "UPDATE game_players SET status='ready' WHERE game_id=? AND user_id=?",
@@ -8137,7 +10549,7 @@ def handle_join(call: CallbackQuery, game_id: str):
         return
 
     cur.execute("INSERT INTO game_players (game_id, user_id, status) VALUES (?,?,?)", (game_id, uid, "ready"))
-    conn.commit()
+    db_commit()
     text, kb = render_lobby(game_id)
     edit_inline_or_message(call, text, reply_markup=kb, parse_mode="HTML")
     bot.answer_callback_query(call.id)
@@ -8157,7 +10569,7 @@ def handle_extend(call: CallbackQuery, game_id: str):
         return
 
     cur.execute("UPDATE games SET reg_extended=1, reg_ends_ts=? WHERE game_id=?", (int(reg_ends_ts) + 30, game_id))
-    conn.commit()
+    db_commit()
     text, kb = render_lobby(game_id)
     edit_inline_or_message(call, text, reply_markup=kb, parse_mode="HTML")
     bot.answer_callback_query(call.id)
@@ -8174,18 +10586,21 @@ def handle_cancel(call: CallbackQuery, game_id: str):
         return
 
     comp = int(int(stake_cents) * 0.10)
+    legs = []
     if get_user(creator_id) and int(get_user(creator_id)[7] or 0) == 0:
-        add_balance(creator_id, -comp)
+        legs.append((creator_id, -comp))
 
     cur.execute("SELECT user_id FROM game_players WHERE game_id=? AND user_id<>?", (game_id, creator_id))
     others = [r[0] for r in cur.fetchall()]
     for uid in others:
         u = get_user(uid)
         if u and u[2]:
-            add_balance(uid, comp)
+            legs.append((uid, comp))
+    ledger_post(legs, "cancel_comp", game_id)
 
     cur.execute("UPDATE games SET state='cancelled' WHERE game_id=?", (game_id,))
-    conn.commit()
+    db_commit()
+    live_game_evict(game_id)
 
     creator_name = get_user(creator_id)[2] if get_user(creator_id) else "Инициатор"
     text = (
@@ -8228,7 +10643,8 @@ def handle_continue(call: CallbackQuery, game_id: str):
         rfmt = cross_format_for_round(r)
         cur.execute("UPDATE games SET state='playing', roulette_format=?, cross_round=?, turn_index=0 WHERE game_id=?",
                     (rfmt, r, game_id))
-        conn.commit()
+        db_commit()
+        live_game_evict(game_id)
 
 
         order = turn_order_get(game_id)
@@ -8256,7 +10672,8 @@ def handle_continue(call: CallbackQuery, game_id: str):
         stake_cents = int((cur.fetchone() or (0,))[0] or 0)
     
         cur.execute("UPDATE games SET state='playing', turn_index=0 WHERE game_id=?", (game_id,))
-        conn.commit()
+        db_commit()
+        live_game_evict(game_id)
         shop_bind_players_for_game(game_id)
         try:
             zero_init_game(game_id)
@@ -8280,7 +10697,8 @@ def handle_continue(call: CallbackQuery, game_id: str):
         return
 
     cur.execute("UPDATE games SET state='choose_format' WHERE game_id=?", (game_id,))
-    conn.commit()
+    db_commit()
+    live_game_evict(game_id)
 
     text = (
         "Выберите формат рулетки:\n"
@@ -8295,7 +10713,7 @@ def handle_continue(call: CallbackQuery, game_id: str):
     edit_inline_or_message(call, text, reply_markup=kb, parse_mode="HTML")
     bot.answer_callback_query(call.id)
 
-@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("rematch:vote:"))
+@cb_route("rematch:vote")
 def on_rematch_vote(call: CallbackQuery):
     parts = call.data.split(":")
     if len(parts) != 4:
@@ -8318,7 +10736,7 @@ def on_rematch_vote(call: CallbackQuery):
         VALUES (?,?,?)
         ON CONFLICT(game_id, user_id) DO UPDATE SET vote=excluded.vote
     """, (game_id, uid, vote))
-    conn.commit()
+    db_commit()
     cur.execute("SELECT creator_id FROM games WHERE game_id=?", (game_id,))
     row = cur.fetchone()
     if not row:
@@ -8341,7 +10759,8 @@ def on_rematch_vote(call: CallbackQuery):
     yes_uids = {int(r[0]) for r in cur.fetchall()}
 
     cur.execute("UPDATE games SET state='finished' WHERE game_id=?", (game_id,))
-    conn.commit()
+    db_commit()
+    live_game_evict(game_id)
 
     if len(yes_uids) < 2:
         end_text = text + "\n\nИгра завершена. Недостаточно игроков для продолжения игры (нужно минимум 2 «Да»)."
@@ -8351,7 +10770,7 @@ def on_rematch_vote(call: CallbackQuery):
 
     bot.answer_callback_query(call.id)
 
-@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("rfmt:set:"))
+@cb_route("rfmt:set")
 def on_rfmt(call: CallbackQuery):
     base, owner = cb_unpack(call.data)
     clicker = call.from_user.id
@@ -8374,7 +10793,8 @@ def on_rfmt(call: CallbackQuery):
         return
 
     cur.execute("UPDATE games SET roulette_format=?, state='playing', turn_index=0 WHERE game_id=?", (fmt, game_id))
-    conn.commit()
+    db_commit()
+    live_game_evict(game_id)
     shop_bind_players_for_game(game_id)
 
     order = turn_order_get(game_id)
@@ -8389,7 +10809,7 @@ def on_rfmt(call: CallbackQuery):
     edit_inline_or_message(call, text, reply_markup=kb, parse_mode="HTML")
     bot.answer_callback_query(call.id)
 
-@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("turn:begin:"))
+@cb_route("turn:begin")
 def on_turn_begin(call: CallbackQuery):
     base, owner = cb_unpack(call.data)
     clicker = call.from_user.id
@@ -8465,12 +10885,12 @@ def on_turn_begin(call: CallbackQuery):
         INSERT OR REPLACE INTO spins (game_id, user_id, stage, msg_chat_id, msg_id, inline_id, grid_text, started_ts)
         VALUES (?,?,?,?,?,?,?,?)
         """, (game_id, uid, "ready", call.message.chat.id, call.message.message_id, None, empty_grid, now_ts()))
-    conn.commit()
+    db_commit()
 
     edit_inline_or_message(call, text, reply_markup=kb, parse_mode="HTML")
     bot.answer_callback_query(call.id)
 
-@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("spin:pull:"))
+@cb_route("spin:pull")
 def on_spin_pull(call: CallbackQuery):
     base, owner = cb_unpack(call.data)
     clicker = call.from_user.id
@@ -8493,42 +10913,47 @@ def on_spin_pull(call: CallbackQuery):
     
     db_exec("UPDATE spins SET stage='spinning' WHERE game_id=? AND user_id=?", (game_id, uid), commit=True)
     
-    def _edit(text: str, kb=None):
+    def _edit(text: str, kb=None, frame: bool = False):
+        prio = EDIT_PRIO_FRAME if frame else EDIT_PRIO_NORMAL
+        deadline = (time.time() + EDIT_FRAME_TTL_SEC) if frame else None
         if inline_id:
-            limited_edit_message_text(text=text, inline_id=inline_id, reply_markup=kb, parse_mode="HTML")
+            limited_edit_message_text(text=text, inline_id=inline_id, reply_markup=kb, parse_mode="HTML",
+                                      priority=prio, deadline=deadline)
         else:
-            limited_edit_message_text(text=text, chat_id=msg_chat_id, msg_id=msg_id, reply_markup=kb, parse_mode="HTML")
+            limited_edit_message_text(text=text, chat_id=msg_chat_id, msg_id=msg_id, reply_markup=kb, parse_mode="HTML",
+                                      priority=prio, deadline=deadline)
 
     def run_spin():
         try:
-            grow = db_one("SELECT roulette_format, stake_cents, turn_index, COALESCE(game_type,'roulette'), COALESCE(cross_round,1) FROM games WHERE game_id=?", (game_id,))
-            if not grow:
+            gs = live_game(game_id)
+            if gs is None:
                 bot.answer_callback_query(call.id, "Игра не найдена.", show_alert=True)
                 return
             
-            rfmt, stake_cents, turn_index, game_type, cross_round = grow
+            rfmt, stake_cents, turn_index, game_type, cross_round = (
+                gs.roulette_format, gs.stake_cents, gs.turn_index, gs.game_type, gs.cross_round
+            )
             stake_now = int(stake_cents)
             add_cents = 0
             if game_type == "cross":
                 stake_now, add_cents = cross_stake_for_round(int(stake_cents), int(cross_round))
                     
-            rr = db_one("SELECT creator_id FROM games WHERE game_id=?", (game_id,))
-            creator_id = int((rr[0] if rr else 0) or 0)
+            creator_id = int(gs.creator_id or 0)
                 
-            strow = db_one("SELECT status FROM game_players WHERE game_id=? AND user_id=?", (game_id, uid))
-            pstatus = (strow[0] if strow else "") or ""
+            pstatus = live_game_player_status(game_id, uid)
                 
             title = "1×3" if rfmt == "1x3" else ("3×3" if rfmt == "3x3" else "3×5")
+            # Веса и фальшивый клевер — один раз на ход, а не на каждый кадр
+            ww = roulette_weights_for(uid, rfmt, game_id)
+            clover_on = shop_get_active_for_game(uid, game_id).get("fake_clover", 0) > 0
             def make_rand_state():
-                ww = roulette_weights_for(uid, rfmt, game_id)
                 if rfmt == "1x3":
                     st = [weighted_pick(ww) for _ in range(3)]
-                    return apply_fake_clover_to_state(uid, rfmt, st, game_id)
-                if rfmt == "3x3":
+                elif rfmt == "3x3":
                     st = [[weighted_pick(ww) for _ in range(3)] for __ in range(3)]
-                    return apply_fake_clover_to_state(uid, rfmt, st, game_id)
-                st = [[weighted_pick(ww) for _ in range(5)] for __ in range(3)]
-                return apply_fake_clover_to_state(uid, rfmt, st, game_id)
+                else:
+                    st = [[weighted_pick(ww) for _ in range(5)] for __ in range(3)]
+                return fake_clover_apply(rfmt, st) if clover_on else st
             def render_state(state):
                 if rfmt == "1x3":
                     return render_1x3(state)
@@ -8547,6 +10972,9 @@ def on_spin_pull(call: CallbackQuery):
             sleep_s = 0.9 if rfmt == "3x5" else 0.7 
                 
             for _ in range(steps):
+                # Лимитер захлёбывается — остаток анимации пропускаем, итог уходит сразу
+                if not EDIT_LIMITER.animation_ok():
+                    break
                 st = make_rand_state()
                 grid_txt = render_state(st)
                         
@@ -8559,8 +10987,8 @@ def on_spin_pull(call: CallbackQuery):
                     + f"Ход: <u>{html_escape(pname)}</u>\n"
                     + stake_line
                 )
-                _edit(text, kb=None)
-                time.sleep(sleep_s)
+                _edit(text, kb=None, frame=True)
+                yield sleep_s
                     
             final_state = make_rand_state()
             final_grid = render_state(final_state)
@@ -8575,145 +11003,157 @@ def on_spin_pull(call: CallbackQuery):
             boosts_line = render_active_boosts_line(pname, active_for_display)
             boosts_block = (boosts_line + "\n\n") if boosts_line else ""
 
-            if pepper_on: delta = int(delta) * 2
+            # Расчёт хода — одной транзакцией: баланс, результаты, статистика, рабство и указатель хода
+            with db_tx():
+                if pepper_on: delta = int(delta) * 2
 
-            # Применение страховки или пакета
-            insured = (active.get("insurance", 0) > 0) or (active.get("paket", 0) > 0)
-            insurance_triggered = False
-            chip_triggered = False
+                # Применение страховки или пакета
+                insured = (active.get("insurance", 0) > 0) or (active.get("paket", 0) > 0)
+                insurance_triggered = False
+                chip_triggered = False
 
-            if insured and int(delta) < 0:
-                protected_amt = abs(int(delta))
+                if insured and int(delta) < 0:
+                    protected_amt = abs(int(delta))
 
-                # Приоритет: пакет превращает минус в плюс
-                if active.get("paket", 0) > 0:
-                    chip_triggered = True
-                    shop_mark_used(uid, game_id, "paket")
-                    delta = protected_amt
-                else:
-                    insurance_triggered = True
-                    shop_mark_used(uid, game_id, "insurance")
-                    delta = 0
+                    # Приоритет: пакет превращает минус в плюс
+                    if active.get("paket", 0) > 0:
+                        chip_triggered = True
+                        shop_mark_used(uid, game_id, "paket")
+                        delta = protected_amt
+                    else:
+                        insurance_triggered = True
+                        shop_mark_used(uid, game_id, "insurance")
+                        delta = 0
 
-                # Общий шанс рабства
-                maybe_make_slave_by_shop_trigger(uid, protected_amt, game_id)
+                    # Общий шанс рабства
+                    maybe_make_slave_by_shop_trigger(uid, protected_amt, game_id)
             
-            # Для отображения усилений в тексте результата
-            active_for_display = dict(active)
-            boosts_line = render_active_boosts_line(pname, active_for_display)
-            boosts_block = (boosts_line + "\n\n") if boosts_line else ""
-
-            # Негативные "черепные долги" применяем только если НЕТ страховки
-            if not insured:
-                debt_mult = debt_mult_from_skulls(final_state, rfmt)
-                if debt_mult > 0:
-                    strow2 = db_one("SELECT status FROM game_players WHERE game_id=? AND user_id=?", (game_id, uid))
-                    pstatus2 = (strow2[0] if strow2 else "") or ""
-                    player2 = get_user(uid)
-                    is_demon2 = (player2 and int(player2[7] or 0) == 1)
+                # Для отображения усилений в тексте результата
+                active_for_display = dict(active)
+                boosts_line = render_active_boosts_line(pname, active_for_display)
+                boosts_block = (boosts_line + "\n\n") if boosts_line else ""
+
+                # Негативные "черепные долги" применяем только если НЕТ страховки
+                if not insured:
+                    debt_mult = debt_mult_from_skulls(final_state, rfmt)
+                    if debt_mult > 0:
+                        strow2 = db_one("SELECT status FROM game_players WHERE game_id=? AND user_id=?", (game_id, uid))
+                        pstatus2 = (strow2[0] if strow2 else "") or ""
+                        player2 = get_user(uid)
+                        is_demon2 = (player2 and int(player2[7] or 0) == 1)
                     
-                    if (not is_demon2) and (pstatus2 != "life"):
-                        bal_now = get_balance_cents(uid)
-                        debt_cents = int(debt_mult) * int(stake_now)
-                        predicted = bal_now + int(delta)
-                        target = -debt_cents
-                        final_balance = min(predicted, bal_now, target)
-                        delta = int(final_balance - bal_now)
-                        if final_balance < 0:
-                            set_slave_buyout(uid, abs(int(final_balance)) * 100) # назначение цены рабу
+                        if (not is_demon2) and (pstatus2 != "life"):
+                            bal_now = get_balance_cents(uid)
+                            debt_cents = int(debt_mult) * int(stake_now)
+                            predicted = bal_now + int(delta)
+                            target = -debt_cents
+                            final_balance = min(predicted, bal_now, target)
+                            delta = int(final_balance - bal_now)
+                            if final_balance < 0:
+                                set_slave_buyout(uid, abs(int(final_balance)) * 100) # назначение цены рабу
                     
-            # Дьявольский перец
-            if pepper_on and pepper_triggers_demon(final_state, rfmt):
-                rr_pep = db_one("SELECT user_id FROM users WHERE demon=1 ORDER BY RANDOM() LIMIT 1")
-                if rr_pep:
-                    demon_id = int(rr_pep[0])
-                    slavery_add_owner(uid, demon_id, 6000)
+                # Дьявольский перец
+                if pepper_on and pepper_triggers_demon(final_state, rfmt):
+                    rr_pep = db_one("SELECT user_id FROM users WHERE demon=1 ORDER BY RANDOM() LIMIT 1")
+                    if rr_pep:
+                        demon_id = int(rr_pep[0])
+                        slavery_add_owner(uid, demon_id, 6000)
             
-            u = get_user(uid)
-            is_demon = (u and int(u[7] or 0) == 1)
-            if not is_demon:
-                if delta > 0:
-                    kept = apply_slave_cut(uid, delta, reason="roulette")
-                    add_balance(uid, kept)
-                else:
-                    add_balance(uid, delta)
-                
-            if game_type == "cross":
-                db_exec("""
-                        INSERT INTO game_results (game_id, user_id, delta_cents, finished)
-                        VALUES (?,?,?,1)
-                        ON CONFLICT(game_id, user_id) DO UPDATE SET
-                            delta_cents = COALESCE(game_results.delta_cents, 0) + excluded.delta_cents,
-                            finished = 1
-                        """, (game_id, uid, int(delta)), commit=True)
-            else:
-                db_exec("""
-                        INSERT INTO game_results (game_id, user_id, delta_cents, finished)
-                        VALUES (?,?,?,1)
-                        ON CONFLICT(game_id, user_id) DO UPDATE SET delta_cents=excluded.delta_cents, finished=1
-                        """, (game_id, uid, int(delta)), commit=True)
+                u = get_user(uid)
+                is_demon = (u and int(u[7] or 0) == 1)
+                if not is_demon:
+                    if delta > 0:
+                        credit_income(uid, delta, "roulette", game_id)
+                    else:
+                        add_balance(uid, delta, "roulette", game_id)
                 
-            if game_type != "cross":
-                db_exec("INSERT OR IGNORE INTO game_stats (user_id) VALUES (?)", (uid,), commit=True)
-                if delta >= 0:
-                    db_exec(
-                        "UPDATE game_stats SET games_total=games_total+1, wins=wins+1, max_win_cents=MAX(max_win_cents, ?) WHERE user_id=?",
-                        (int(delta), uid), commit=True
-                    )
-                else:
-                    db_exec(
-                        "UPDATE game_stats SET games_total=games_total+1, losses=losses+1, max_lose_cents=MAX(max_lose_cents, ?) WHERE user_id=?",
-                        (int(abs(delta)), uid), commit=True
-                    )
-                bump_game_type_stat(uid, game_type)
-            elif int(cross_round) >= 9:
-                rr_tot = db_one("SELECT delta_cents FROM game_results WHERE game_id=? AND user_id=?", (game_id, uid))
-                tot = int((rr_tot[0] if rr_tot else 0) or 0)
-                db_exec("INSERT OR IGNORE INTO game_stats (user_id) VALUES (?)", (uid,), commit=True)
-                if tot >= 0:
-                    db_exec(
-                        "UPDATE game_stats SET games_total=games_total+1, wins=wins+1, max_win_cents=MAX(max_win_cents, ?) WHERE user_id=?",
-                        (int(tot), uid), commit=True
-                    )
+                if game_type == "cross":
+                    db_exec("""
+                            INSERT INTO game_results (game_id, user_id, delta_cents, finished)
+                            VALUES (?,?,?,1)
+                            ON CONFLICT(game_id, user_id) DO UPDATE SET
+                                delta_cents = COALESCE(game_results.delta_cents, 0) + excluded.delta_cents,
+                                finished = 1
+                            """, (game_id, uid, int(delta)), commit=True)
                 else:
-                    db_exec(
-                        "UPDATE game_stats SET games_total=games_total+1, losses=losses+1, max_lose_cents=MAX(max_lose_cents, ?) WHERE user_id=?",
-                        (int(abs(tot)), uid), commit=True
-                    )
-                bump_game_type_stat(uid, game_type)
+                    db_exec("""
+                            INSERT INTO game_results (game_id, user_id, delta_cents, finished)
+                            VALUES (?,?,?,1)
+                            ON CONFLICT(game_id, user_id) DO UPDATE SET delta_cents=excluded.delta_cents, finished=1
+                            """, (game_id, uid, int(delta)), commit=True)
+                
+                if game_type != "cross":
+                    db_exec("INSERT OR IGNORE INTO game_stats (user_id) VALUES (?)", (uid,), commit=True)
+                    if delta >= 0:
+                        db_exec(
+                            "UPDATE game_stats SET games_total=games_total+1, wins=wins+1, max_win_cents=MAX(max_win_cents, ?) WHERE user_id=?",
+                            (int(delta), uid), commit=True
+                        )
+                    else:
+                        db_exec(
+                            "UPDATE game_stats SET games_total=games_total+1, losses=losses+1, max_lose_cents=MAX(max_lose_cents, ?) WHERE user_id=?",
+                            (int(abs(delta)), uid), commit=True
+                        )
+                    bump_game_type_stat(uid, game_type)
+                elif int(cross_round) >= 9:
+                    rr_tot = db_one("SELECT delta_cents FROM game_results WHERE game_id=? AND user_id=?", (game_id, uid))
+                    tot = int((rr_tot[0] if rr_tot else 0) or 0)
+                    db_exec("INSERT OR IGNORE INTO game_stats (user_id) VALUES (?)", (uid,), commit=True)
+                    if tot >= 0:
+                        db_exec(
+                            "UPDATE game_stats SET games_total=games_total+1, wins=wins+1, max_win_cents=MAX(max_win_cents, ?) WHERE user_id=?",
+                            (int(tot), uid), commit=True
+                        )
+                    else:
+                        db_exec(
+                            "UPDATE game_stats SET games_total=games_total+1, losses=losses+1, max_lose_cents=MAX(max_lose_cents, ?) WHERE user_id=?",
+                            (int(abs(tot)), uid), commit=True
+                        )
+                    bump_game_type_stat(uid, game_type)
 
-            order = turn_order_get(game_id)
-            if not order:
-                return
+                order = turn_order_get(game_id)
+                if not order:
+                    return
                     
-            if (not is_demon) and (pstatus == "life") and (delta < 0) and creator_id:
-                set_slave_buyout(uid, abs(delta) * 100) # назначение цены рабу
-                owner_id = pick_life_owner(game_id, int(uid), int(creator_id) if creator_id else None)
-                if owner_id and int(owner_id) != int(uid):
-                    db_exec("INSERT OR IGNORE INTO slave_meta (slave_id) VALUES (?)", (int(uid),), commit=True)
-                    db_exec("UPDATE slave_meta SET strikes=strikes+1 WHERE slave_id=?", (int(uid),), commit=True)
-                    existed = db_one("SELECT 1 FROM slavery WHERE slave_id=? AND owner_id=?", (int(uid), int(owner_id)))
-                    db_exec(
-                        "INSERT OR REPLACE INTO slavery (slave_id, owner_id, share_bp) VALUES (?,?,?)",
-                        (int(uid), int(owner_id), 6000), commit=True
-                    )
+                if (not is_demon) and (pstatus == "life") and (delta < 0) and creator_id:
+                    set_slave_buyout(uid, abs(delta) * 100) # назначение цены рабу
+                    owner_id = pick_life_owner(game_id, int(uid), int(creator_id) if creator_id else None)
+                    if owner_id and int(owner_id) != int(uid):
+                        db_exec("INSERT OR IGNORE INTO slave_meta (slave_id) VALUES (?)", (int(uid),), commit=True)
+                        db_exec("UPDATE slave_meta SET strikes=strikes+1 WHERE slave_id=?", (int(uid),), commit=True)
+                        existed = db_one("SELECT 1 FROM slavery WHERE slave_id=? AND owner_id=?", (int(uid), int(owner_id)))
+                        db_exec(
+                            "INSERT OR REPLACE INTO slavery (slave_id, owner_id, share_bp) VALUES (?,?,?)",
+                            (int(uid), int(owner_id), 6000), commit=True
+                        )
             
-                    if not existed:
-                        ou = get_user(int(owner_id))
-                        oname = (ou[2] if ou and ou[2] else "Игрок")
-                        oun = (ou[1] if ou and ou[1] else "")
-                        o_tag = f" (@{html_escape(oun)})" if oun else ""
-                        notify_safe(uid, f"Ты проиграл свою свободу. С этого момента ты личная собственность: <b>{html_escape(oname)}</b>{o_tag}")
+                        if not existed:
+                            ou = get_user(int(owner_id))
+                            oname = (ou[2] if ou and ou[2] else "Игрок")
+                            oun = (ou[1] if ou and ou[1] else "")
+                            o_tag = f" (@{html_escape(oun)})" if oun else ""
+                            db_after_commit(notify_safe, uid, f"Ты проиграл свою свободу. С этого момента ты личная собственность: <b>{html_escape(oname)}</b>{o_tag}")
                 
-            current_pos = int(turn_index) % len(order)
-            is_round_last = (current_pos == len(order) - 1)
+                current_pos = int(turn_index) % len(order)
+                is_round_last = (current_pos == len(order) - 1)
+                if game_type == "cross" and is_round_last and int(cross_round) < 9:
+                    next_round = int(cross_round) + 1
+                    db_exec("UPDATE games SET cross_round=?, roulette_format=?, turn_index=0 WHERE game_id=?",
+                                        (next_round, cross_format_for_round(next_round), game_id), commit=True)
+                    db_after_commit(live_game_set, game_id, cross_round=next_round,
+                                    roulette_format=cross_format_for_round(next_round), turn_index=0)
+                elif is_round_last:
+                    db_exec("UPDATE games SET state='finished' WHERE game_id=?", (game_id,), commit=True)
+                    db_after_commit(live_game_evict, game_id)
+                else:
+                    db_exec("UPDATE games SET turn_index=? WHERE game_id=?", (current_pos + 1, game_id), commit=True)
+                    db_after_commit(live_game_set, game_id, turn_index=current_pos + 1)
                 
             header = "⟢♣♦ Рулетка ♥♠⟣" if game_type != "cross" else "⟢♣♦ Марафон рулетка ♥♠⟣"
             round_line = f"Раунд: <b>{int(cross_round)}</b>\n" if game_type == "cross" else ""
             result_line = f"Результат <u>{html_escape(pname)}</u>: <b>{cents_to_money_str(delta)}</b>$"
                 
-            strow = db_one("SELECT status FROM game_players WHERE game_id=? AND user_id=?", (game_id, uid))
-            pstatus = (strow[0] if strow else "") or ""
+            pstatus = live_game_player_status(game_id, uid)
             if pstatus == "life":
                 stake_line = "Ставка: <b>1000$</b>"
             else:
@@ -8723,9 +11163,6 @@ def on_spin_pull(call: CallbackQuery):
                 
             if game_type == "cross" and is_round_last and int(cross_round) < 9:
                 next_round = int(cross_round) + 1
-                next_fmt = cross_format_for_round(next_round)
-                db_exec("UPDATE games SET cross_round=?, roulette_format=?, turn_index=0 WHERE game_id=?",
-                                    (next_round, next_fmt, game_id), commit=True)
                 
                 order = turn_order_get(game_id)
                 next_uid = int(order[0]) if order else int(uid)
@@ -8746,7 +11183,6 @@ def on_spin_pull(call: CallbackQuery):
                 _edit(final_text, kb=kb)
                 
             elif is_round_last:
-                db_exec("UPDATE games SET state='finished' WHERE game_id=?", (game_id,), commit=True)
                 try:
                     for pid in set(order):
                         shop_tick_after_game(int(pid), game_id)
@@ -8756,6 +11192,7 @@ def on_spin_pull(call: CallbackQuery):
                 apply_demon_life_settlement(game_id)
                 update_demon_streak_after_game(game_id)   
                 emancipate_slaves_after_game(game_id)
+                status_cache_invalidate_game(game_id)
                 
                 rr2 = db_one("SELECT creator_id FROM games WHERE game_id=?", (game_id,))
                 creator_id2 = int((rr2[0] if rr2 else 0) or 0)
@@ -8777,8 +11214,6 @@ def on_spin_pull(call: CallbackQuery):
                 next_user = get_user(next_uid)
                 next_name = next_user[2] if next_user and next_user[2] else "Игрок"
                 
-                db_exec("UPDATE games SET turn_index=? WHERE game_id=?", (next_index, game_id), commit=True)
-                
                 kb = InlineKeyboardMarkup()
                 kb.add(InlineKeyboardButton(
                     f"Ход {next_name}",
@@ -8802,12 +11237,13 @@ def on_spin_pull(call: CallbackQuery):
             send_error_report(f"run_spin game_id={game_id} uid={uid}", e)
         finally:
             db_exec("UPDATE spins SET stage='done' WHERE game_id=? AND user_id=?", (game_id, uid), commit=True)
+            status_cache_invalidate(uid)
     
-    threading.Thread(target=run_spin, daemon=True).start()
+    SCHEDULER.run_steps(run_spin())
     bot.answer_callback_query(call.id)
     return
 
-@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("life:accept:"))
+@cb_route("life:accept")
 def on_life_accept(call: CallbackQuery):
     base, owner = cb_unpack(call.data)
     clicker = call.from_user.id
@@ -8834,7 +11270,7 @@ def on_life_accept(call: CallbackQuery):
         return
 
     cur.execute("INSERT OR IGNORE INTO slave_meta (slave_id) VALUES (?)", (clicker,))
-    conn.commit()
+    db_commit()
     cur.execute("SELECT COALESCE(life_uses,0) FROM slave_meta WHERE slave_id=?", (clicker,))
     life_uses = int((cur.fetchone() or (0,))[0] or 0)
     if life_uses >= MAX_LIFE_STAKES:
@@ -8842,9 +11278,8 @@ def on_life_accept(call: CallbackQuery):
         return
     u = get_user(clicker)
     bal = int(u[5] or 0) if u else 0
-    if bal < 0:
-        add_balance(clicker, -bal) 
-    add_balance(clicker, stake_cents)
+    # долг списывается, ставка на жизнь выдаётся — одной проводкой
+    add_balance(clicker, stake_cents - min(0, bal), "life", game_id)
 
     cur.execute("SELECT status FROM game_players WHERE game_id=? AND user_id=?", (game_id, clicker))
     st = (cur.fetchone() or ("",))[0]
@@ -8861,13 +11296,15 @@ def on_life_accept(call: CallbackQuery):
 
     cur.execute("UPDATE game_players SET status='life' WHERE game_id=? AND user_id=?", (game_id, clicker))
     cur.execute("DELETE FROM life_wait WHERE game_id=? AND user_id=?", (game_id, clicker))
-    conn.commit()
+    db_commit()
+    live_game_evict(game_id)
 
     cur.execute("SELECT COUNT(*) FROM life_wait WHERE game_id=?", (game_id,))
     pending = int(cur.fetchone()[0] or 0)
     if pending == 0:
         cur.execute("UPDATE games SET state='playing' WHERE game_id=?", (game_id,))
-        conn.commit()
+        db_commit()
+        live_game_evict(game_id)
 
         order = turn_order_get(game_id)
         if len(order) >= 2:
@@ -8902,7 +11339,7 @@ def owns_slaves(uid: int) -> bool:
 
 def get_game_stats(uid: int) -> Tuple[int,int,int,int,int]:
     cur.execute("INSERT OR IGNORE INTO game_stats (user_id) VALUES (?)", (uid,))
-    conn.commit()
+    db_commit()
     cur.execute("SELECT games_total, wins, losses, max_win_cents, max_lose_cents FROM game_stats WHERE user_id=?", (uid,))
     row = cur.fetchone()
     return tuple(int(x or 0) for x in row)
@@ -8912,11 +11349,7 @@ def build_profile_summary_text(view_uid: int) -> Optional[str]:
     if not u or not u[2]:
         return None
 
-    cur.execute("SELECT user_id FROM users WHERE demon=0")
-    uids = [int(r[0]) for r in cur.fetchall()]
-    uids.sort(key=lambda x: top_value_cents(x), reverse=True)
-
-    place = (uids.index(int(view_uid)) + 1) if (int(u[7] or 0) == 0 and int(view_uid) in uids) else "-"
+    place = (top_place(int(view_uid)) or "-") if int(u[7] or 0) == 0 else "-"
     status = compute_status(int(view_uid))
 
     return (
@@ -8979,53 +11412,76 @@ def slavery_add_owner(slave_id: int, owner_id: int, share_bp: int = 6000) -> boo
         commit=True
     )
 
+    status_cache_invalidate(slave_id)
+
     inserted = (rc or 0) > 0
     return inserted and (not existed)
 
+# Оценка выплат за последние SLAVE_EARN_WINDOW_SEC по двум корзинам сводки:
+# текущая целиком + предыдущая пропорционально непрошедшей части окна.
+# Именованные параметры: :now, :w (= SLAVE_EARN_WINDOW_SEC).
+SLAVE_EARN_WINDOW_SQL = """
+    CASE
+      WHEN s.bucket_ts = (:now / :w) * :w
+        THEN s.bucket_cents + s.prev_bucket_cents * (:w - (:now - s.bucket_ts)) / :w
+      WHEN s.bucket_ts = (:now / :w) * :w - :w
+        THEN s.bucket_cents * (:w - (:now - s.bucket_ts - :w)) / :w
+      ELSE 0
+    END
+"""
+
+SLAVE_EARN_SUMMARY_UPSERT_SQL = """
+    INSERT INTO slave_earn_summary
+        (slave_id, owner_id, last_credit_cents, last_ts, bucket_ts, bucket_cents, prev_bucket_cents)
+    VALUES (?,?,?,?,?,?,0)
+    ON CONFLICT(slave_id, owner_id) DO UPDATE SET
+        prev_bucket_cents = CASE
+            WHEN excluded.bucket_ts = bucket_ts THEN prev_bucket_cents
+            WHEN excluded.bucket_ts = bucket_ts + ? THEN bucket_cents
+            ELSE 0 END,
+        bucket_cents = CASE
+            WHEN excluded.bucket_ts = bucket_ts THEN bucket_cents + excluded.bucket_cents
+            ELSE excluded.bucket_cents END,
+        bucket_ts = excluded.bucket_ts,
+        last_credit_cents = excluded.last_credit_cents,
+        last_ts = excluded.last_ts
+"""
+
 def slave_profit_lasth(slave_id: int, owner_id: int) -> int:
-    """Сумма выплат от раба владельцу за последние часы."""
-    ts0 = now_ts() - 4 * 3600 # время последней выплаты
+    """Сумма выплат от раба владельцу за последние часы (по сводке)."""
     row = db_one(
-        "SELECT COALESCE(SUM(amount_cents),0) FROM slave_earn_log WHERE slave_id=? AND owner_id=? AND ts>=?",
-        (int(slave_id), int(owner_id), int(ts0))
+        f"SELECT {SLAVE_EARN_WINDOW_SQL} FROM slave_earn_summary s WHERE s.slave_id=:sid AND s.owner_id=:oid",
+        {"now": now_ts(), "w": SLAVE_EARN_WINDOW_SEC, "sid": int(slave_id), "oid": int(owner_id)}
     )
     return int((row[0] if row else 0) or 0)
 
+SLAVE_LAST_CREDIT_SQL = "SELECT last_credit_cents FROM slave_earn_summary WHERE slave_id=? AND owner_id=?"
+
 def slave_last_credit(slave_id: int, owner_id: int) -> Optional[int]:
     """
     Последнее зачисление (в центах), которое этот раб перечислил конкретному владельцу.
     Если начислений не было — None.
     """
-    row = db_one(
-        "SELECT amount_cents FROM slave_earn_log "
-        "WHERE slave_id=? AND owner_id=? "
-        "ORDER BY ts DESC LIMIT 1",
-        (int(slave_id), int(owner_id))
-    )
+    row = db_one(SLAVE_LAST_CREDIT_SQL, (int(slave_id), int(owner_id)))
     if not row:
         return None
     return int(row[0] or 0)
 
-def apply_slave_cut(slave_id: int, income_cents: int, reason: str = "") -> int:
+def slave_cut_split(slave_id: int, income_cents: int) -> Tuple[int, List[Tuple[int, int]]]:
     """
-    Потокобезопасная версия.
-    Если пользователь раб — удерживаем доли share_bp и раздаём владельцам.
-    Возвращает income_cents ПОСЛЕ удержания.
+    Если пользователь раб — доли владельцев по share_bp.
+    Возвращает (остаток рабу, [(owner_id, доля)]). Денег не двигает.
     """
     income_cents = int(income_cents or 0)
     if income_cents <= 0:
-        return income_cents
+        return income_cents, []
 
     owners = db_all(
         "SELECT owner_id, share_bp FROM slavery WHERE slave_id=? ORDER BY share_bp DESC",
         (int(slave_id),)
     )
-    if not owners:
-        return income_cents
-
     kept = income_cents
-    ts = now_ts()
-
+    parts = []
     for owner_id, share_bp in owners:
         owner_id = int(owner_id or 0)
         share_bp = int(share_bp or 0)
@@ -9037,20 +11493,39 @@ def apply_slave_cut(slave_id: int, income_cents: int, reason: str = "") -> int:
             continue
 
         kept -= part
+        parts.append((owner_id, part))
+    return kept, parts
 
-        add_balance(owner_id, part)
-
-        db_exec(
+def slave_cut_record(slave_id: int, parts: List[Tuple[int, int]]):
+    """Учёт выплаченных долей: earned_cents, журнал заработка и сводка для /rabs."""
+    if not parts:
+        return
+    ts = now_ts()
+    db_exec_many(
+        "UPDATE slavery SET earned_cents=COALESCE(earned_cents,0)+? WHERE slave_id=? AND owner_id=?",
+        [(int(part), int(slave_id), int(owner_id)) for owner_id, part in parts],
+        commit=True
+    )
+    for owner_id, part in parts:
+        DB_WRITER.submit(
             "INSERT INTO slave_earn_log (slave_id, owner_id, ts, amount_cents) VALUES (?,?,?,?)",
-            (int(slave_id), int(owner_id), int(ts), int(part)),
-            commit=True
+            (int(slave_id), int(owner_id), int(ts), int(part))
         )
-        db_exec(
-            "UPDATE slavery SET earned_cents=COALESCE(earned_cents,0)+? WHERE slave_id=? AND owner_id=?",
-            (int(part), int(slave_id), int(owner_id)),
-            commit=True
+        DB_WRITER.submit(
+            SLAVE_EARN_SUMMARY_UPSERT_SQL,
+            (int(slave_id), int(owner_id), int(part), int(ts),
+             (int(ts) // SLAVE_EARN_WINDOW_SEC) * SLAVE_EARN_WINDOW_SEC, int(part), SLAVE_EARN_WINDOW_SEC)
         )
-    
+
+def credit_income(uid: int, income_cents: int, kind: str, ref: str = "", payer: int = LEDGER_HOUSE) -> int:
+    """
+    Доход пользователя одной проводкой: payer → доли владельцев (если раб) + остаток самому.
+    Возвращает остаток, зачисленный пользователю.
+    """
+    kept, parts = slave_cut_split(uid, income_cents)
+    with db_tx():
+        ledger_post(parts + [(int(uid), int(kept))], kind, ref, counter=payer)
+        slave_cut_record(uid, parts)
     return kept
 
 def set_slave_buyout(slave_id: int, buyout_cents: int):
@@ -9102,6 +11577,9 @@ def get_slave_owners(slave_id: int):
     return [(int(o), int(bp or 0)) for (o, bp) in rows]
 
 def notify_safe(uid: int, text: str):
+    if db_in_tx():
+        db_after_commit(notify_safe, uid, text)
+        return
     try:
         bot.send_message(int(uid), text, parse_mode="HTML")
     except Exception:
@@ -9111,16 +11589,16 @@ def remove_owner_from_slave(slave_id: int, owner_id: int) -> bool:
     cur.execute("SELECT 1 FROM slavery WHERE slave_id=? AND owner_id=?", (int(slave_id), int(owner_id)))
     existed = cur.fetchone() is not None
     if existed:
-        cur.execute("DELETE FROM slavery WHERE slave_id=? AND owner_id=?", (int(slave_id), int(owner_id)))
-        conn.commit()
+        db_exec("DELETE FROM slavery WHERE slave_id=? AND owner_id=?", (int(slave_id), int(owner_id)), commit=True)
+        status_cache_invalidate(slave_id)
     return existed
 
 def free_slave_fully(slave_id: int, reason: str):
     """Полное освобождение: удаляем все доли владельцев + обнуляем buyout."""
     owners = get_slave_owners(slave_id)
-    cur.execute("DELETE FROM slavery WHERE slave_id=?", (int(slave_id),))
-    conn.commit()
+    db_exec("DELETE FROM slavery WHERE slave_id=?", (int(slave_id),), commit=True)
     clear_slave_buyout(slave_id)
+    status_cache_invalidate(slave_id)
 
     su = get_user(slave_id)
     sname = (su[2] if su and su[2] else "Игрок")
@@ -9164,12 +11642,25 @@ def owner_free_slave_with_reward(owner_id: int, slave_id: int) -> Tuple[bool, in
     reward_cents = max(0, buyout_cents // 10)
 
     if reward_cents > 0:
-        add_balance(owner_id, reward_cents)
+        add_balance(owner_id, reward_cents, "free_reward", str(slave_id))
 
     free_slave_fully(slave_id, "Владелец добровольно освободил раба.")
     return True, reward_cents
 
 
+# рабы + имена + сводка выплат одним запросом; параметры :now, :w, :oid
+RABS_LIST_SQL = f"""
+    SELECT sl.slave_id, COALESCE(sl.earned_cents,0), COALESCE(sl.share_bp,0), COALESCE(sl.acquired_ts,0),
+           u.short_name, u.username,
+           COALESCE({SLAVE_EARN_WINDOW_SQL}, 0),
+           COALESCE(s.last_credit_cents, 0)
+    FROM slavery sl
+    LEFT JOIN users u ON u.user_id = sl.slave_id
+    LEFT JOIN slave_earn_summary s ON s.slave_id = sl.slave_id AND s.owner_id = sl.owner_id
+    WHERE sl.owner_id=:oid
+    ORDER BY COALESCE(sl.earned_cents,0) DESC
+"""
+
 def build_rabs_list_text_kb(owner_id: int, viewer_id: int) -> tuple[str, Optional[InlineKeyboardMarkup]]:
     owner_id = int(owner_id)
     viewer_id = int(viewer_id)
@@ -9181,12 +11672,8 @@ def build_rabs_list_text_kb(owner_id: int, viewer_id: int) -> tuple[str, Optiona
     owner_name = (rr[0] if rr else None) or "Без имени"
     owner_username = (rr[1] if rr else "") or ""
 
-    rows = db_all("""
-        SELECT slave_id, COALESCE(earned_cents,0), COALESCE(share_bp,0), COALESCE(acquired_ts,0)
-        FROM slavery
-        WHERE owner_id=?
-        ORDER BY COALESCE(earned_cents,0) DESC
-    """, (owner_id,)) or []
+    # один запрос: рабы + имена + сводка выплат (без похода в slave_earn_log)
+    rows = db_all(RABS_LIST_SQL, {"now": now_ts(), "w": SLAVE_EARN_WINDOW_SEC, "oid": owner_id}) or []
 
     head_owner_un = f" (@{html_escape(owner_username)})" if owner_username else ""
     intro = f"Список рабов пользователя <b>{html_escape(owner_name)}</b>{head_owner_un}"
@@ -9201,15 +11688,13 @@ def build_rabs_list_text_kb(owner_id: int, viewer_id: int) -> tuple[str, Optiona
     kb = InlineKeyboardMarkup()
     slave_buttons = []
 
-    for i, (slave_id, earned_cents, _share_bp, _acquired_ts) in enumerate(top, 1):
+    for i, (slave_id, earned_cents, _share_bp, _acquired_ts, sname, sun, lasth, lastp) in enumerate(top, 1):
         slave_id = int(slave_id)
         earned_cents = int(earned_cents or 0)
-        lasth = int(slave_profit_lasth(slave_id, owner_id) or 0)
-        lastp = int(slave_last_credit(slave_id, owner_id) or 0)
-
-        sr = db_one("SELECT short_name, username FROM users WHERE user_id=?", (slave_id,))
-        sname = (sr[0] if sr else None) or "Без имени"
-        sun = (sr[1] if sr else "") or ""
+        lasth = int(lasth or 0)
+        lastp = int(lastp or 0)
+        sname = sname or "Без имени"
+        sun = sun or ""
 
         uname_part = f" (@{html_escape(sun)})" if sun else ""
         lines.append(
@@ -9292,6 +11777,8 @@ def emancipate_slaves_after_game(game_id: str):
             if not is_slave(uid):
                 free_slave_fully(uid, "победа над владельцем в игре")
 
+SLAVES_BY_OWNER_SQL = "SELECT slave_id FROM slavery WHERE owner_id=? ORDER BY slave_id"
+
 def apply_demon_life_settlement(game_id: str):
     g = db_one("SELECT COALESCE(stake_kind,'money'), COALESCE(life_demon_id,0), COALESCE(demon_settled,0) FROM games WHERE game_id=?", (game_id,))
     if not g:
@@ -9325,16 +11812,15 @@ def apply_demon_life_settlement(game_id: str):
         demon_bal = get_balance_cents(loser_id)
         payout = demon_bal // 4 # % капитала
         if payout > 0:
-            add_balance(loser_id, -payout)
+            kept = credit_income(winner_id, payout, "demon_pay", payer=loser_id)
 
-            kept = apply_slave_cut(winner_id, payout, reason="demon_pay")
-            add_balance(winner_id, kept)
-
-            try:
-                ensure_daily_mail_row(winner_id)
-                _send_mail_prompt(winner_id, "demon_pay", kept)
-            except Exception:
-                pass
+            def _mail_demon_pay():
+                try:
+                    ensure_daily_mail_row(winner_id)
+                    _send_mail_prompt(winner_id, "demon_pay", kept)
+                except Exception:
+                    pass
+            db_after_commit(_mail_demon_pay)
         return
 
     # демон победил обычного: забирает душy 
@@ -9344,21 +11830,17 @@ def apply_demon_life_settlement(game_id: str):
         set_slave_buyout(loser_id, int(demon_bal) * 25) # цена выкупа
 
         if inserted:
-            try:
-                un = l[3] if l else ""
-                uname = f" (@{un})" if un else ""
-                bot.send_message(
-                    loser_id,
-                    f"Ты проиграл свою свободу. С этого момента ты личная собственность <b>{html_escape(w[2] or 'Демон')}</b>{uname}",
-                    parse_mode="HTML"
-                )
-            except Exception:
-                pass
+            un = l[3] if l else ""
+            uname = f" (@{un})" if un else ""
+            notify_safe(
+                loser_id,
+                f"Ты проиграл свою свободу. С этого момента ты личная собственность <b>{html_escape(w[2] or 'Демон')}</b>{uname}"
+            )
         return
 
     # демон победил демона: победителю отправляем список рабов проигравшего (команда /get)
     if w_is_demon and l_is_demon:
-        slaves = db_all("SELECT slave_id FROM slavery WHERE owner_id=? ORDER BY slave_id", (loser_id,))
+        slaves = db_all(SLAVES_BY_OWNER_SQL, (loser_id,))
         if not slaves:
             return
 
@@ -9380,10 +11862,13 @@ def apply_demon_life_settlement(game_id: str):
 
         lines.append("")
         lines.append("Забрать раба: /get @username")
-        try:
-            bot.send_message(winner_id, "\n".join(lines))
-        except Exception:
-            pass
+
+        def _send_loot_list():
+            try:
+                bot.send_message(winner_id, "\n".join(lines))
+            except Exception:
+                pass
+        db_after_commit(_send_loot_list)
 
 # DEV COMMANDS
 @bot.message_handler(commands=["devil"])
@@ -9402,13 +11887,17 @@ def cmd_devil(message):
             target = int(r[0])
     upsert_user(target, None)
     cur.execute("UPDATE users SET demon=1 WHERE user_id=?", (target,))
-    conn.commit()
+    db_commit()
+    status_cache_invalidate(target)
+    user_cache_invalidate(target)
     bot.reply_to(message, "Статус \"Демон\" установлен.")
 
+SHIFTS_DUE_SQL = "SELECT user_id FROM work_shift WHERE ends_ts <= ?"
+
 def _work_daemon():
     while True:
         try:
-            cur.execute("SELECT user_id FROM work_shift WHERE ends_ts <= ?", (now_ts(),))
+            cur.execute(SHIFTS_DUE_SQL, (now_ts(),))
             uids = [int(r[0]) for r in cur.fetchall()]
             for uid in uids:
                 finish_shift(uid)
@@ -9420,6 +11909,17 @@ def _work_daemon():
 threading.Thread(target=_work_daemon, daemon=True).start()
 threading.Thread(target=_mail_daemon, daemon=True).start()
 threading.Thread(target=_pm_autodelete_daemon, daemon=True).start()
+threading.Thread(target=_group_seen_daemon, daemon=True).start()
+
+try:
+    print("fsm states loaded:", fsm_load_all())
+except Exception as e:
+    send_error_report("fsm_load_all", e)
+
+try:
+    print("scheduled jobs resumed:", load_scheduled_jobs())
+except Exception as e:
+    send_error_report("load_scheduled_jobs", e)
 
 @bot.message_handler(commands=["human"])
 def cmd_human(message):
@@ -9436,13 +11936,239 @@ def cmd_human(message):
         r = cur.fetchone()
         if r:
             target = int(r[0])
-    cur.execute("SELECT demo_gift_cents FROM users WHERE user_id=?", (target,))
+    cur.execute("SELECT demo_gift_cents, COALESCE(balance_cents,0) FROM users WHERE user_id=?", (target,))
     r = cur.fetchone()
     gift = int(r[0] or 0) if r else 0
-    cur.execute("UPDATE users SET demon=0, balance_cents=? WHERE user_id=?", (gift, target))
-    conn.commit()
+    bal = int(r[1] or 0) if r else 0
+    with db_tx():
+        db_exec("UPDATE users SET demon=0 WHERE user_id=?", (target,), commit=True)
+        ledger_post([(target, gift - bal)], "human")
+    status_cache_invalidate(target)
+    user_cache_invalidate(target)
     bot.reply_to(message, "Статус \"Демон\" снят, профиль откатан.")
 
+def build_perf_report_text() -> str:
+    lines = ["Производительность", ""]
+
+    ws = db_wait_stats()
+    lines.append(f"БД: читателей {DB_READERS}")
+    for kind, title in (("writer", "писатель"), ("reader", "читатели")):
+        st = ws.get(kind) or {}
+        lines.append(
+            f"☛ {title}: захватов {int(st.get('n', 0))}, "
+            f"ожидание ср. {st.get('avg_ms', 0.0):.2f} мс, макс. {st.get('max_ms', 0.0):.1f} мс"
+        )
+
+    wb = dict(DB_WRITER.stats)
+    lines.append(
+        f"☛ фоновая запись: в очереди {DB_WRITER.pending()}, записано {wb['written']} "
+        f"пачками {wb['batches']}, схлопнуто {wb['coalesced']}, ошибок {wb['errors']}"
+    )
+
+    ss = dict(SCHEDULER.stats)
+    lines.append(
+        f"Планировщик: в очереди {SCHEDULER.pending()}, выполнено {ss['fired']}, "
+        f"отменено {ss['cancelled']}, ошибок {ss['errors']}"
+    )
+
+    lines.append(
+        f"GC игр: проходов {GAMES_GC_STATS['runs']}, в архив {GAMES_GC_STATS['games']}, "
+        f"удалено строк {GAMES_GC_STATS['rows']} (последний: {GAMES_GC_STATS['last_games']}/{GAMES_GC_STATS['last_rows']})"
+    )
+
+    sc = status_cache_stats()
+    total = sc["hits"] + sc["misses"]
+    rate = (sc["hits"] / total * 100.0) if total else 0.0
+    lines.append("")
+    lines.append(
+        f"Кэш статусов: {sc['size']}/{STATUS_CACHE_MAX}, попаданий {rate:.1f}% "
+        f"({sc['hits']}/{total}), сбросов {sc['invalidations']}"
+    )
+    uc = user_cache_stats()
+    utotal = uc["hits"] + uc["misses"]
+    urate = (uc["hits"] / utotal * 100.0) if utotal else 0.0
+    lines.append(
+        f"Кэш пользователей: {uc['size']}, попаданий {urate:.1f}% "
+        f"({uc['hits']}/{utotal}), сбросов {uc['invalidations']}"
+    )
+    em = EDIT_LIMITER.metrics()
+    lines.append(
+        f"Правки сообщений: в очереди {em['depth']} (чатов {em['chats']}, на паузе {em['blocked']}), "
+        f"отправлено {em['applied']}, схлопнуто {em['coalesced']}, кадров сброшено {em['frames_dropped']}, "
+        f"429: {em['429']}, задержка p50 {em['p50_ms']:.0f} мс, p99 {em['p99_ms']:.0f} мс"
+    )
+    fs = FSM_STATE.sizes()
+    lines.append(
+        f"Диалоги в памяти: регистрация {fs['reg']}, репорты {fs['report']}, сделки {fs['trade']}"
+    )
+    ist = dict(INLINE_STATS)
+    lines.append(
+        f"Inline: запросов {ist['queries']}, карточек посчитано {ist['built']}, пропущено {ist['skipped']}, "
+        f"не успели {ist['timeouts']}, ошибок {ist['errors']}, "
+        f"вытеснено в очереди {ist['superseded']}, прервано {ist['aborted']}"
+    )
+    lg = dict(LIVE_GAMES_STATS)
+    lines.append(
+        f"Живые игры: в памяти {live_games_count()}, обращений {lg['hits']}, "
+        f"загрузок {lg['loads']}, выселено {lg['evictions']}"
+    )
+    return "\n".join(lines)
+
+@bot.message_handler(commands=["perf"])
+def cmd_perf(message):
+    if message.from_user.id != OWNER_ID:
+        return
+    if message.chat.type != "private":
+        return
+    bot.reply_to(message, build_perf_report_text())
+
+# Проверка планов горячих запросов: схема копируется из рабочей базы в :memory:,
+# заполняется синтетикой, после ANALYZE каждый запрос гоняется через EXPLAIN QUERY PLAN.
+# Полный проход по таблице (SCAN без USING INDEX) = провал.
+QPLAN_SYNTH_ROWS = 3000
+
+# те же константы, что выполняются на местах вызова: поменял запрос — проверка видит новый.
+# Список собирается при вызове: часть констант (GC) объявлена ниже по файлу.
+def hot_queries() -> List[Tuple[str, str, object]]:
+    return [
+        ("slavery по владельцу", SLAVES_BY_OWNER_SQL, (7,)),
+        ("список рабов (/rabs)", RABS_LIST_SQL, {"now": 1_700_000_000, "w": SLAVE_EARN_WINDOW_SEC, "oid": 7}),
+        ("игры игрока (магазин)", USER_ACTIVE_GAMES_SQL, (7,)),
+        ("лобби игрока", USER_LOBBIES_SQL, (7,)),
+        ("смены к выплате", SHIFTS_DUE_SQL, (1_000,)),
+        ("антифрод переводов", TRANSFER_FRAUD_COUNTS_SQL, (10_000_000, 100_000_000, 7, 8, 1_000)),
+        ("поиск по @username", USER_BY_USERNAME_SQL, ("user7",)),
+        ("зависшие лобби", RESUME_LOBBY_JOBS_SQL, ()),
+        ("GC игр", GC_PICK_GAMES_SQL, (1_000, 200)),
+        ("топ", TOP_UIDS_SQL, (20,)),
+        ("отложенные задачи", SCHEDULED_JOBS_PAGE_SQL, (1_000.0, "", "", 500)),
+        ("сводка выплат", SLAVE_LAST_CREDIT_SQL, (7, 8)),
+    ]
+
+def _qplan_synthetic_db(n: int = QPLAN_SYNTH_ROWS) -> sqlite3.Connection:
+    mem = sqlite3.connect(":memory:")
+    schema = db_all(
+        "SELECT type, sql FROM sqlite_master "
+        "WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%' "
+        "ORDER BY CASE type WHEN 'table' THEN 0 ELSE 1 END"
+    )
+    for _type, sql in schema or []:
+        try:
+            mem.execute(sql)
+        except sqlite3.Error:
+            pass
+
+    rnd = random.Random(12345)
+    ts0 = 1_700_000_000
+    states = ["finished"] * 90 + ["cancelled"] * 6 + ["lobby", "playing", "choose_format", "lobby"]
+    fills = [
+        ("INSERT OR IGNORE INTO users (user_id, username, short_name, created_ts, contract_ts, balance_cents, demo_gift_cents, demon) "
+         "VALUES (?,?,?,?,?,?,?,?)",
+         lambda i: (i, f"user{i}", f"Имя{i}", ts0, ts0, rnd.randint(0, 10**9), 100000, int(i % 97 == 0))),
+        ("INSERT OR IGNORE INTO slavery (slave_id, owner_id, share_bp) VALUES (?,?,?)",
+         lambda i: (i, rnd.randint(1, n // 20), 6000)),
+        ("INSERT OR IGNORE INTO games (game_id, creator_id, state, stake_cents, created_ts) VALUES (?,?,?,?,?)",
+         lambda i: (f"g{i}", rnd.randint(1, n), rnd.choice(states), 100, ts0 - rnd.randint(0, 30 * 86400))),
+        ("INSERT OR IGNORE INTO game_players (game_id, user_id, status) VALUES (?,?,?)",
+         lambda i: (f"g{i // 3}", rnd.randint(1, n), "ready")),
+        ("INSERT OR IGNORE INTO work_shift (user_id, job_key, started_ts, ends_ts) VALUES (?,?,?,?)",
+         lambda i: (i, "job", ts0, ts0 + rnd.randint(-3600, 86400))),
+        ("INSERT INTO transfers (from_id, to_id, amount_cents, ts) VALUES (?,?,?,?)",
+         lambda i: (rnd.randint(1, n), rnd.randint(1, n), rnd.randint(1, 10**7), ts0 - rnd.randint(0, 86400))),
+        ("INSERT INTO slave_earn_log (slave_id, owner_id, ts, amount_cents) VALUES (?,?,?,?)",
+         lambda i: (rnd.randint(1, n), rnd.randint(1, n // 20), ts0 - rnd.randint(0, 86400), 100)),
+        ("INSERT OR IGNORE INTO slave_earn_summary (slave_id, owner_id, last_credit_cents, last_ts, bucket_ts) VALUES (?,?,?,?,?)",
+         lambda i: (i, rnd.randint(1, n // 20), 100, ts0, ts0)),
+        ("INSERT OR IGNORE INTO scheduled_jobs (kind, ref, arg, due_ts) VALUES (?,?,?,?)",
+         lambda i: ("lobby", f"g{i}", 0, ts0 + rnd.randint(0, 600))),
+    ]
+    for sql, gen in fills:
+        try:
+            mem.executemany(sql, [gen(i) for i in range(1, n + 1)])
+        except sqlite3.Error as e:
+            print("qplan fill failed:", sql.split("(")[0], repr(e))
+    mem.commit()
+    mem.execute("ANALYZE")
+    return mem
+
+def check_query_plans() -> List[Tuple[str, bool, str]]:
+    """[(название, ок, план)] для hot_queries() на синтетической базе."""
+    mem = _qplan_synthetic_db()
+    out: List[Tuple[str, bool, str]] = []
+    try:
+        for title, sql, params in hot_queries():
+            try:
+                rows = mem.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()
+            except sqlite3.Error as e:
+                out.append((title, False, f"ошибка: {e}"))
+                continue
+            details = [str(r[3]) for r in rows]
+            full_scan = any(d.startswith("SCAN") and "USING" not in d for d in details)
+            out.append((title, not full_scan, "; ".join(details)))
+    finally:
+        mem.close()
+    return out
+
+def build_qplan_report_text() -> str:
+    res = check_query_plans()
+    bad = [r for r in res if not r[1]]
+    lines = [f"Планы запросов: {len(res) - len(bad)}/{len(res)} по индексу", ""]
+    for title, ok, plan in res:
+        mark = "✓" if ok else "✗"
+        lines.append(f"{mark} {title}: {plan}")
+    return "\n".join(lines)
+
+def build_ledger_report_text() -> str:
+    r = ledger_reconcile()
+    lines = [
+        "Журнал денег",
+        "",
+        f"Проводок {r['postings']}, ног {r['legs']}, сумма ног {r['sum']} (должна быть 0)",
+        f"Казино: {cents_to_money_str(-r['house'])}$ выплачено игрокам",
+        f"Эскроу сделок: {cents_to_money_str(r['escrow'])}$, в открытых сделках {cents_to_money_str(r['hold'])}$",
+    ]
+    bad = r["mismatches"]
+    if not bad:
+        lines.append("Балансы сходятся с журналом.")
+    else:
+        lines.append(f"Расхождения ({len(bad)}):")
+        for uid, bal, led in bad:
+            lines.append(f"☛ {uid}: баланс {cents_to_money_str(bal)}$, журнал {cents_to_money_str(led)}$")
+    return "\n".join(lines)
+
+@bot.message_handler(commands=["ledger"])
+def cmd_ledger(message):
+    if message.from_user.id != OWNER_ID:
+        return
+    if message.chat.type != "private":
+        return
+    bot.reply_to(message, build_ledger_report_text())
+
+def build_routes_report_text() -> str:
+    rows = cb_route_stats()
+    if not rows:
+        return "Маршруты кнопок: нажатий ещё не было."
+    lines = ["Маршруты кнопок (вызовов, ошибок, p50/p95/p99 мс)", ""]
+    for route, n, errors, p50, p95, p99 in rows:
+        lines.append(f"☛ {route}: {n}, ош. {errors}, {p50:.1f} / {p95:.1f} / {p99:.1f}")
+    return "\n".join(lines)
+
+@bot.message_handler(commands=["routes"])
+def cmd_routes(message):
+    if message.from_user.id != OWNER_ID:
+        return
+    if message.chat.type != "private":
+        return
+    bot.reply_to(message, build_routes_report_text())
+
+@bot.message_handler(commands=["qplan"])
+def cmd_qplan(message):
+    if message.from_user.id != OWNER_ID:
+        return
+    if message.chat.type != "private":
+        return
+    bot.reply_to(message, build_qplan_report_text())
+
 @bot.message_handler(commands=["finance"])
 def cmd_finance(message):
     if message.from_user.id != OWNER_ID:
@@ -9502,7 +12228,7 @@ def cmd_finance(message):
                     f"Письмо отправлено пользователю @{uname} с суммой в размере {cents_to_money_str(amt)}$"
                 )
             else:
-                add_balance(uid, int(amt))
+                add_balance(uid, int(amt), "finance")
                 bot.reply_to(
                     message,
                     f"Пользователю @{uname} сразу зачислено {cents_to_money_str(amt)}$ "
@@ -9531,7 +12257,7 @@ def cmd_finance(message):
                 _send_mail_prompt(uid, f"owner_finance|{payload}", int(amt))
                 mailed += 1
             else:
-                add_balance(uid, int(amt))
+                add_balance(uid, int(amt), "finance")
                 instant += 1
         except Exception:
             failed += 1
@@ -9571,7 +12297,7 @@ def cmd_take(message):
         return
 
     uid = int(r[0])
-    add_balance(uid, -amt)
+    add_balance(uid, -amt, "take")
 
     bot.reply_to(message, f"Списано {cents_to_money_str(amt)}$ у пользователя @{uname}")
 
@@ -9596,12 +12322,13 @@ def cmd_addstatus(message):
         return
 
     uname = target[1:].strip()
-    rr = db_one("SELECT user_id FROM users WHERE username=? COLLATE NOCASE", (uname,))
+    rr = db_one(USER_BY_USERNAME_SQL, (uname,))
     if not rr:
         bot.reply_to(message, "Пользователь не найден в базе.")
         return
 
     uid = int(rr[0])
+    status_cache_invalidate(uid)
     if add_custom_status(uid, status_txt):
         bot.reply_to(message, f"Готово. Пользователю @{uname} добавлен статус: {status_txt}")
     else:
@@ -9684,7 +12411,7 @@ def cmd_work(message):
     uname = parts[1][1:].strip()
     job_query = parts[2].strip() if len(parts) >= 3 else ""
 
-    r = db_one("SELECT user_id FROM users WHERE username=? COLLATE NOCASE", (uname,))
+    r = db_one(USER_BY_USERNAME_SQL, (uname,))
     if not r:
         bot.reply_to(message, "Пользователь не найден в базе.")
         return
@@ -9755,7 +12482,7 @@ def cmd_delstat(message):
         return
 
     uname = parts[1][1:].strip()
-    rr = db_one("SELECT user_id FROM users WHERE username=? COLLATE NOCASE", (uname,))
+    rr = db_one(USER_BY_USERNAME_SQL, (uname,))
     if not rr:
         bot.reply_to(message, "Пользователь не найден в базе.")
         return
@@ -9766,6 +12493,7 @@ def cmd_delstat(message):
         return
 
     free_slave_fully(target_id, "Администратор снял статус раба")
+    status_cache_invalidate(target_id)
     bot.reply_to(message, f"Готово. Статус раба снят с @{uname}.")
 
 @bot.message_handler(commands=["blockcash"])
@@ -9823,7 +12551,7 @@ def cmd_blockcash(message):
                 "INSERT INTO transfer_block_log (action, user_id, until_ts, reason, created_ts, chat_id, msg_id) VALUES (?,?,?,?,?,?,?)",
                 ("manual_block", int(target_id), int(until_ts), "manual", int(ts), int(message.chat.id), int(message.message_id))
             )
-            conn.commit()
+            db_commit()
         except Exception as e:
             try:
                 conn.rollback()
@@ -9893,7 +12621,7 @@ def cmd_udblockcash(message):
             c.execute("SELECT until_ts, reason FROM transfer_blocks WHERE user_id=?", (int(target_id),))
             rr = c.fetchone()
             if not rr:
-                conn.commit()
+                db_commit()
                 bot.reply_to(message, "У пользователя нет активной блокировки переводов.")
                 return
 
@@ -9907,7 +12635,7 @@ def cmd_udblockcash(message):
                 ("manual_unblock", int(target_id), int(until_ts), (reason or "")[:200], now_ts(), int(message.chat.id), int(message.message_id))
             )
 
-            conn.commit()
+            db_commit()
         except Exception as e:
             try:
                 conn.rollback()
@@ -10081,6 +12809,12 @@ def cmd_chatlist(message):
     if message.chat.type != "private":
         return
 
+    try:
+        DB_WRITER.flush()
+        flush_group_seen()
+    except Exception:
+        pass
+
     rows = db_all(
         "SELECT chat_id, COALESCE(title,''), COALESCE(last_seen_ts,0) "
         "FROM known_group_chats "
@@ -10189,7 +12923,7 @@ def cmd_del(message):
         return
 
     uname = parts[1][1:].strip()
-    rr = db_one("SELECT user_id FROM users WHERE username=? COLLATE NOCASE", (uname,))
+    rr = db_one(USER_BY_USERNAME_SQL, (uname,))
     if not rr:
         bot.reply_to(message, "Пользователь не найден в базе.")
         return
@@ -10214,6 +12948,7 @@ def cmd_del(message):
 
             c.execute("DELETE FROM slavery WHERE slave_id=? OR owner_id=?", (target_id, target_id))
             c.execute("DELETE FROM slave_earn_log WHERE slave_id=? OR owner_id=?", (target_id, target_id))
+            c.execute("DELETE FROM slave_earn_summary WHERE slave_id=? OR owner_id=?", (target_id, target_id))
             c.execute("DELETE FROM slave_meta WHERE slave_id=?", (target_id,))
 
             c.execute("DELETE FROM demon_loot WHERE winner_id=? OR loser_id=? OR slave_id=?",
@@ -10249,7 +12984,13 @@ def cmd_del(message):
 
             c.execute("DELETE FROM game_players WHERE user_id=?", (target_id,))
             c.execute("DELETE FROM game_results WHERE user_id=?", (target_id,))
+            c.execute("DELETE FROM game_results_archive WHERE user_id=?", (target_id,))
 
+            # остаток на счёте закрываем в журнале, чтобы сверка сходилась
+            c.execute("SELECT COALESCE(balance_cents,0) FROM users WHERE user_id=?", (target_id,))
+            bal_row = c.fetchone()
+            if bal_row:
+                ledger_post_cur(c, [(target_id, -int(bal_row[0] or 0))], "delete")
             c.execute("DELETE FROM users WHERE user_id=?", (target_id,))
 
             for sid in affected_slaves:
@@ -10259,7 +13000,8 @@ def cmd_del(message):
                     c.execute("INSERT OR IGNORE INTO slave_meta (slave_id) VALUES (?)", (sid,))
                     c.execute("UPDATE slave_meta SET buyout_cents=0 WHERE slave_id=?", (sid,))
 
-            conn.commit()
+            db_commit()
+            live_games_clear()
         except Exception as e:
             try:
                 conn.rollback()
@@ -10273,6 +13015,10 @@ def cmd_del(message):
             except Exception:
                 pass
 
+    status_cache_invalidate(target_id, *affected_slaves)
+    user_cache_clear()
+    FSM_STATE.clear("reg", target_id)
+
     bot.reply_to(message, f"Готово. Пользователь @{uname} полностью удалён из базы.")
 
 @bot.message_handler(commands=["ban"])
@@ -10309,7 +13055,7 @@ def cmd_ban(message):
     reason = reason_nl if reason_nl else extra_reason
     reason = (reason or "").strip()
 
-    rr = db_one("SELECT user_id FROM users WHERE username=? COLLATE NOCASE", (uname,))
+    rr = db_one(USER_BY_USERNAME_SQL, (uname,))
     if not rr:
         bot.reply_to(message, "Пользователь не найден в базе.")
         return
@@ -10358,7 +13104,7 @@ def cmd_unban(message):
     uname = (m.group(1) or "").strip()
     reason = (m.group(2) or "").strip()
 
-    rr = db_one("SELECT user_id FROM users WHERE username=? COLLATE NOCASE", (uname,))
+    rr = db_one(USER_BY_USERNAME_SQL, (uname,))
     if not rr:
         bot.reply_to(message, "Пользователь не найден в базе.")
         return
@@ -10477,7 +13223,7 @@ def cmd_profile(message):
             return
 
         target_un = target_ref[1:].strip()
-        rr = db_one("SELECT user_id FROM users WHERE username=? COLLATE NOCASE", (target_un,))
+        rr = db_one(USER_BY_USERNAME_SQL, (target_un,))
         if not rr:
             bot.reply_to(message, "Пользователь не найден в базе.")
             return
@@ -10544,7 +13290,7 @@ def cmd_report(message):
 
     bot.send_message(message.chat.id, "Выберите категорию запроса:", reply_markup=kb)
 
-@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("report:"))
+@cb_route("report")
 def on_report_callbacks(call: CallbackQuery):
     base, owner = cb_unpack(call.data)
     clicker = call.from_user.id
@@ -10792,7 +13538,7 @@ def cmd_pay(message):
             return
 
         target_un = target_ref[1:].strip()
-        rr = db_one("SELECT user_id FROM users WHERE username=? COLLATE NOCASE", (target_un,))
+        rr = db_one(USER_BY_USERNAME_SQL, (target_un,))
         if not rr:
             bot.reply_to(message, "Пользователь не найден в базе данных нашей организации :(")
             return
@@ -10916,7 +13662,7 @@ def cmd_rabs(message):
 
     owner_un = parts[1][1:].strip()
     rr = db_one(
-        "SELECT user_id FROM users WHERE username=? COLLATE NOCASE",
+        USER_BY_USERNAME_SQL,
         (owner_un,)
     )
     if not rr:
@@ -11097,7 +13843,7 @@ def cmd_buyrab(message):
                     "INSERT OR REPLACE INTO buyrab_offer_resp (offer_id, owner_id, pay_cents, status) VALUES (?,?,?,0)",
                     (offer_id, int(oid), int(pay_cents)),
                 )
-            conn.commit()
+            db_commit()
         except Exception as e:
             try:
                 conn.rollback()
@@ -11172,7 +13918,7 @@ def cmd_buyout(message):
         return
 
     cur.execute("INSERT OR IGNORE INTO slave_meta (slave_id) VALUES (?)", (uid,))
-    conn.commit()
+    db_commit()
     cur.execute("SELECT buyout_cents FROM slave_meta WHERE slave_id=?", (uid,))
     buyout_cents = int((cur.fetchone() or (0,))[0] or 0)
 
@@ -11200,17 +13946,18 @@ def cmd_buyout(message):
     if total_bp <= 0:
         total_bp = 10000
 
-    add_balance(uid, -buyout_cents)
-
-    distributed = 0
+    legs = [(uid, -buyout_cents)]
+    paid = []
     for i, (oid, bp) in enumerate(owners):
         part = int((buyout_cents * bp) // total_bp) if bp > 0 else 0
         if i == 0:
             part += (buyout_cents - sum(int((buyout_cents * b) // total_bp) for _o, b in owners))
         if part > 0:
-            add_balance(oid, part)
-            distributed += part
-            notify_safe(oid, f"Раб выкупил себя. Сумма, которую он оставил вам за свою свободу <b>{cents_to_money_str(part)}</b>$",)
+            legs.append((oid, part))
+            paid.append((oid, part))
+    ledger_post(legs, "buyout", str(uid))
+    for oid, part in paid:
+        notify_safe(oid, f"Раб выкупил себя. Сумма, которую он оставил вам за свою свободу <b>{cents_to_money_str(part)}</b>$",)
 
     free_slave_fully(uid, "самовыкуп")
 
@@ -11346,7 +14093,7 @@ def cmd_buy(message):
     )
     for oid in other_owners:
         cur.execute("INSERT OR IGNORE INTO buy_offer_resp (offer_id, owner_id, status) VALUES (?,?,0)", (offer_id, oid))
-    conn.commit()
+    db_commit()
 
     buyer_u = get_user(buyer_id)
     buyer_name = (buyer_u[2] if buyer_u and buyer_u[2] else "Игрок")
@@ -11413,6 +14160,107 @@ def _checkpoint_daemon(): #checkpoint
 
 threading.Thread(target=_checkpoint_daemon, daemon=True).start()
 
+# GC старых игр: завершённые/отменённые игры старше GAMES_RETENTION_DAYS уходят в архив,
+# а их служебные строки удаляются пачками по GAMES_GC_BATCH игр.
+GAMES_RETENTION_DAYS = max(1, int(os.getenv("GAMES_RETENTION_DAYS", "14")))
+GAMES_GC_BATCH = 200
+GAMES_GC_MAX_BATCHES = 50          # за один проход, чтобы не держать писателя надолго
+GAMES_GC_INTERVAL_SEC = 3600
+
+# таблицы, где строки живут только вместе с игрой
+GAMES_GC_TABLES = (
+    "game_players", "game_results", "spins", "turn_orders", "rematch_votes",
+    "zero_bets", "zero_lock", "zero_state", "zero_outcomes", "life_wait",
+    "shop_used", "shop_bind", "scheduled_jobs",
+)
+
+GC_PICK_GAMES_SQL = "SELECT game_id FROM games WHERE state IN ('finished','cancelled') AND COALESCE(created_ts,0) < ? LIMIT ?"
+
+GAMES_GC_STATS = {"runs": 0, "games": 0, "rows": 0, "last_ts": 0, "last_games": 0, "last_rows": 0}
+
+def gc_old_games_batch(cutoff_ts: int, limit: int = GAMES_GC_BATCH) -> Tuple[int, int]:
+    """Одна пачка: (игр заархивировано, строк удалено)."""
+    rows = db_all(GC_PICK_GAMES_SQL, (int(cutoff_ts), int(limit)))
+    ids = [r[0] for r in rows or []]
+    if not ids:
+        return 0, 0
+
+    qmarks = ",".join(["?"] * len(ids))
+    reclaimed = 0
+    with db_tx():
+        db_exec(f"""
+            INSERT OR IGNORE INTO games_archive
+              (game_id, game_type, state, creator_id, stake_cents, created_ts, cross_round, origin_chat_id, archived_ts)
+            SELECT game_id, COALESCE(game_type,'roulette'), state, creator_id, stake_cents, created_ts,
+                   COALESCE(cross_round,1), COALESCE(origin_chat_id,0), ?
+            FROM games WHERE game_id IN ({qmarks})
+        """, (now_ts(), *ids), commit=True)
+        db_exec(f"""
+            INSERT OR IGNORE INTO game_results_archive (game_id, user_id, delta_cents)
+            SELECT game_id, user_id, COALESCE(delta_cents,0) FROM game_results WHERE game_id IN ({qmarks})
+        """, tuple(ids), commit=True)
+
+        for table in GAMES_GC_TABLES:
+            col = "ref" if table == "scheduled_jobs" else "game_id"
+            rc, _ = db_exec(f"DELETE FROM {table} WHERE {col} IN ({qmarks})", tuple(ids), commit=True)
+            reclaimed += max(0, int(rc or 0))
+        rc, _ = db_exec(f"DELETE FROM games WHERE game_id IN ({qmarks})", tuple(ids), commit=True)
+        reclaimed += max(0, int(rc or 0))
+
+    return len(ids), reclaimed
+
+def gc_old_games() -> Tuple[int, int]:
+    cutoff = now_ts() - GAMES_RETENTION_DAYS * 24 * 3600
+    games_n, rows_n = 0, 0
+    for _ in range(GAMES_GC_MAX_BATCHES):
+        g, r = gc_old_games_batch(cutoff)
+        games_n += g
+        rows_n += r
+        if g < GAMES_GC_BATCH:
+            break
+        time.sleep(0.2)  # даём пройти обычным записям
+
+    # continue_tokens привязаны к group_key, чистим просто по возрасту
+    rc, _ = db_exec("DELETE FROM continue_tokens WHERE COALESCE(ts,0) < ?", (cutoff,), commit=True)
+    rows_n += max(0, int(rc or 0))
+    # привязки к играм, которых уже нет (в том числе собранных до появления shop_bind в GAMES_GC_TABLES)
+    rc, _ = db_exec("DELETE FROM shop_bind WHERE game_id NOT IN (SELECT game_id FROM games)", (), commit=True)
+    rows_n += max(0, int(rc or 0))
+
+    GAMES_GC_STATS["runs"] += 1
+    GAMES_GC_STATS["games"] += games_n
+    GAMES_GC_STATS["rows"] += rows_n
+    GAMES_GC_STATS["last_ts"] = now_ts()
+    GAMES_GC_STATS["last_games"] = games_n
+    GAMES_GC_STATS["last_rows"] = rows_n
+    if games_n or rows_n:
+        print(f"games gc: archived {games_n} games, reclaimed {rows_n} rows")
+    return games_n, rows_n
+
+def _games_gc_daemon():
+    while True:
+        try:
+            gc_old_games()
+        except Exception:
+            send_error_report("_games_gc_daemon")
+        time.sleep(GAMES_GC_INTERVAL_SEC)
+
+threading.Thread(target=_games_gc_daemon, daemon=True).start()
+
+# Проверки на старте: планы горячих запросов и таблицы выплат слотов
+try:
+    for _title, _ok, _plan in check_query_plans():
+        if not _ok:
+            print("QUERY PLAN FULL SCAN:", _title, "->", _plan)
+except Exception as e:
+    print("query plan check failed:", repr(e))
+try:
+    _bad = check_slot_tables()
+    if _bad:
+        print("SLOT TABLES MISMATCH:", len(_bad), _bad[:5])
+except Exception as e:
+    print("slot table check failed:", repr(e))
+
 # RUN
 print(f"Contest bot started as @{BOT_USERNAME}")
 while True: